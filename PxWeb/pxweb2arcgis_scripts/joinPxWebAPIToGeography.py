@@ -1,5 +1,6 @@
 import arcpy
 import os
+import sys
 import shutil
 import json
 import csv
@@ -8,7 +9,24 @@ from datetime import datetime
 from dateutil import parser
 from pathlib import Path
 
-import jsonstat
+# helpers shared by the SDMX and PxWeb tools live in the top-level common folder
+sys.path.append(str(Path(__file__).resolve().parents[2].joinpath('common')))
+from geometry_setup import parse_geometry_options, build_geometry_index
+from feature_writer import FeatureWriter
+from normalized_output import NormalizedOutputWriter, get_output_layout, create_stats_table, create_relationship_class
+from pivot_output import pivot_wide, iter_wide_rows
+from unmatched_rows import create_unmatched_rows_table, get_missing_keys_table_path, write_missing_keys_table, missing_keys_summary
+from feature_upserter import FeatureUpserter
+from join_keys import JoinKeyTransform
+from tool_parameters import get_optional_parameter, get_optional_parameter_as_text
+from progress_reporter import ProgressReporter, set_progressor, reset_progressor
+from schema_inference import TableSchema, DEFAULT_PERIOD_FIELDS
+from http_client import get_client
+
+import pandas as pd
+
+from pxweb_jsonstat import JsonStatCube, merge_datasets, encode
+from pxweb_query import PxWebQueryPlanner, get_table_metadata, fetch_queries, DEFAULT_MAX_CELLS, DEFAULT_MAX_WORKERS
 
 def create_working_directory():
     now_ts = datetime.now().strftime('%Y%m%d%H%M%S')
@@ -22,12 +40,12 @@ def create_working_directory():
 
     return [full_job_path, now_ts]
 
-def get_pxw_field_aliases(dataset):
+def get_pxw_field_aliases(pxw_cube):
     fields = []
-    for i, d in enumerate(dataset.dimensions()):
+    for i, d in enumerate(pxw_cube.dimensions):
         f = {
-            'name': d.label,
-            'alias': d.did,
+            'name': d['label'],
+            'alias': d['id'],
             'type': 'String'
         }
 
@@ -39,65 +57,45 @@ def get_pxw_field_aliases(dataset):
     ]
     return fields
 
-def query_and_parse_pxw(in_url, in_pxw_body_file_path):
+def query_and_parse_pxw(in_url, in_pxw_body_file_path, max_cells=DEFAULT_MAX_CELLS, max_workers=DEFAULT_MAX_WORKERS, headless=False):
     json_params = None
     # arcpy.AddMessage(in_url)
     # arcpy.AddMessage(in_pxw_body_file_path)
     with open(in_pxw_body_file_path, encoding='utf-8') as json_file:
         json_params = json.load(json_file)
-    
-    response = requests.post(in_url, json=json_params)
+
+    # plan the query against the table metadata so no single request goes over the server's cell limit
+    planner = PxWebQueryPlanner(json_params, get_table_metadata(in_url), max_cells)
+    queries = planner.plan()
+    if len(queries) > 1:
+        arcpy.AddMessage(f'Query of about {planner.estimate_cells(json_params)} cells split into {len(queries)} requests')
+        progress = ProgressReporter(f'Querying PxWeb API in {len(queries)} requests', len(queries), 'Request', headless=headless)
+        try:
+            res_jsons = fetch_queries(in_url, queries, max_workers, on_result=lambda i, res_json: progress.update())
+        except requests.exceptions.RequestException as e:
+            arcpy.AddError(f'Unable to query PxWeb API :: {e}')
+            raise arcpy.ExecuteError
+        progress.finish()
+
+        # one dataset again, categories in the table's order
+        return JsonStatCube(merge_datasets(res_jsons, planner.category_order()))
+
+    try:
+        response = get_client().post(in_url, json=json_params)
+    except requests.exceptions.RequestException as e:
+        arcpy.AddError(f'Unable to query PxWeb API :: {e}')
+        raise arcpy.ExecuteError
     
     return_dataset = None
     if response:
         res_json = response.json()
-        jstat = jsonstat.from_json(res_json)
-        return_dataset = jstat.dataset(0)
+        return_dataset = JsonStatCube(res_json)
 
     return return_dataset
 
-def create_data_frame(dataset, pxw_jf_name, pxw_jf_label):
-    area_dim = None
-    
-    for d in dataset.dimensions():
-        if d.label.strip() == pxw_jf_label.strip():
-            area_dim = d
-            break
-
-    cnt = area_dim.__len__()
-    cat_lookups = {}
-    for i in range(0, cnt):
-        cat = area_dim.category(i)
-        cat_lookups[cat.label] = cat.index
-    
-    def get_code(row):
-        return cat_lookups[row[pxw_jf_label]]
-
-    def get_units_decimals(row, f):
-        r_info = row['Information']
-
-        for i, d in enumerate(dataset.dimensions()):
-            if d.role == 'metric' and d._JsonStatDimension__unit:
-                unit_info = d._JsonStatDimension__unit
-                
-                for j in range(0, 99999):
-                    try:
-                        cat = d._pos2cat(j)      
-                        if cat.label == r_info:                  
-                            return unit_info[cat.index][f]                   
-                    except:
-                        arcpy.AddMessage(f'nothing found at index {j}. exiting ..')
-                        break 
-                
-                return 'UNKNOWN'
-
-    df = dataset.to_data_frame()
-
-    df[f'{pxw_jf_label}_Code'] = df.apply(lambda row: get_code(row), axis=1)
-    df['UNITS'] = df.apply(lambda row: get_units_decimals(row, 'base').upper(), axis=1)    
-    df['DECIMALS'] = df.apply(lambda row: get_units_decimals(row, 'decimals'), axis=1)
-
-    return df
+def create_data_frame(pxw_cube, pxw_jf_name, pxw_jf_label):
+    # flatten the cube in one vectorized pass, adding the area code, UNITS and DECIMALS columns
+    return pxw_cube.to_data_frame(pxw_jf_label)
 
 def convert_dataframe_to_csv_file(dataframe, full_job_path):
     file_name = 'fromPxWebapi.csv'
@@ -107,27 +105,50 @@ def convert_dataframe_to_csv_file(dataframe, full_job_path):
 
     return full_path_to_file.resolve()
 
-def get_geom(geo_field, geo_value, join_field_type):
-    global geom_cache
-    global geo_fl
-
-    wc = """{0} = '{1}'""".format(arcpy.AddFieldDelimiters(geo_fl, geo_field), geo_value)
-    # arcpy.AddMessage(wc)
-    if geo_value in geom_cache:
-        # arcpy.AddMessage(f'got from cache for {geo_value}')
-        return geom_cache[geo_value]
-    else:
-        geom = None
-        row = None
-        try:
-            row = next(arcpy.da.SearchCursor(geo_fl, ['SHAPE@', geo_field], where_clause=wc))
-            # arcpy.AddMessage(row)
-            geom = row[0]
-            geo_val_to_add = row[1]
-            geom_cache[geo_val_to_add] = geom
-            return geom
-        except:
-            arcpy.AddMessage(f'Unable to get geometry from Geography layer. The where_clause, {wc} did not return results.')
+def get_pxw_field_definitions(dataframe, out_workspace):
+    # [source column, name, type, alias, length] taken from the data frame instead of guessed from a csv
+    field_defs = []
+    for col in dataframe.columns:
+        name = arcpy.ValidateFieldName(col, out_workspace)
+        if col == 'Value':
+            field_defs.append([col, name, 'DOUBLE', col, 8])
+        elif pd.api.types.is_integer_dtype(dataframe[col]):
+            field_defs.append([col, name, 'LONG', col, 4])
+        elif pd.api.types.is_float_dtype(dataframe[col]):
+            field_defs.append([col, name, 'DOUBLE', col, 8])
+        else:
+            length = int(dataframe[col].astype(str).str.len().max()) if len(dataframe) > 0 else 1
+            field_defs.append([col, name, 'TEXT', col, max(length, 1)])
+
+    return field_defs
+
+def iter_dataframe_rows(dataframe):
+    # NaN (missing cells in the cube) is written as null
+    if 'Value' in dataframe.columns:
+        dataframe = dataframe.assign(Value=pd.to_numeric(dataframe['Value'], errors='coerce'))
+    dataframe = dataframe.astype(object).where(dataframe.notna(), None)
+    return dataframe.itertuples(index=False, name=None)
+
+def get_pxw_key_fields(pxw_cube, row_source_names, row_fields):
+    # output fields holding the dimension categories, found by column name or the name the table conversion gave it
+    key_fields = []
+    for dim in pxw_cube.dimensions:
+        for name in (dim['label'], arcpy.ValidateFieldName(dim['label'], 'memory')):
+            if name in row_source_names:
+                key_fields.append(row_fields[row_source_names.index(name)])
+                break
+    return key_fields
+
+def read_table_rows(in_table):
+    with arcpy.da.SearchCursor(in_table, '*') as cursor:
+        for row in cursor:
+            yield row
+
+def report_missing_geom(geo_value, wc):
+    arcpy.AddMessage(f'Unable to get geometry from Geography layer. The where_clause, {wc} did not return results.')
+
+def report_insert_error(row_number, row, e):
+    arcpy.AddWarning(f'Unable to insert row {row_number} into output feature class :: {e}')
 
 
 ################
@@ -144,8 +165,6 @@ in_pxw_join_field_label = in_pxw_join_field_raw[1].strip()
 in_geo_table = arcpy.GetParameter(3)
 in_geo_join_field = arcpy.GetParameterAsText(4)
 
-global geom_cache
-geom_cache = {}
 global geo_fl
 geo_fl = 'geo_fl'
 arcpy.MakeFeatureLayer_management(in_geo_table, geo_fl)
@@ -162,28 +181,118 @@ in_use_wm_sr_for_output = arcpy.GetParameter(10)
 in_should_transform_fields = arcpy.GetParameter(11)
 in_transform_fields = arcpy.GetParameter(12)
 
-arcpy.SetProgressor('default', 'Creating working directory ...')
+in_save_temp_files = get_optional_parameter(13, False)
+in_headless = get_optional_parameter(14, False)
+in_direct_load = get_optional_parameter(15, False)
+in_max_concurrent_queries = get_optional_parameter(16, DEFAULT_MAX_WORKERS)
+in_use_http_cache = get_optional_parameter(17, False)
+in_upsert = get_optional_parameter(18, False)
+in_upsert_delete_missing = get_optional_parameter(19, False)
+in_key_normalization = get_optional_parameter_as_text(20)
+in_unmatched_rows_to_table = get_optional_parameter(21, False)
+in_output_layout = get_optional_parameter_as_text(22)
+in_create_relationship_class = get_optional_parameter(23, False)
+in_simplify_tolerance = get_optional_parameter_as_text(24)
+in_use_geometry_index_cache = get_optional_parameter(25, True)
+in_max_cells_per_query = get_optional_parameter(26, DEFAULT_MAX_CELLS)
+
+join_key_normalizer, in_simplify_tolerance = parse_geometry_options(in_key_normalization, in_simplify_tolerance)
+
+# FLAT writes every row with its geometry, NORMALIZED writes each geometry once and the rows to a related table,
+# WIDE writes one feature per area with a column per period / measure
+try:
+    in_output_layout = get_output_layout(in_output_layout)
+except ValueError as e:
+    arcpy.AddError(str(e))
+    raise arcpy.ExecuteError
+
+# the http client lives for the whole Pro session, only report this run's requests
+get_client().clear_timings()
+# responses are cached on disk when asked for, reruns against unchanged data only revalidate them
+get_client().cache.enabled = in_use_http_cache
+
+set_progressor('Creating working directory ...', in_headless)
 # create working directory
 wd_res = create_working_directory()
 full_job_path = wd_res[0]
 now_ts = wd_res[1]
 
-arcpy.SetProgressor('default', 'Querying PxWeb API ...')
+progress = ProgressReporter('Querying PxWeb API', headless=in_headless)
 # get pxw api response 
-pxw_response = query_and_parse_pxw(in_pxw_api_url, in_pxw_post_body)
+pxw_response = query_and_parse_pxw(in_pxw_api_url, in_pxw_post_body, in_max_cells_per_query, in_max_concurrent_queries, in_headless)
+progress.finish()
 
-arcpy.SetProgressor('default', 'Converting PxWeb JSON-Stat to CSV ...')
+progress = ProgressReporter('Converting PxWeb JSON-Stat to a data frame', headless=in_headless)
 # convert pxw json-stat to pandas dataframe
 pxw_as_dataframe = create_data_frame(pxw_response, in_pxw_join_field_name, in_pxw_join_field_label)
-
-# convert pandas data frame to csv and write to temp file location
-path_to_csv_file = convert_dataframe_to_csv_file(pxw_as_dataframe, full_job_path)
-
-arcpy.SetProgressor('default', 'Converting CSV file to Table in memory ...')
-# write csv to temp table in output workspace - will be deleted later
-tmp_stats_tbl = 'tbl_tmp'
-arcpy.TableToTable_conversion(str(path_to_csv_file), 'memory', tmp_stats_tbl)
-in_mem_stats_tbl = f'memory\\{tmp_stats_tbl}'
+progress.update(len(pxw_as_dataframe))
+progress.finish()
+
+in_mem_stats_tbl = None
+schema = None
+if in_output_layout == 'WIDE':
+    if in_save_temp_files:
+        convert_dataframe_to_csv_file(pxw_as_dataframe, full_job_path)
+
+    set_progressor('Pivoting PxWeb observations ...', in_headless)
+    # the join dimension becomes the rows, every other dimension that varies becomes columns named from its codes
+    join_dim = pxw_response.find_dimension(in_pxw_join_field_label)
+    pivot_dims = [dim for dim in pxw_response.dimensions if dim is not join_dim]
+    pivot_source = pxw_as_dataframe.assign(**{f'{dim["label"]}_Code': encode(pxw_response.category_positions(dim), dim['codes']) for dim in pivot_dims})
+    join_columns = [f'{in_pxw_join_field_label}_Code', in_pxw_join_field_label]
+    if not in_pxw_use_calcd_geo_code_field_for_join:
+        join_columns.reverse()
+
+    wide_frame, stats_source_fields, dropped_fields = pivot_wide(
+        pivot_source,
+        join_columns,
+        [(f'{dim["label"]}_Code', dim['label']) for dim in pivot_dims],
+        'Value',
+        in_output_workspace,
+        ['UNITS', 'DECIMALS']
+    )
+    if dropped_fields:
+        arcpy.AddWarning(f'Fields that vary between observations are not part of the WIDE output :: {", ".join(dropped_fields)}')
+    arcpy.AddMessage(f'{len(pxw_as_dataframe)} observations pivoted to {len(wide_frame)} rows of {len(stats_source_fields)} fields')
+    del pivot_source
+
+    stats_row_source_names = [f[0] for f in stats_source_fields]
+    stats_row_fields = [f[1] for f in stats_source_fields]
+    stats_rows = iter_wide_rows(wide_frame)
+    cnt = len(wide_frame)
+elif in_direct_load:
+    # rows go straight from the data frame into the output feature class, the csv is only written for debugging
+    if in_save_temp_files:
+        convert_dataframe_to_csv_file(pxw_as_dataframe, full_job_path)
+
+    stats_source_fields = get_pxw_field_definitions(pxw_as_dataframe, in_output_workspace)
+    stats_row_source_names = [f[0] for f in stats_source_fields]
+    stats_row_fields = [f[1] for f in stats_source_fields]
+    stats_rows = iter_dataframe_rows(pxw_as_dataframe)
+    cnt = len(pxw_as_dataframe)
+else:
+    progress = ProgressReporter('Writing CSV file', headless=in_headless)
+    # convert pandas data frame to csv and write to temp file location
+    path_to_csv_file = convert_dataframe_to_csv_file(pxw_as_dataframe, full_job_path)
+    progress.update(len(pxw_as_dataframe))
+    progress.finish()
+
+    progress = ProgressReporter('Converting CSV file to Table in memory', headless=in_headless)
+    # write csv to temp table in output workspace - will be deleted later
+    tmp_stats_tbl = 'tbl_tmp'
+    arcpy.TableToTable_conversion(str(path_to_csv_file), 'memory', tmp_stats_tbl)
+    in_mem_stats_tbl = f'memory\\{tmp_stats_tbl}'
+    progress.finish()
+
+    # typed from the values rather than what the csv conversion guessed, the time dimension becomes dates
+    time_fields = [arcpy.ValidateFieldName(dim['label'], 'memory') for dim in pxw_response.dimensions if dim['id'] in pxw_response.roles.get('time', [])]
+    join_fields = [arcpy.ValidateFieldName(f, 'memory') for f in (in_pxw_join_field_label, f'{in_pxw_join_field_label}_Code')]
+    schema = TableSchema.from_table(in_mem_stats_tbl, period_fields=DEFAULT_PERIOD_FIELDS + tuple(time_fields), text_fields=join_fields)
+    stats_source_fields = [[name, name, field_type, alias, length] for name, field_type, alias, length in schema.field_definitions()]
+    stats_row_source_names = list(schema.names)
+    stats_row_fields = list(stats_row_source_names)
+    stats_rows = schema.convert_rows(read_table_rows(in_mem_stats_tbl))
+    cnt = int(arcpy.GetCount_management(in_mem_stats_tbl)[0])
 
 # test write output table to workspace to make sure pxw data came in ok
 # arcpy.TableToTable_conversion(in_mem_stats_tbl, in_output_workspace, 'pxw_table')
@@ -197,23 +306,30 @@ elif pxw_response.label:
 # build path to newly created output feature class 
 final_output_fc_path = os.path.join(in_output_workspace, in_output_filename)
 
+# in upsert mode an existing output is updated in place, keyed on the dimension categories
+upsert_existing = in_upsert and arcpy.Exists(final_output_fc_path)
+if upsert_existing and in_output_layout != 'FLAT':
+    arcpy.AddError('Upserting into an existing output only works with the FLAT output layout')
+    raise arcpy.ExecuteError
+
 # check if the filename for the output fc already exists, if so, add the now_ts (timestamp) to the end
-if arcpy.Exists(final_output_fc_path):
+if not upsert_existing and arcpy.Exists(final_output_fc_path):
     in_output_filename = f'{in_output_filename}_{now_ts}' 
     final_output_fc_path = os.path.join(in_output_workspace, in_output_filename)
 
-arcpy.SetProgressor('default', 'Creating output Feature Class ...')
-# create output feature class
-geo_layer_feature_type = in_geo_fl_desc.shapeType
-geo_layer_sr = arcpy.SpatialReference(102100) if in_use_wm_sr_for_output else in_geo_fl_desc.spatialReference
-arcpy.CreateFeatureclass_management(in_output_workspace, in_output_filename, geo_layer_feature_type, '#', '#', '#', geo_layer_sr)
+if not upsert_existing:
+    set_progressor('Creating output Feature Class ...', in_headless)
+    # create output feature class
+    geo_layer_feature_type = in_geo_fl_desc.shapeType
+    geo_layer_sr = arcpy.SpatialReference(102100) if in_use_wm_sr_for_output else in_geo_fl_desc.spatialReference
+    arcpy.CreateFeatureclass_management(in_output_workspace, in_output_filename, geo_layer_feature_type, '#', '#', '#', geo_layer_sr)
 
 # get field alias info
 if in_should_update_field_aliases_on_output:
-    arcpy.SetProgressor('default', 'Collecting field alias information ...')
+    set_progressor('Collecting field alias information ...', in_headless)
     alias_info = get_pxw_field_aliases(pxw_response)
 
-arcpy.SetProgressor('default', 'Building fields to add to output feature class ...')
+set_progressor('Building fields to add to output feature class ...', in_headless)
 # build list of fields to add
 add_field_type_map = {
     'Integer': 'LONG',
@@ -222,81 +338,128 @@ add_field_type_map = {
 }
 stats_tbl_fields = []
 join_field_type = 'text'
-stats_table_fields = arcpy.ListFields(in_mem_stats_tbl)
-for f in stats_table_fields:
-    if not f.required:
-        alias = f.aliasName
-        if in_should_update_field_aliases_on_output:
-            found_field = [ff for ff in alias_info if ff['name'] == f.name]
-            if found_field and len(found_field) > 0:
-                found_field = found_field[0]
-                alias = found_field['alias']
-            
-        field_type = f.type
-        if f.type in add_field_type_map.keys():
-            field_type = add_field_type_map[f.type]
-
-        stats_tbl_fields.append([f.name, field_type, alias, f.length])
-
-        if f.name == in_pxw_join_field_name:
-            join_field_type = field_type
-
-arcpy.SetProgressor('default', 'Adding fields to output feature class ...')
-# add the fields
-arcpy.AddFields_management(final_output_fc_path, stats_tbl_fields)
-
-stats_table_fields_list = [f.name for f in stats_table_fields]
+for source_name, name, source_type, alias, length in stats_source_fields:
+    if in_should_update_field_aliases_on_output:
+        found_field = [ff for ff in alias_info if ff['name'] == source_name]
+        if found_field and len(found_field) > 0:
+            found_field = found_field[0]
+            alias = found_field['alias']
+        
+    field_type = source_type
+    if source_type in add_field_type_map.keys():
+        field_type = add_field_type_map[source_type]
+
+    stats_tbl_fields.append([name, field_type, alias, length])
+
+    if source_name == in_pxw_join_field_name:
+        join_field_type = field_type
+
+search_field = in_pxw_join_field_label
+if in_pxw_use_calcd_geo_code_field_for_join:
+    search_field = f'{in_pxw_join_field_label}_Code'
+
+# the output field holding the join values
+output_join_field = stats_row_fields[stats_row_source_names.index(search_field)]
+
+if not upsert_existing:
+    set_progressor('Adding fields to output feature class ...', in_headless)
+    # add the fields
+    if in_output_layout == 'NORMALIZED':
+        # the feature class only gets the join key, the rows go to a stats table
+        arcpy.AddFields_management(final_output_fc_path, [f for f in stats_tbl_fields if f[0] == output_join_field])
+        stats_table_path = create_stats_table(in_output_workspace, in_output_filename, stats_tbl_fields)
+    else:
+        arcpy.AddFields_management(final_output_fc_path, stats_tbl_fields)
+
+stats_table_fields_list = list(stats_row_fields)
 stats_table_fields_list.insert(0, 'SHAPE@')
 # final_outfc_fields = ','.join(stats_table_fields_list)
 
-cnt = int(arcpy.GetCount_management(in_mem_stats_tbl)[0])
-arcpy.SetProgressor('step', f'Inserting {cnt} rows into output feature class ...', 0, cnt, 1)
-# add features with geometry to the output feature class
-counter = 1
-with arcpy.da.SearchCursor(in_mem_stats_tbl, '*') as cursor:
-    for row in cursor:
-        arcpy.SetProgressorPosition(counter)
-        arcpy.SetProgressorLabel(f'Inserting row {counter} of {cnt} ...')
-
-        stats_cursor_fields = cursor.fields
-        
-        search_field = in_pxw_join_field_label
-        if in_pxw_use_calcd_geo_code_field_for_join:
-            search_field = f'{in_pxw_join_field_label}_Code'
-
-        search_val = row[stats_cursor_fields.index(search_field)]
-
-        if in_should_transform_fields and in_transform_fields.rowCount > 0:
-            for i in range(0, in_transform_fields.rowCount):
-                find_val = in_transform_fields.getValue(i, 0)
-                rep_val = in_transform_fields.getValue(i, 1)
-
-                if find_val and rep_val == 'None':
-                    search_val = search_val.replace(find_val, '')
-                elif find_val and rep_val == '':
-                    search_val = f'{find_val}{search_val}'
-                elif find_val == '' and rep_val:
-                    search_val = f'{search_val}{rep_val}'
-                elif find_val and rep_val:
-                    search_val = f'{find_val}{search_val}{rep_val}'
-
-        geom = get_geom(in_geo_join_field, search_val, join_field_type)
-
-        row_list = list(row)
-        row_list.insert(0, geom)
-        insert_row = tuple(row_list)
-        # arcpy.AddMessage(insert_row)
-
-        with arcpy.da.InsertCursor(final_output_fc_path, stats_table_fields_list) as ic:
-            try:
-                ic.insertRow(insert_row)
-                counter = counter + 1
-            except:
-                arcpy.AddMessage(ic.fields)
-                arcpy.AddError('Error inserting rows')
-                raise arcpy.ExecuteError
-
-arcpy.ResetProgressor()
+# scan the geography layer once so each join value is a dictionary lookup
+global geom_index
+join_key_transform = None
+if in_should_transform_fields and in_transform_fields.rowCount > 0:
+    # the transform rules are read once, not on every row
+    join_key_transform = JoinKeyTransform.from_value_table(in_transform_fields)
+geom_index = build_geometry_index(geo_fl, in_geo_join_field, on_miss=report_missing_geom, key_transform=join_key_transform, key_normalizer=join_key_normalizer, use_cache=in_use_geometry_index_cache, simplify_tolerance=in_simplify_tolerance, headless=in_headless)
+# a cached index memory-maps its file, release it however the join ends
+try:
+    if upsert_existing:
+        pxw_key_fields = get_pxw_key_fields(pxw_response, stats_row_source_names, stats_row_fields)
+        try:
+            writer = FeatureUpserter(final_output_fc_path, stats_table_fields_list, pxw_key_fields, in_upsert_delete_missing, on_error=report_insert_error, field_types={f[0]: f[1] for f in stats_tbl_fields})
+        except ValueError as e:
+            arcpy.AddError(f'Unable to upsert into the existing output feature class :: {e}')
+            raise arcpy.ExecuteError
+        arcpy.AddMessage(f'Upserting into existing output feature class {final_output_fc_path}')
+    elif in_output_layout == 'NORMALIZED':
+        writer = NormalizedOutputWriter(final_output_fc_path, stats_table_path, stats_table_fields_list, output_join_field, on_error=report_insert_error)
+    else:
+        writer = FeatureWriter(final_output_fc_path, stats_table_fields_list, on_error=report_insert_error)
+
+    unmatched_writer = None
+    if in_unmatched_rows_to_table:
+        # rows without geometry go to a non-spatial table instead of the output feature class
+        unmatched_table_path = create_unmatched_rows_table(in_output_workspace, in_output_filename, stats_tbl_fields)
+        unmatched_writer = FeatureWriter(unmatched_table_path, stats_table_fields_list[1:], on_error=report_insert_error)
+
+    progress = ProgressReporter(f'Inserting {cnt} rows into output feature class', cnt, 'Inserting row', headless=in_headless)
+    # add features with geometry to the output feature class
+    with writer:
+        # look up the position of the join field once, not on every row
+        join_field_idx = stats_row_source_names.index(search_field)
+        for row in stats_rows:
+            search_val = row[join_field_idx]
+
+            # any join key transform is already part of the index
+            geom = geom_index.get(search_val)
+
+            if geom is None and unmatched_writer is not None:
+                unmatched_writer.write(tuple(row))
+            else:
+                writer.write((geom,) + tuple(row))
+            progress.update()
+
+    progress.finish()
+finally:
+    geom_index.close()
+
+if geom_index.normalized_matches:
+    arcpy.AddMessage(f'{len(geom_index.normalized_matches)} join keys only matched the Geography layer after normalization')
+
+if unmatched_writer is not None:
+    unmatched_writer.close()
+    arcpy.AddMessage(f'{unmatched_writer.rows_written} rows without geometry written to {unmatched_table_path}')
+
+if schema is not None and schema.conversion_errors > 0:
+    arcpy.AddWarning(f'{schema.conversion_errors} values did not fit the field types inferred from a sample of the rows and were written as null')
+
+# one line per join key without geometry, however many rows it has
+miss_counts = geom_index.miss_counts
+for msg in missing_keys_summary(miss_counts):
+    arcpy.AddMessage(msg)
+missing_keys_table_path = write_missing_keys_table(get_missing_keys_table_path(in_output_workspace, in_output_filename), miss_counts, in_output_filename)
+if miss_counts:
+    arcpy.AddWarning(f'{len(miss_counts)} join keys have no geometry in the Geography layer, see {missing_keys_table_path}')
+
+if upsert_existing:
+    arcpy.AddMessage(writer.summary())
+
+if writer.error_count > 0:
+    arcpy.AddWarning(f'{writer.error_count} of {cnt} rows could not be inserted into the output feature class')
+    if writer.rows_written == 0:
+        arcpy.AddError('Error inserting rows')
+        raise arcpy.ExecuteError
+
+if in_output_layout == 'NORMALIZED':
+    arcpy.AddMessage(f'{writer.features_written} features written to {final_output_fc_path}, {writer.rows_written} rows to {stats_table_path}')
+    if in_create_relationship_class:
+        set_progressor('Creating relationship class ...', in_headless)
+        rel_path = create_relationship_class(final_output_fc_path, stats_table_path, output_join_field)
+        if rel_path is None:
+            arcpy.AddWarning('Relationship classes need a geodatabase as the output workspace, none was created')
+
+reset_progressor(in_headless)
 
 # # replace SDMX codes with values
 # if in_should_replace_codes_with_values:
@@ -306,17 +469,19 @@ arcpy.ResetProgressor()
 # set the output parameter
 arcpy.SetParameter(7, final_output_fc_path)
 
-arcpy.SetProgressor('default', 'Cleaning up temporary files ...')
-# delete the in memory workspace
-arcpy.Delete_management(in_mem_stats_tbl)
+if not in_headless:
+    for msg in get_client().timing_summary():
+        arcpy.AddMessage(msg)
 
-# clean up geometry cache variable
-del geom_cache
+set_progressor('Cleaning up temporary files ...', in_headless)
+# delete the in memory workspace
+if in_mem_stats_tbl is not None:
+    arcpy.Delete_management(in_mem_stats_tbl)
 
 # delete tmp directory
-# if not in_save_temp_files:
-#     pth = Path(full_job_path)
-#     if pth.exists():
-#         shutil.rmtree(pth)
-# else:
-#     arcpy.AddMessage(f'Temp files saved at {full_job_path}')
\ No newline at end of file
+if not in_save_temp_files:
+    pth = Path(full_job_path)
+    if pth.exists():
+        shutil.rmtree(pth)
+else:
+    arcpy.AddMessage(f'Temp files saved at {full_job_path}')
\ No newline at end of file
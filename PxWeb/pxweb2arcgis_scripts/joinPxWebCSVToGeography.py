@@ -1,5 +1,6 @@
 import arcpy
 import os
+import sys
 import shutil
 import json
 import csv
@@ -8,6 +9,20 @@ from datetime import datetime
 from dateutil import parser
 from pathlib import Path
 
+# helpers shared by the SDMX and PxWeb tools live in the top-level common folder
+sys.path.append(str(Path(__file__).resolve().parents[2].joinpath('common')))
+from geometry_setup import parse_geometry_options, build_geometry_index
+from feature_writer import FeatureWriter
+from normalized_output import NormalizedOutputWriter, get_output_layout, create_stats_table, create_relationship_class
+from unmatched_rows import create_unmatched_rows_table, get_missing_keys_table_path, write_missing_keys_table, missing_keys_summary
+from tool_parameters import get_optional_parameter, get_optional_parameter_as_text
+from progress_reporter import ProgressReporter, set_progressor, reset_progressor
+from schema_inference import TableSchema
+from join_keys import JoinKeyTransform
+
+from pxweb_jsonstat import load_jsonstat_file
+from pxweb_units import add_unit_fields
+
 def write_log(msg):
     global full_log_path
     with open(full_log_path, 'a') as lf:
@@ -27,32 +42,11 @@ def create_working_directory():
 
     return [full_job_path, now_ts]
 
-def get_geom(geo_field, geo_value, join_field_type):
-    global geom_cache
-    global geo_fl
-
-    # if join_field_type == 'TEXT':
-    #     geo_value = f"'{geo_value}'"
+def report_missing_geom(geo_value, wc):
+    write_log(f'Unable to find or get geometry when where clause is :: {wc}')
 
-    wc = """{0} = '{1}'""".format(arcpy.AddFieldDelimiters(geo_fl, geo_field), geo_value)
-    # arcpy.AddMessage(wc)
-    if geo_value in geom_cache:
-        # arcpy.AddMessage(f'got from cache for {geo_value}')
-        return geom_cache[geo_value]
-    else:
-        geom = None
-        row = None
-        try:
-            row = next(arcpy.da.SearchCursor(geo_fl, ['SHAPE@', geo_field],where_clause=wc))
-            geom = row[0]
-            geo_val_to_add = row[1]
-            geom_cache[geo_val_to_add] = geom
-            return geom
-        except:
-            write_log(f'Unable to find or get geometry when where clause is :: {wc}')
-            # arcpy.AddMessage(f'Unable to find or get geometry when where clause is :: {wc}')            
-
-        return geom
+def report_insert_error(row_number, row, e):
+    write_log(f'Unable to insert row {row_number} into output feature class :: {e}')
 
 ################
 # SCRIPT START #
@@ -66,8 +60,6 @@ in_pxw_join_field = arcpy.GetParameterAsText(1)
 in_geo_table = arcpy.GetParameter(2)
 in_geo_join_field = arcpy.GetParameterAsText(3)
 
-global geom_cache
-geom_cache = {}
 global geo_fl
 geo_fl = 'geo_fl'
 arcpy.MakeFeatureLayer_management(in_geo_table, geo_fl)
@@ -86,8 +78,26 @@ in_should_transform_fields = arcpy.GetParameter(8)
 in_transform_fields = arcpy.GetParameter(9)
 
 in_save_temp_files = arcpy.GetParameter(10)
-
-arcpy.SetProgressor('default', 'Creating working directory ...')
+in_headless = get_optional_parameter(11, False)
+in_units_metadata_file = get_optional_parameter_as_text(12)
+in_units_metric_field = get_optional_parameter_as_text(13)
+in_key_normalization = get_optional_parameter_as_text(14)
+in_unmatched_rows_to_table = get_optional_parameter(15, False)
+in_output_layout = get_optional_parameter_as_text(16)
+in_create_relationship_class = get_optional_parameter(17, False)
+in_simplify_tolerance = get_optional_parameter_as_text(18)
+in_use_geometry_index_cache = get_optional_parameter(19, True)
+
+join_key_normalizer, in_simplify_tolerance = parse_geometry_options(in_key_normalization, in_simplify_tolerance)
+
+# FLAT writes every row with its geometry, NORMALIZED writes each geometry once and the rows to a related table
+try:
+    in_output_layout = get_output_layout(in_output_layout, ('FLAT', 'NORMALIZED'))
+except ValueError as e:
+    arcpy.AddError(str(e))
+    raise arcpy.ExecuteError
+
+set_progressor('Creating working directory ...', in_headless)
 # create working directory
 wd_res = create_working_directory()
 full_job_path = wd_res[0]
@@ -102,11 +112,22 @@ with open(full_log_path, 'w') as lf:
     
 write_log('Job Started')
 
-arcpy.SetProgressor('default', 'Converting CSV file to Table in memory ...')
+unit_cube = None
+if in_units_metadata_file:
+    set_progressor('Reading unit information from JSON-stat metadata file ...', in_headless)
+    # resolve units once for the whole job
+    unit_cube = load_jsonstat_file(in_units_metadata_file)
+
+progress = ProgressReporter('Converting CSV file to Table in memory', headless=in_headless)
 # write csv to temp table in output workspace - will be deleted later
 tmp_stats_tbl = 'tbl_tmp'
 arcpy.TableToTable_conversion(in_pxw_csv, 'memory', tmp_stats_tbl)
 in_mem_stats_tbl = f'memory\\{tmp_stats_tbl}'
+progress.finish()
+
+if unit_cube:
+    set_progressor('Adding UNITS and DECIMALS from JSON-stat metadata file ...', in_headless)
+    add_unit_fields(in_mem_stats_tbl, unit_cube, in_units_metric_field, write_log)
 
 # build path to newly created output feature class 
 final_output_fc_path = os.path.join(in_output_workspace, in_output_filename)
@@ -116,7 +137,7 @@ if arcpy.Exists(final_output_fc_path):
     in_output_filename = f'{in_output_filename}_{now_ts}' 
     final_output_fc_path = os.path.join(in_output_workspace, in_output_filename)
 
-arcpy.SetProgressor('default', 'Creating output Feature Class ...')
+set_progressor('Creating output Feature Class ...', in_headless)
 # create output feature class
 geo_layer_feature_type = in_geo_fl_desc.shapeType
 geo_layer_sr = arcpy.SpatialReference(102100) if in_use_wm_sr_for_output else in_geo_fl_desc.spatialReference
@@ -131,90 +152,111 @@ arcpy.CreateFeatureclass_management(in_output_workspace, in_output_filename, geo
 #     raise arcpy.ExecuteError
 #     # alias_info = parse_fields_from_codelists_file(in_codelists_file)
 
-arcpy.SetProgressor('default', 'Building fields to add to output feature class ...')
-# build list of fields to add
-add_field_type_map = {
-    'Integer': 'LONG',
-    'String': 'TEXT',
-    'SmallInteger': 'SHORT'
-}
-stats_tbl_fields = []
+set_progressor('Building fields to add to output feature class ...', in_headless)
+# build list of fields to add, typed from the values rather than what the csv conversion guessed
+schema = TableSchema.from_table(in_mem_stats_tbl, text_fields=[in_pxw_join_field])
+stats_tbl_fields = schema.field_definitions()
 join_field_type = 'text'
-stats_table_fields = arcpy.ListFields(in_mem_stats_tbl)
-for f in stats_table_fields:
-    if not f.required:
-        alias = f.aliasName        
-        field_type = f.type
-        if f.type in add_field_type_map.keys():
-            field_type = add_field_type_map[f.type]
-
-        stats_tbl_fields.append([f.name, field_type, alias, f.length])
-
-        if f.name == in_pxw_join_field:
-            join_field_type = field_type
+for name, field_type, alias, length in stats_tbl_fields:
+    if name == in_pxw_join_field:
+        join_field_type = field_type
 
-arcpy.SetProgressor('default', 'Adding fields to output feature class ...')
+set_progressor('Adding fields to output feature class ...', in_headless)
 # add the fields
-arcpy.AddFields_management(final_output_fc_path, stats_tbl_fields)
+if in_output_layout == 'NORMALIZED':
+    # the feature class only gets the join key, the rows go to a stats table
+    arcpy.AddFields_management(final_output_fc_path, [f for f in stats_tbl_fields if f[0] == in_pxw_join_field])
+    stats_table_path = create_stats_table(in_output_workspace, in_output_filename, stats_tbl_fields)
+else:
+    arcpy.AddFields_management(final_output_fc_path, stats_tbl_fields)
 
-stats_table_fields_list = [f.name for f in stats_table_fields]
+stats_table_fields_list = list(schema.names)
 stats_table_fields_list.insert(0, 'SHAPE@')
 # final_outfc_fields = ','.join(stats_table_fields_list)
 
-cnt = int(arcpy.GetCount_management(in_mem_stats_tbl)[0])
-arcpy.SetProgressor('step', f'Inserting {cnt} rows into output feature class ...', 0, cnt, 1)
-# add features with geometry to the output feature class
-counter = 1
-with arcpy.da.SearchCursor(in_mem_stats_tbl, '*') as cursor:
-    for row in cursor:
-        arcpy.SetProgressorPosition(counter)
-        arcpy.SetProgressorLabel(f'Inserting row {counter} of {cnt} ...')
-
-        stats_cursor_fields = cursor.fields
-        search_val = row[stats_cursor_fields.index(in_pxw_join_field)]
-
-        if in_should_transform_fields and in_transform_fields.rowCount > 0:
-            for i in range(0, in_transform_fields.rowCount):
-                find_val = in_transform_fields.getValue(i, 0)
-                rep_val = in_transform_fields.getValue(i, 1)
-
-                if find_val and rep_val == 'None':
-                    search_val = search_val.replace(find_val, '')
-                elif find_val and rep_val == '':
-                    search_val = f'{find_val}{search_val}'
-                elif find_val == '' and rep_val:
-                    search_val = f'{search_val}{rep_val}'
-                elif find_val and rep_val:
-                    search_val = f'{find_val}{search_val}{rep_val}'
-
-        geom = get_geom(in_geo_join_field, search_val, join_field_type)
-
-        row_list = list(row)
-        row_list.insert(0, geom)
-        insert_row = tuple(row_list)
-        # arcpy.AddMessage(insert_row)
-
-        with arcpy.da.InsertCursor(final_output_fc_path, stats_table_fields_list) as ic:
-            try:
-                ic.insertRow(insert_row)
-                counter = counter + 1
-            except:
-                arcpy.AddMessage(ic.fields)
-                arcpy.AddError('Error inserting rows')
-                raise arcpy.ExecuteError
-
-arcpy.ResetProgressor()
+# scan the geography layer once so each join value is a dictionary lookup
+global geom_index
+join_key_transform = None
+if in_should_transform_fields and in_transform_fields.rowCount > 0:
+    # the transform rules are read once, not on every row
+    join_key_transform = JoinKeyTransform.from_value_table(in_transform_fields)
+geom_index = build_geometry_index(geo_fl, in_geo_join_field, on_miss=report_missing_geom, key_transform=join_key_transform, key_normalizer=join_key_normalizer, use_cache=in_use_geometry_index_cache, simplify_tolerance=in_simplify_tolerance, headless=in_headless)
+# a cached index memory-maps its file, release it however the join ends
+try:
+    cnt = int(arcpy.GetCount_management(in_mem_stats_tbl)[0])
+    unmatched_writer = None
+    if in_unmatched_rows_to_table:
+        # rows without geometry go to a non-spatial table instead of the output feature class
+        unmatched_table_path = create_unmatched_rows_table(in_output_workspace, in_output_filename, stats_tbl_fields)
+        unmatched_writer = FeatureWriter(unmatched_table_path, stats_table_fields_list[1:], on_error=report_insert_error)
+
+    progress = ProgressReporter(f'Inserting {cnt} rows into output feature class', cnt, 'Inserting row', headless=in_headless)
+    # add features with geometry to the output feature class
+    if in_output_layout == 'NORMALIZED':
+        writer = NormalizedOutputWriter(final_output_fc_path, stats_table_path, stats_table_fields_list, in_pxw_join_field, on_error=report_insert_error)
+    else:
+        writer = FeatureWriter(final_output_fc_path, stats_table_fields_list, on_error=report_insert_error)
+
+    with arcpy.da.SearchCursor(in_mem_stats_tbl, '*') as cursor, writer:
+        # look up the position of the join field once, not on every row
+        join_field_idx = cursor.fields.index(in_pxw_join_field)
+        for row in schema.convert_rows(cursor):
+            search_val = row[join_field_idx]
+
+            # any join key transform is already part of the index
+            geom = geom_index.get(search_val)
+
+            if geom is None and unmatched_writer is not None:
+                unmatched_writer.write(tuple(row))
+            else:
+                writer.write((geom,) + tuple(row))
+            progress.update()
+
+    progress.finish()
+finally:
+    geom_index.close()
+
+if geom_index.normalized_matches:
+    arcpy.AddMessage(f'{len(geom_index.normalized_matches)} join keys only matched the Geography layer after normalization')
+
+if unmatched_writer is not None:
+    unmatched_writer.close()
+    arcpy.AddMessage(f'{unmatched_writer.rows_written} rows without geometry written to {unmatched_table_path}')
+
+if schema.conversion_errors > 0:
+    arcpy.AddWarning(f'{schema.conversion_errors} values did not fit the field types inferred from a sample of the rows and were written as null')
+
+# one line per join key without geometry, however many rows it has
+miss_counts = geom_index.miss_counts
+for msg in missing_keys_summary(miss_counts):
+    write_log(msg)
+missing_keys_table_path = write_missing_keys_table(get_missing_keys_table_path(in_output_workspace, in_output_filename), miss_counts, in_output_filename)
+if miss_counts:
+    arcpy.AddWarning(f'{len(miss_counts)} join keys have no geometry in the Geography layer, see {missing_keys_table_path}')
+
+if writer.error_count > 0:
+    arcpy.AddWarning(f'{writer.error_count} of {cnt} rows could not be inserted into the output feature class')
+    if writer.rows_written == 0:
+        arcpy.AddError('Error inserting rows')
+        raise arcpy.ExecuteError
+
+if in_output_layout == 'NORMALIZED':
+    arcpy.AddMessage(f'{writer.features_written} features written to {final_output_fc_path}, {writer.rows_written} rows to {stats_table_path}')
+    if in_create_relationship_class:
+        set_progressor('Creating relationship class ...', in_headless)
+        rel_path = create_relationship_class(final_output_fc_path, stats_table_path, in_pxw_join_field)
+        if rel_path is None:
+            arcpy.AddWarning('Relationship classes need a geodatabase as the output workspace, none was created')
+
+reset_progressor(in_headless)
 
 # set the output parameter
 arcpy.SetParameter(6, final_output_fc_path)
 
-arcpy.SetProgressor('default', 'Cleaning up temporary files ...')
+set_progressor('Cleaning up temporary files ...', in_headless)
 # finally, delete the in memory workspace
 arcpy.Delete_management(in_mem_stats_tbl)
 
-# clean up geometry cache variable
-del geom_cache
-
 # delete tmp directory
 if not in_save_temp_files:
     pth = Path(full_job_path)
@@ -1,5 +1,7 @@
 import arcpy
 import os
+import sys
+import glob
 import shutil
 import json
 import csv
@@ -7,7 +9,20 @@ import requests
 from datetime import datetime
 from dateutil import parser
 from pathlib import Path
-import glob
+
+# helpers shared by the SDMX and PxWeb tools live in the top-level common folder
+sys.path.append(str(Path(__file__).resolve().parents[2].joinpath('common')))
+from geometry_setup import parse_geometry_options, build_geometry_index
+from tool_parameters import get_optional_parameter, get_optional_parameter_as_text
+from progress_reporter import ProgressReporter, set_progressor, reset_progressor
+from join_keys import JoinKeyTransform
+
+from batch_pool import imap_in_pool
+from batch_manifest import BatchManifest, file_hash, params_hash
+from unmatched_rows import write_missing_keys_table, missing_keys_summary
+
+from pxweb_jsonstat import load_jsonstat_file
+from pxweb_csv_batch import process_csv_file, init_worker, process_csv_file_in_worker
 
 def write_log(msg):
     global full_log_path
@@ -30,32 +45,8 @@ def create_working_directory():
 
     return [full_job_path, now_ts]
 
-def get_geom(geo_field, geo_value, join_field_type):
-    global geom_cache
-    global geo_fl
-
-    # if join_field_type == 'TEXT':
-    #     geo_value = f"'{geo_value}'"
-
-    wc = """{0} = '{1}'""".format(arcpy.AddFieldDelimiters(geo_fl, geo_field), geo_value)
-    # arcpy.AddMessage(wc)
-    if geo_value in geom_cache:
-        # arcpy.AddMessage(f'got from cache for {geo_value}')
-        return geom_cache[geo_value]
-    else:
-        geom = None
-        row = None
-        try:
-            row = next(arcpy.da.SearchCursor(geo_fl, ['SHAPE@', geo_field],where_clause=wc))
-            geom = row[0]
-            geo_val_to_add = row[1]
-            geom_cache[geo_val_to_add] = geom
-            return geom
-        except:
-            write_log(f'Unable to find or get geometry when where clause is :: {wc}')
-            # arcpy.AddMessage(f'Unable to find or get geometry when where clause is :: {wc}')            
-
-        return geom
+def report_missing_geom(geo_value, wc):
+    write_log(f'Unable to find or get geometry when where clause is :: {wc}')
 
 ################
 # SCRIPT START #
@@ -68,8 +59,6 @@ in_pxw_join_field = arcpy.GetParameterAsText(1)
 in_geo_table = arcpy.GetParameter(2)
 in_geo_join_field = arcpy.GetParameterAsText(3)
 
-global geom_cache
-geom_cache = {}
 global geo_fl
 geo_fl = 'geo_fl'
 arcpy.MakeFeatureLayer_management(in_geo_table, geo_fl)
@@ -84,8 +73,19 @@ in_use_wm_sr_for_output = arcpy.GetParameter(6)
 in_should_transform_fields = arcpy.GetParameter(7)
 in_transform_fields = arcpy.GetParameter(8)
 in_save_temp_files = arcpy.GetParameter(9)
-
-arcpy.SetProgressor('default', 'Creating working directory ...')
+in_headless = get_optional_parameter(10, False)
+in_units_metadata_file = get_optional_parameter_as_text(11)
+in_units_metric_field = get_optional_parameter_as_text(12)
+in_worker_count = get_optional_parameter(13, 1)
+in_rebuild_all = get_optional_parameter(14, False)
+in_key_normalization = get_optional_parameter_as_text(15)
+in_unmatched_rows_to_table = get_optional_parameter(16, False)
+in_simplify_tolerance = get_optional_parameter_as_text(17)
+in_use_geometry_index_cache = get_optional_parameter(18, True)
+
+join_key_normalizer, in_simplify_tolerance = parse_geometry_options(in_key_normalization, in_simplify_tolerance)
+
+set_progressor('Creating working directory ...', in_headless)
 # create working directory
 wd_res = create_working_directory()
 full_job_path = wd_res[0]
@@ -103,118 +103,150 @@ with open(full_log_path, 'w') as lf:
     
 write_log('Job Started')
 
-for fname in glob.glob(f'{in_pxw_csv_folder}/*.csv'):
-    # use the incoming filename to as the default for the output
-    in_output_filename = arcpy.ValidateTableName(os.path.splitext(os.path.basename(fname))[0])
-
-    arcpy.SetProgressor('default', f'Converting CSV file \'{fname}\' to Table in memory ...')
-    # write csv to temp table in output workspace - will be deleted later
-    tmp_stats_tbl = 'tbl_tmp'
-    arcpy.TableToTable_conversion(fname, 'memory', tmp_stats_tbl)
-    in_mem_stats_tbl = f'memory\\{tmp_stats_tbl}'
-
+unit_cube = None
+if in_units_metadata_file:
+    set_progressor('Reading unit information from JSON-stat metadata file ...', in_headless)
+    # resolve units once for the whole job
+    unit_cube = load_jsonstat_file(in_units_metadata_file)
+
+# scan the geography layer once so each join value is a dictionary lookup
+global geom_index
+join_key_transform = None
+if in_should_transform_fields and in_transform_fields.rowCount > 0:
+    # the transform rules are read once and go into the index, workers get them with it
+    join_key_transform = JoinKeyTransform.from_value_table(in_transform_fields)
+geom_index = build_geometry_index(geo_fl, in_geo_join_field, on_miss=report_missing_geom, key_transform=join_key_transform, key_normalizer=join_key_normalizer, use_cache=in_use_geometry_index_cache, simplify_tolerance=in_simplify_tolerance, headless=in_headless)
+# a cached index memory-maps its file, release it however the join ends
+try:
     ### TODO
     # use the output filename pattern if there is a value
     if in_output_filename_pattern:
         arcpy.AddMessage('TODO :: file name pattern for output name not yet implemented')
 
-    # build path to newly created output feature class
-    final_output_fc_path = os.path.join(in_output_workspace, in_output_filename)
-
-    # check if the filename for the output fc already exists, if so, add the now_ts (timestamp) to the end
-    if arcpy.Exists(final_output_fc_path):
-        in_output_filename = f'{in_output_filename}_{now_ts}' 
-        final_output_fc_path = os.path.join(in_output_workspace, in_output_filename)
-
-    arcpy.SetProgressor('default', f'Creating output Feature Class :: {in_output_filename} ...')
-    # create output feature class
-    geo_layer_feature_type = in_geo_fl_desc.shapeType
-    geo_layer_sr = in_geo_fl_desc.spatialReference
-    arcpy.CreateFeatureclass_management(in_output_workspace, in_output_filename, geo_layer_feature_type, '#', '#', '#', geo_layer_sr)
-
-    arcpy.SetProgressor('default', 'Building fields to add to output feature class ...')
-    # build list of fields to add
-    add_field_type_map = {
-        'Integer': 'LONG',
-        'String': 'TEXT',
-        'SmallInteger': 'SHORT'
+    # sorted, so outputs are named and written in the same order on every run
+    csv_files = sorted(glob.glob(f'{in_pxw_csv_folder}/*.csv'))
+
+    process_options = {
+        'join_field': in_pxw_join_field,
+        'unit_cube': unit_cube,
+        'units_metric_field': in_units_metric_field,
+        'headless': in_headless,
+        'unmatched_rows_to_table': in_unmatched_rows_to_table,
+        'shape_type': in_geo_fl_desc.shapeType,
+        'spatial_reference': in_geo_fl_desc.spatialReference.exportToString(),
+        'now_ts': now_ts
     }
-    stats_tbl_fields = []
-    join_field_type = 'text'
-    stats_table_fields = arcpy.ListFields(in_mem_stats_tbl)
-    for f in stats_table_fields:
-        if not f.required:
-            alias = f.aliasName                
-            field_type = f.type
-            if f.type in add_field_type_map.keys():
-                field_type = add_field_type_map[f.type]
-
-            stats_tbl_fields.append([f.name, field_type, alias, f.length])
-
-            if f.name == in_pxw_join_field:
-                join_field_type = field_type
-
-    arcpy.SetProgressor('default', 'Adding fields to output feature class ...')
-    # add the fields
-    arcpy.AddFields_management(final_output_fc_path, stats_tbl_fields)
-
-    stats_table_fields_list = [f.name for f in stats_table_fields]
-    stats_table_fields_list.insert(0, 'SHAPE@')
-    # final_outfc_fields = ','.join(stats_table_fields_list)
-
-    cnt = int(arcpy.GetCount_management(in_mem_stats_tbl)[0])
-    arcpy.SetProgressor('step', f'Inserting {cnt} rows into output feature class ...', 0, cnt, 1)
-    # add features with geometry to the output feature class
-    counter = 1
-    with arcpy.da.SearchCursor(in_mem_stats_tbl, '*') as cursor:
-        for row in cursor:
-            arcpy.SetProgressorPosition(counter)
-            arcpy.SetProgressorLabel(f'Feature Class \'{in_output_filename}\' -- Inserting row {counter} of {cnt} ...')
-
-            stats_cursor_fields = cursor.fields
-            search_val = row[stats_cursor_fields.index(in_pxw_join_field)]
-
-            if in_should_transform_fields and in_transform_fields.rowCount > 0:
-                for i in range(0, in_transform_fields.rowCount):
-                    find_val = in_transform_fields.getValue(i, 0)
-                    rep_val = in_transform_fields.getValue(i, 1)
-
-                    if find_val and rep_val == 'None':
-                        search_val = search_val.replace(find_val, '')
-                    elif find_val and rep_val == '':
-                        search_val = f'{find_val}{search_val}'
-                    elif find_val == '' and rep_val:
-                        search_val = f'{search_val}{rep_val}'
-                    elif find_val and rep_val:
-                        search_val = f'{find_val}{search_val}{rep_val}'
-
-            geom = get_geom(in_geo_join_field, search_val, join_field_type)
-
-            row_list = list(row)
-            row_list.insert(0, geom)
-            insert_row = tuple(row_list)
-            # arcpy.AddMessage(insert_row)
-
-            with arcpy.da.InsertCursor(final_output_fc_path, stats_table_fields_list) as ic:
-                try:
-                    ic.insertRow(insert_row)
-                    counter = counter + 1
-                except:
-                    arcpy.AddMessage(ic.fields)
-                    arcpy.AddError('Error inserting rows')
-                    raise arcpy.ExecuteError
-
-    arcpy.ResetProgressor()
-
-    arcpy.SetProgressor('default', 'Cleaning up temporary files ...')
-    # finally, delete the in memory workspace
-    arcpy.Delete_management(in_mem_stats_tbl)
-    arcpy.Delete_management(tmp_stats_tbl)
-    del in_mem_stats_tbl
-    del tmp_stats_tbl
-
-# clean up geometry cache variable
-del geom_cache
+
+    set_progressor('Checking CSV files against the batch manifest ...', in_headless)
+    # only files that are new, changed, or were joined to a different geography or with different parameters get rebuilt
+    manifest = BatchManifest(in_output_workspace, 'pxweb_batch_manifest')
+    geo_version = geom_index.fingerprint()
+    params_version = params_hash({
+        'join_field': in_pxw_join_field,
+        'geo_join_field': in_geo_join_field,
+        'key_normalization': join_key_normalizer.settings() if join_key_normalizer else None,
+        'simplify_tolerance': in_simplify_tolerance,
+        'unmatched_rows_to_table': in_unmatched_rows_to_table,
+        'transform_rules': join_key_transform.rules if join_key_transform else [],
+        'units_metadata_file': file_hash(in_units_metadata_file) if in_units_metadata_file else None,
+        'units_metric_field': in_units_metric_field,
+        'shape_type': process_options['shape_type'],
+        'spatial_reference': process_options['spatial_reference']
+    })
+    if geo_version is None:
+        arcpy.AddWarning('Unable to fingerprint the Geography layer, all CSV files will be rebuilt')
+
+    csv_hashes = {}
+    previous_entries = {}
+    changed_csv_files = []
+    for fname in csv_files:
+        csv_hashes[fname] = file_hash(fname)
+        entry = manifest.get(fname)
+        if not in_rebuild_all and manifest.is_current(entry, csv_hashes[fname], geo_version, params_version):
+            write_log(f'\'{fname}\' unchanged since the last run, keeping {entry["OUTPUT"]}')
+            continue
+
+        # the rebuilt output replaces the one from the last run once it is built, instead of staying a timestamped copy
+        previous_entries[fname] = entry
+        changed_csv_files.append(fname)
+
+    arcpy.AddMessage(f'{len(csv_files) - len(changed_csv_files)} of {len(csv_files)} CSV files unchanged since the last run')
+    csv_files = changed_csv_files
+
+    worker_count = min(in_worker_count, len(csv_files))
+    if worker_count > 1:
+        set_progressor('Sharing geometry index with worker processes ...', in_headless)
+        # workers rebuild the index from WKB instead of each scanning the geography layer
+        geom_index_path = str(full_job_path.joinpath('geometry_index.gidx'))
+        geom_index.save(geom_index_path)
+
+        # each worker writes its feature classes to its own scratch geodatabase
+        csv_results = imap_in_pool(process_csv_file_in_worker, csv_files, worker_count, init_worker, (geom_index_path, str(full_job_path), process_options))
+    else:
+        csv_results = (process_csv_file(fname, in_output_workspace, geom_index, process_options, write_log) for fname in csv_files)
+
+    progress = ProgressReporter(f'Joining {len(csv_files)} CSV files to Geography with {max(worker_count, 1)} worker(s)', len(csv_files), 'CSV file', headless=in_headless or worker_count <= 1)
+    normalized_keys = set()
+    missing_keys = set()
+    # one table for the job, one row per csv file and join key without geometry
+    missing_keys_table_path = os.path.join(in_output_workspace, 'pxweb_batch_missing_keys')
+    for csv_result in csv_results:
+        normalized_keys.update(csv_result['normalized_keys'])
+
+        csv_basename = os.path.basename(csv_result['fname'])
+        missing_keys.update(csv_result['miss_counts'].keys())
+        for msg in missing_keys_summary(csv_result['miss_counts']):
+            write_log(f'{csv_basename} :: {msg}')
+        write_missing_keys_table(missing_keys_table_path, csv_result['miss_counts'], csv_basename)
+        if csv_result['unmatched_rows'] > 0:
+            write_log(f'{csv_basename} :: {csv_result["unmatched_rows"]} rows without geometry written to a separate table')
+
+        if worker_count > 1:
+            for msg in csv_result['log']:
+                write_log(msg)
+
+            # copy into the output workspace in file order, same naming as a single process run
+            in_output_filename = csv_result['basename']
+            final_output_fc_path = os.path.join(in_output_workspace, in_output_filename)
+            if arcpy.Exists(final_output_fc_path):
+                in_output_filename = f'{in_output_filename}_{now_ts}'
+                final_output_fc_path = os.path.join(in_output_workspace, in_output_filename)
+            arcpy.Copy_management(csv_result['path'], final_output_fc_path)
+
+            if csv_result['unmatched_path']:
+                unmatched_table_path = f'{final_output_fc_path}_unmatched'
+                if arcpy.Exists(unmatched_table_path):
+                    arcpy.Delete_management(unmatched_table_path)
+                arcpy.Copy_management(csv_result['unmatched_path'], unmatched_table_path)
+        else:
+            final_output_fc_path = csv_result['path']
+
+        if csv_result['error_count'] > 0:
+            arcpy.AddWarning(f'{csv_result["error_count"]} of {csv_result["rows"]} rows from \'{csv_result["fname"]}\' could not be inserted into the output feature class')
+            if csv_result['rows_written'] == 0:
+                arcpy.AddError('Error inserting rows')
+                raise arcpy.ExecuteError
+
+        final_output_fc_path = manifest.replace_output(previous_entries[csv_result['fname']], final_output_fc_path)
+        manifest.record(csv_result['fname'], csv_hashes[csv_result['fname']], geo_version, params_version, os.path.basename(final_output_fc_path), csv_result['rows_written'])
+
+        progress.update()
+
+    progress.finish()
+finally:
+    geom_index.close()
+
+if normalized_keys:
+    arcpy.AddMessage(f'{len(normalized_keys)} join keys only matched the Geography layer after normalization')
+
+if missing_keys:
+    arcpy.AddWarning(f'{len(missing_keys)} join keys have no geometry in the Geography layer, see {missing_keys_table_path}')
+reset_progressor(in_headless)
+
+if worker_count > 1:
+    set_progressor('Cleaning up worker scratch geodatabases ...', in_headless)
+    for scratch_gdb in full_job_path.glob('worker_*.gdb'):
+        arcpy.Delete_management(str(scratch_gdb))
 
 # delete tmp directory
 if not in_save_temp_files:
@@ -2,6 +2,22 @@ import arcpy
 import requests
 import json
 import jsonstat
+import sys
+from pathlib import Path
+
+# helpers shared by the SDMX and PxWeb tools live in the top-level common folder. validator code
+# embedded in the toolbox has no __file__ to find it from, it then runs the full query with requests
+try:
+    sys.path.append(str(Path(__file__).resolve().parents[2].joinpath('common')))
+except NameError:
+    pass
+try:
+    from http_client import get_client
+    from field_discovery import get_pxweb_query_dimensions, DISCOVERY_TIMEOUT
+except ImportError:
+    get_client = None
+    get_pxweb_query_dimensions = None
+    DISCOVERY_TIMEOUT = (10, 60)
 
 def load_pxweb_post_params(in_path):
     json_params = None
@@ -11,10 +27,25 @@ def load_pxweb_post_params(in_path):
 
 def get_pxweb_field_list(in_url, post_body_params):
     return_values = {'success': False, 'fields': []}
-    
+
+    # the table metadata is enough to list the fields, and is kept for the rest of the session
+    dimensions = []
+    if get_pxweb_query_dimensions is not None:
+        try:
+            dimensions = get_pxweb_query_dimensions(in_url, post_body_params)
+        except (requests.exceptions.RequestException, ValueError, KeyError):
+            dimensions = []
+
+    if dimensions:
+        return_values['fields'] = [f'{code} - {text}' for code, text in dimensions]
+        return_values['success'] = True
+        return return_values
+
+    # fall back to running the query
     response = None
     try:
-        response = requests.post(in_url, json=post_body_params)
+        client = get_client() if get_client is not None else requests
+        response = client.post(in_url, json=post_body_params, timeout=DISCOVERY_TIMEOUT)
     except requests.exceptions.RequestException as e:
         return_values['message'] = e
         return return_values
@@ -0,0 +1,139 @@
+import os
+
+import arcpy
+
+from geometry_index import GeometryIndex
+from feature_writer import FeatureWriter
+from unmatched_rows import create_unmatched_rows_table
+from progress_reporter import ProgressReporter
+from schema_inference import TableSchema
+
+from pxweb_units import add_unit_fields
+
+# state of a pool worker, set up once by init_worker
+_worker = {}
+
+def get_spatial_reference(sr_string):
+    spatial_reference = arcpy.SpatialReference()
+    spatial_reference.loadFromString(sr_string)
+    return spatial_reference
+
+def process_csv_file(fname, out_workspace, geom_index, options, log):
+    # join one pxweb csv file to the geography and write it to a new feature class in out_workspace
+    headless = options['headless']
+
+    # use the incoming filename to as the default for the output
+    in_output_filename = arcpy.ValidateTableName(os.path.splitext(os.path.basename(fname))[0])
+    output_basename = in_output_filename
+
+    progress = ProgressReporter(f'Converting CSV file \'{fname}\' to Table in memory', headless=headless)
+    # write csv to temp table in output workspace - will be deleted later
+    tmp_stats_tbl = 'tbl_tmp'
+    arcpy.TableToTable_conversion(fname, 'memory', tmp_stats_tbl)
+    in_mem_stats_tbl = f'memory\\{tmp_stats_tbl}'
+    progress.finish()
+
+    if options['unit_cube']:
+        if not headless:
+            arcpy.SetProgressor('default', 'Adding UNITS and DECIMALS from JSON-stat metadata file ...')
+        add_unit_fields(in_mem_stats_tbl, options['unit_cube'], options['units_metric_field'], log)
+
+    # build path to newly created output feature class
+    final_output_fc_path = os.path.join(out_workspace, in_output_filename)
+
+    # check if the filename for the output fc already exists, if so, add the now_ts (timestamp) to the end
+    if arcpy.Exists(final_output_fc_path):
+        in_output_filename = f'{in_output_filename}_{options["now_ts"]}'
+        final_output_fc_path = os.path.join(out_workspace, in_output_filename)
+
+    if not headless:
+        arcpy.SetProgressor('default', f'Creating output Feature Class :: {in_output_filename} ...')
+    # create output feature class
+    arcpy.CreateFeatureclass_management(out_workspace, in_output_filename, options['shape_type'], '#', '#', '#', get_spatial_reference(options['spatial_reference']))
+
+    if not headless:
+        arcpy.SetProgressor('default', 'Building fields to add to output feature class ...')
+    # build list of fields to add, typed from the values rather than what the csv conversion guessed
+    schema = TableSchema.from_table(in_mem_stats_tbl, text_fields=[options['join_field']])
+    stats_tbl_fields = schema.field_definitions()
+
+    if not headless:
+        arcpy.SetProgressor('default', 'Adding fields to output feature class ...')
+    # add the fields
+    arcpy.AddFields_management(final_output_fc_path, stats_tbl_fields)
+
+    stats_table_fields_list = list(schema.names)
+    stats_table_fields_list.insert(0, 'SHAPE@')
+
+    def report_insert_error(row_number, row, e):
+        log(f'Unable to insert row {row_number} into output feature class :: {e}')
+
+    unmatched_writer = None
+    unmatched_table_path = None
+    if options['unmatched_rows_to_table']:
+        # rows without geometry go to a non-spatial table instead of the output feature class
+        unmatched_table_path = create_unmatched_rows_table(out_workspace, in_output_filename, stats_tbl_fields)
+        unmatched_writer = FeatureWriter(unmatched_table_path, stats_table_fields_list[1:], on_error=report_insert_error)
+
+    # misses are counted per file, the index is shared by all files of the job
+    geom_index.clear_miss_counts()
+
+    cnt = int(arcpy.GetCount_management(in_mem_stats_tbl)[0])
+    progress = ProgressReporter(f'Inserting {cnt} rows into output feature class', cnt, f'Feature Class \'{in_output_filename}\' -- Inserting row', headless=headless)
+    # add features with geometry to the output feature class
+    with arcpy.da.SearchCursor(in_mem_stats_tbl, '*') as cursor, \
+            FeatureWriter(final_output_fc_path, stats_table_fields_list, on_error=report_insert_error) as writer:
+        # look up the position of the join field once, not on every row
+        join_field_idx = cursor.fields.index(options['join_field'])
+        for row in schema.convert_rows(cursor):
+            search_val = row[join_field_idx]
+
+            # any join key transform is already part of the index
+            geom = geom_index.get(search_val)
+
+            if geom is None and unmatched_writer is not None:
+                unmatched_writer.write(tuple(row))
+            else:
+                writer.write((geom,) + tuple(row))
+            progress.update()
+
+    progress.finish()
+
+    if unmatched_writer is not None:
+        unmatched_writer.close()
+
+    if schema.conversion_errors > 0:
+        log(f'{schema.conversion_errors} values did not fit the field types inferred from a sample of the rows and were written as null')
+
+    # finally, delete the in memory workspace
+    arcpy.Delete_management(in_mem_stats_tbl)
+
+    return {
+        'fname': fname,
+        'basename': output_basename,
+        'name': in_output_filename,
+        'path': final_output_fc_path,
+        'rows': cnt,
+        'rows_written': writer.rows_written,
+        'error_count': writer.error_count,
+        'normalized_keys': geom_index.normalized_matches,
+        'miss_counts': geom_index.miss_counts,
+        'unmatched_path': unmatched_table_path,
+        'unmatched_rows': unmatched_writer.rows_written if unmatched_writer is not None else 0
+    }
+
+def init_worker(geom_index_path, scratch_folder, options):
+    # each worker loads the shared geometry index and writes to its own scratch geodatabase
+    _worker['log'] = []
+    _worker['geom_index'] = GeometryIndex.load(geom_index_path, on_miss=lambda geo_value, wc: _worker['log'].append(f'Unable to find or get geometry when where clause is :: {wc}'))
+    _worker['options'] = dict(options, headless=True)
+
+    gdb_name = f'worker_{os.getpid()}.gdb'
+    arcpy.CreateFileGDB_management(scratch_folder, gdb_name)
+    _worker['scratch_gdb'] = os.path.join(scratch_folder, gdb_name)
+
+def process_csv_file_in_worker(fname):
+    _worker['log'] = []
+    result = process_csv_file(fname, _worker['scratch_gdb'], _worker['geom_index'], _worker['options'], _worker['log'].append)
+    result['log'] = _worker['log']
+    return result
@@ -0,0 +1,241 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+UNKNOWN_UNIT = ('UNKNOWN', None)
+
+def get_dataset_json(res_json):
+    # json-stat 2.0 is a dataset at the top level, json-stat 1.0 (pxweb 'json-stat') is a bundle of datasets
+    if res_json.get('class') == 'dataset':
+        return res_json
+    return next(iter(res_json.values()))
+
+def get_dimension_ids(ds_json):
+    if 'id' in ds_json:
+        return ds_json['id'], ds_json['size']
+    return ds_json['dimension']['id'], ds_json['dimension']['size']
+
+def get_roles(ds_json):
+    if 'role' in ds_json:
+        return ds_json['role']
+    return ds_json['dimension'].get('role', {})
+
+def get_categories(dim_json):
+    # codes in cube order, and their labels
+    category = dim_json.get('category', {})
+    index = category.get('index')
+    labels = category.get('label', {})
+
+    if index is None:
+        codes = list(labels.keys())
+    elif isinstance(index, dict):
+        codes = [None] * len(index)
+        for code, pos in index.items():
+            codes[pos] = code
+    else:
+        codes = list(index)
+
+    return codes, [labels.get(code, code) for code in codes]
+
+def get_value_list(ds_json, cell_cnt):
+    value = ds_json.get('value', [])
+    if isinstance(value, dict):
+        # sparse cubes list only the cells that have a value
+        values = [None] * cell_cnt
+        for pos, v in value.items():
+            values[int(pos)] = v
+        value = values
+
+    return value
+
+def get_values(ds_json, cell_cnt):
+    value = get_value_list(ds_json, cell_cnt)
+    return pd.to_numeric(pd.Series(value, dtype=object), errors='coerce').to_numpy()
+
+def encode(idx, values):
+    # dictionary-encode a column, falling back to plain values when labels repeat
+    if len(set(values)) == len(values):
+        return pd.Categorical.from_codes(idx, categories=values)
+    return np.array(values, dtype=object)[idx]
+
+def set_sizes(ds_json, sizes):
+    if 'id' in ds_json:
+        ds_json['size'] = sizes
+    else:
+        ds_json['dimension']['size'] = sizes
+
+def merge_datasets(res_jsons, category_order=None):
+    # merge the responses of a split query back into one response. the chunks share
+    # dimensions but hold different categories of the split dimension(s). categories
+    # keep the order they were first seen in, or the position given in category_order
+    # (dimension id -> {code: position})
+    category_order = category_order or {}
+    cubes = [JsonStatCube(r) for r in res_jsons]
+    first = cubes[0]
+
+    merged_codes = []
+    merged_dims = {}
+    for k, dim in enumerate(first.dimensions):
+        codes = []
+        labels = {}
+        units = {}
+        for cube in cubes:
+            chunk_dim = cube.dimensions[k]
+            for code, label in zip(chunk_dim['codes'], chunk_dim['labels']):
+                if code not in labels:
+                    codes.append(code)
+                    labels[code] = label
+            units.update(chunk_dim['json'].get('category', {}).get('unit', {}))
+
+        order = category_order.get(dim['id'])
+        if order:
+            codes.sort(key=lambda c: order.get(c, len(order)))
+
+        category = {
+            'index': {code: pos for pos, code in enumerate(codes)},
+            'label': {code: labels[code] for code in codes}
+        }
+        if units:
+            category['unit'] = {code: units[code] for code in codes if code in units}
+
+        merged_dim = dict(dim['json'])
+        merged_dim['category'] = category
+        merged_dims[dim['id']] = merged_dim
+        merged_codes.append(codes)
+
+    # place each chunk's block of cells into the merged cube
+    sizes = [len(codes) for codes in merged_codes]
+    values = np.full(sizes, None, dtype=object)
+    for cube in cubes:
+        idx = []
+        for k, chunk_dim in enumerate(cube.dimensions):
+            positions = {code: pos for pos, code in enumerate(merged_codes[k])}
+            idx.append(np.array([positions[code] for code in chunk_dim['codes']], dtype=np.intp))
+
+        chunk_values = np.empty(cube.cell_cnt, dtype=object)
+        chunk_values[:] = get_value_list(cube.ds_json, cube.cell_cnt)
+        values[np.ix_(*idx)] = chunk_values.reshape(cube.sizes)
+
+    ds_json = dict(first.ds_json)
+    ds_json['dimension'] = dict(first.ds_json['dimension'])
+    ds_json['dimension'].update(merged_dims)
+    set_sizes(ds_json, sizes)
+    ds_json['value'] = values.ravel().tolist()
+    # status positions refer to the chunk cubes
+    ds_json.pop('status', None)
+
+    # same envelope as the chunks, a json-stat 2.0 dataset or a 1.0 bundle
+    if first.ds_json is res_jsons[0]:
+        return ds_json
+    return {next(iter(res_jsons[0].keys())): ds_json}
+
+def get_unit_lookup(res_json):
+    # metric category label (and code) -> (base, decimals), resolved once per dataset
+    return JsonStatCube(res_json).unit_lookup()
+
+def load_jsonstat_file(file_path):
+    # a JSON-stat response saved to disk, e.g. the cube a CSV export was made from
+    with open(file_path, encoding='utf-8') as json_file:
+        return JsonStatCube(json.load(json_file))
+
+class JsonStatCube(object):
+
+    """Flat (one row per cell) view of a JSON-stat dataset. The category
+    position of every dimension for every cell is built with repeat/tile over
+    the dimension sizes, so each column is a single gather."""
+
+    def __init__(self, res_json):
+        self.ds_json = get_dataset_json(res_json)
+        self.label = self.ds_json.get('label')
+        self.dimension_ids, self.sizes = get_dimension_ids(self.ds_json)
+        self.roles = get_roles(self.ds_json)
+        self.cell_cnt = int(np.prod(self.sizes)) if self.sizes else 0
+
+        self.dimensions = []
+        for did in self.dimension_ids:
+            dim_json = self.ds_json['dimension'][did]
+            codes, labels = get_categories(dim_json)
+            self.dimensions.append({
+                'id': did,
+                'label': dim_json.get('label', did),
+                'codes': codes,
+                'labels': labels,
+                'json': dim_json
+            })
+
+    def find_dimension(self, label):
+        for dim in self.dimensions:
+            if dim['label'].strip() == label.strip():
+                return dim
+        return None
+
+    def metric_dimension(self):
+        metric_ids = self.roles.get('metric', [])
+        for dim in self.dimensions:
+            if dim['id'] in metric_ids and dim['json'].get('category', {}).get('unit'):
+                return dim
+        return None
+
+    def category_positions(self, dim):
+        # last dimension varies fastest, same order as the value array
+        k = self.dimensions.index(dim)
+        repeats = int(np.prod(self.sizes[k + 1:]))
+        tiles = int(np.prod(self.sizes[:k]))
+        return np.tile(np.repeat(np.arange(self.sizes[k], dtype=np.intp), repeats), tiles)
+
+    def category_units(self, dim):
+        # (base, decimals) for each category of the metric dimension, in cube order
+        unit_info = dim['json']['category']['unit']
+        units = []
+        for code in dim['codes']:
+            unit = unit_info.get(code)
+            if unit:
+                units.append((str(unit.get('base', UNKNOWN_UNIT[0])).upper(), unit.get('decimals')))
+            else:
+                units.append(UNKNOWN_UNIT)
+        return units
+
+    def unit_lookup(self):
+        dim = self.metric_dimension()
+        if dim is None:
+            return {}
+
+        lookup = {}
+        for code, label, unit in zip(dim['codes'], dim['labels'], self.category_units(dim)):
+            lookup[code] = unit
+            lookup[label] = unit
+        return lookup
+
+    def unit_columns(self):
+        dim = self.metric_dimension()
+        if dim is None:
+            return (np.full(self.cell_cnt, UNKNOWN_UNIT[0], dtype=object), pd.array([None] * self.cell_cnt, dtype='Int64'))
+
+        # resolve the unit of each metric category once, then gather per cell
+        units = self.category_units(dim)
+        bases = [u[0] for u in units]
+        decimals = [u[1] for u in units]
+
+        idx = self.category_positions(dim)
+        base_values = sorted(set(bases))
+        base_codes = np.array([base_values.index(b) for b in bases], dtype=np.intp)
+
+        return (pd.Categorical.from_codes(base_codes[idx], categories=base_values), pd.array(decimals, dtype='Int64')[idx])
+
+    def to_data_frame(self, code_dimension_label=None):
+        columns = {}
+        for dim in self.dimensions:
+            columns[dim['label']] = encode(self.category_positions(dim), dim['labels'])
+
+        columns['Value'] = get_values(self.ds_json, self.cell_cnt)
+
+        if code_dimension_label:
+            dim = self.find_dimension(code_dimension_label)
+            columns[f'{code_dimension_label}_Code'] = encode(self.category_positions(dim), dim['codes'])
+
+        units, decimals = self.unit_columns()
+        columns['UNITS'] = units
+        columns['DECIMALS'] = decimals
+
+        return pd.DataFrame(columns)
@@ -0,0 +1,131 @@
+import copy
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+from http_client import get_client
+
+# most PxWeb servers cap a query at 100,000 cells (see the api config maxValues)
+DEFAULT_MAX_CELLS = 100000
+DEFAULT_MAX_WORKERS = 4
+
+def get_table_metadata(in_url):
+    # a GET on the table url returns its variables and their values, no data
+    try:
+        response = get_client().get(in_url)
+    except requests.exceptions.RequestException:
+        return None
+
+    if not response:
+        return None
+    return response.json()
+
+def post_query(in_url, post_body):
+    response = get_client().post(in_url, json=post_body)
+    response.raise_for_status()
+    return response.json()
+
+def fetch_queries(in_url, queries, max_workers=DEFAULT_MAX_WORKERS, on_result=None):
+    # run the queries on a bounded pool, responses are returned in the order of queries
+    results = [None] * len(queries)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(post_query, in_url, q): i for i, q in enumerate(queries)}
+        for future in as_completed(futures):
+            i = futures[future]
+            results[i] = future.result()
+            if on_result:
+                on_result(i, results[i])
+
+    return results
+
+class PxWebQueryPlanner(object):
+
+    """Splits a PxWeb POST body into queries that stay under the server's cell
+    limit. The cell count is estimated from the table metadata and the
+    selection of each variable, and queries are split along their largest
+    selection until every chunk fits."""
+
+    def __init__(self, post_body, table_metadata=None, max_cells=DEFAULT_MAX_CELLS):
+        self.post_body = post_body
+        self.max_cells = max_cells
+        self.variables = {}
+        if table_metadata:
+            for v in table_metadata.get('variables', []):
+                self.variables[v['code']] = v
+
+    def category_order(self):
+        # variable code -> {value code: position in the table}
+        order = {}
+        for code, v in self.variables.items():
+            order[code] = {value: pos for pos, value in enumerate(v.get('values', []))}
+        return order
+
+    def selection_values(self, query_item):
+        # the value codes a selection resolves to, None when only the server can tell
+        selection = query_item['selection']
+        values = selection.get('values', [])
+        if selection['filter'] == 'item':
+            return list(values)
+
+        variable = self.variables.get(query_item['code'])
+        if selection['filter'] == 'all' and variable:
+            return [v for v in variable['values'] if any(fnmatch.fnmatchcase(v, pattern) for pattern in values)]
+
+        return None
+
+    def selection_size(self, query_item):
+        values = self.selection_values(query_item)
+        if values is not None:
+            return len(values)
+
+        selection = query_item['selection']
+        if selection['filter'] == 'top':
+            return int(selection['values'][0])
+        # agg: and vs: selections return one value per listed value
+        return max(len(selection.get('values', [])), 1)
+
+    def estimate_cells(self, post_body):
+        cells = 1
+        selected = set()
+        for query_item in post_body['query']:
+            selected.add(query_item['code'])
+            cells = cells * self.selection_size(query_item)
+
+        # variables left out of the query are eliminated when the table allows it, otherwise every value comes back
+        for code, v in self.variables.items():
+            if code not in selected and not v.get('elimination', False):
+                cells = cells * len(v.get('values', []))
+
+        return cells
+
+    def plan(self):
+        return self._split(self.post_body)
+
+    def _split(self, post_body):
+        cells = self.estimate_cells(post_body)
+        if cells <= self.max_cells:
+            return [post_body]
+
+        # split along the largest selection that can be listed value by value
+        split_idx = None
+        split_values = []
+        for i, query_item in enumerate(post_body['query']):
+            values = self.selection_values(query_item)
+            if values and len(values) > len(split_values):
+                split_idx = i
+                split_values = values
+
+        if split_idx is None or len(split_values) < 2:
+            # nothing left to split on, let the server decide
+            return [post_body]
+
+        chunk_size = max(1, int(self.max_cells // (cells / len(split_values))))
+
+        queries = []
+        for start in range(0, len(split_values), chunk_size):
+            chunk = copy.deepcopy(post_body)
+            chunk['query'][split_idx]['selection'] = {'filter': 'item', 'values': split_values[start:start + chunk_size]}
+            queries.extend(self._split(chunk))
+
+        return queries
@@ -0,0 +1,37 @@
+import arcpy
+
+from pxweb_jsonstat import UNKNOWN_UNIT
+
+def add_unit_fields(in_table, unit_cube, in_metric_field, log):
+    # attach UNITS and DECIMALS from a cached JSON-stat cube, resolved once per dataset and looked up per row
+    table_field_names = [f.name for f in arcpy.ListFields(in_table)]
+    if 'UNITS' in table_field_names or 'DECIMALS' in table_field_names:
+        log('CSV already has UNITS / DECIMALS fields, unit metadata file not used')
+        return
+
+    metric_dim = unit_cube.metric_dimension()
+    if metric_dim is None:
+        arcpy.AddWarning('JSON-stat metadata file has no metric dimension with unit information, UNITS and DECIMALS not added')
+        return
+
+    metric_field = in_metric_field if in_metric_field else arcpy.ValidateFieldName(metric_dim['label'], 'memory')
+    if metric_field not in table_field_names:
+        arcpy.AddWarning(f'Field \'{metric_field}\' not found in CSV, UNITS and DECIMALS not added')
+        return
+
+    unit_lookup = unit_cube.unit_lookup()
+    units_length = max([len(u[0]) for u in unit_lookup.values()] + [len(UNKNOWN_UNIT[0])])
+    arcpy.AddFields_management(in_table, [['UNITS', 'TEXT', 'UNITS', units_length], ['DECIMALS', 'SHORT', 'DECIMALS']])
+
+    unknown_values = set()
+    with arcpy.da.UpdateCursor(in_table, [metric_field, 'UNITS', 'DECIMALS']) as cursor:
+        for row in cursor:
+            unit = unit_lookup.get(row[0])
+            if unit is None:
+                unknown_values.add(row[0])
+                unit = UNKNOWN_UNIT
+            cursor.updateRow([row[0], unit[0], unit[1]])
+
+    # one log line per unknown value, not per row
+    for v in sorted(unknown_values, key=str):
+        log(f'No unit information found for \'{v}\' in JSON-stat metadata file')
@@ -1,13 +1,41 @@
 import arcpy
 import os
+import sys
 import shutil
 import json
 import csv
+import itertools
 import requests
+import pandas as pd
 from datetime import datetime
 from dateutil import parser
 from pathlib import Path
 
+# helpers shared by the SDMX and PxWeb tools live in the top-level common folder
+sys.path.append(str(Path(__file__).resolve().parents[2].joinpath('common')))
+from geometry_setup import parse_geometry_options, build_geometry_index
+from feature_writer import FeatureWriter
+from normalized_output import NormalizedOutputWriter, get_output_layout, create_stats_table, create_relationship_class
+from pivot_output import pivot_wide, iter_wide_rows
+from unmatched_rows import create_unmatched_rows_table, get_missing_keys_table_path, write_missing_keys_table, missing_keys_summary
+from feature_upserter import FeatureUpserter
+from tool_parameters import get_optional_parameter, get_optional_parameter_as_text
+from progress_reporter import ProgressReporter, set_progressor, reset_progressor
+from schema_inference import TableSchema
+from http_client import get_client
+
+from sdmx_decoder import SDMXObservationDecoder
+from sdmx_codelists import SDMXCodelists
+from sdmx_chunks import SDMXQueryPlanner, fetch_chunks, merge_data_messages, DEFAULT_MAX_WORKERS
+
+# streaming needs the optional ijson package (pip install ijson)
+try:
+    from sdmx_stream import SDMXStreamParser
+except ImportError:
+    SDMXStreamParser = None
+
+DECODE_CHUNK_SIZE = 100000
+
 def create_working_directory():
     now_ts = datetime.now().strftime('%Y%m%d%H%M%S')
     
@@ -58,11 +86,19 @@ def parse_fields_and_lookups(dimension_props, attribute_props):
 
     return fields
 
+def get_sdmx_response(in_url, stream=False):
+    try:
+        return get_client().get(
+            in_url, 
+            headers={'accept': 'application/vnd.sdmx.data+json;version=1.0.0-wd'},
+            stream=stream
+        )
+    except requests.exceptions.RequestException as e:
+        arcpy.AddError(f'Unable to query SDMX API :: {e}')
+        raise arcpy.ExecuteError
+
 def query_and_parse_sdmx(in_url):
-    response = requests.get(
-        in_url, 
-        headers={'accept': 'application/vnd.sdmx.data+json;version=1.0.0-wd'}
-    )
+    response = get_sdmx_response(in_url)
 
     if response:
         res_json = response.json()
@@ -85,89 +121,127 @@ def query_and_parse_sdmx(in_url):
             'res_count': res_count 
         }
 
-def convert_sdmx_json_to_csv(sdmx_response):
-    observations = sdmx_response['obs']
-    dimension_props = sdmx_response['dimension_props']
-    attribute_props = sdmx_response['attribute_props']
+def query_and_stream_sdmx(in_url):
+    response = get_sdmx_response(in_url, stream=True)
 
-    features = []
+    if response:
+        # let urllib3 undo any gzip/deflate encoding while the body is being read
+        response.raw.decode_content = True
+        stream_parser = SDMXStreamParser(response.raw)
 
-    for obs in observations:
-        feature = {}
-
-        dim_splits = obs.split(':')
-        attributes = observations[obs]
-
-        for i, current_key_str in enumerate(dim_splits):
-            current_key_int = int(current_key_str)
-            found_dim = [dim for dim in dimension_props if dim['keyPosition'] == i][0]
-            
-            if found_dim is not None:
-                if found_dim['id'] == 'TIME_PERIOD':
-                    tv = parser.parse(found_dim['values'][current_key_int]['name']['en'])
-                    feature['{}_CODE'.format(found_dim['id'])] = datetime.strftime(tv, '%Y-%m')
-                    feature['{}'.format(found_dim['name']['en'].upper().replace(' ', '_'))] = datetime.strftime(tv, '%Y-%m')
-                else:
-                    feature['{}_CODE'.format(found_dim['id'])] = found_dim['values'][current_key_int]['id']
-                    feature['{}'.format(found_dim['name']['en'].upper().replace(' ', '_'))] = found_dim['values'][current_key_int]['name']['en']
-
-        obs_value = attributes[0]
-        feature['OBS_VALUE'] = obs_value
-    
-        attributes.pop(0)
+        try:
+            structure = stream_parser.read_structure()
+            dimension_props = structure['dimensions']['observation']
+            attribute_props = structure['attributes']['observation']
+            fields = parse_fields_and_lookups(dimension_props, attribute_props)
+        except:
+            response.close()
+            arcpy.AddError('unable to parse SDMX response from \'{}\''.format(in_url))
+            raise arcpy.ExecuteError
+
+        return { 
+            'dimension_props': dimension_props,
+            'attribute_props': attribute_props, 
+            'obs_batches': stream_parser.observation_batches(), 
+            'fields': fields,
+            'res_count': None,
+            'response': response
+        }
 
-        for j, attValue in enumerate(attributes):
-            att_value = attributes[j]
-            found_att = attribute_props[j]
+def query_and_parse_sdmx_chunks(chunk_urls, max_workers=DEFAULT_MAX_WORKERS, headless=False):
+    progress = ProgressReporter(f'Querying SDMX API in {len(chunk_urls)} requests', len(chunk_urls), 'Request', headless=headless)
+    try:
+        res_jsons = fetch_chunks(chunk_urls, max_workers, on_result=lambda i, res_json: progress.update())
+    except requests.exceptions.RequestException as e:
+        arcpy.AddError(f'Unable to query SDMX API :: {e}')
+        raise arcpy.ExecuteError
+    progress.finish()
 
-            if att_value is None:
-                feature['{}_CODE'.format(found_att['id'])] = None
-                feature[found_att['id'].upper().replace(' ', '_')] = None
-            else:
-                feature['{}_CODE'.format(found_att['id'])] = found_att['values'][att_value]['id']
-                feature[found_att['id'].upper().replace(' ', '_')] = found_att['values'][att_value]['name']['en']
+    try:
+        sdmx_response = merge_data_messages(res_jsons)
+    except:
+        arcpy.AddError('unable to parse SDMX response from \'{}\''.format(chunk_urls[0]))
+        raise arcpy.ExecuteError
+
+    if sdmx_response is None:
+        arcpy.AddError('SDMX query did not return any observations')
+        raise arcpy.ExecuteError
+
+    # the structure is parsed once, from the merged value lists
+    sdmx_response['fields'] = parse_fields_and_lookups(sdmx_response['dimension_props'], sdmx_response['attribute_props'])
+    sdmx_response['res_count'] = len(sdmx_response['obs'])
+
+    return sdmx_response
 
-        features.append(feature)
+def convert_sdmx_json_to_csv(sdmx_response, decoder, progress=None):
+    observations = sdmx_response['obs']
+    obs_keys = list(observations.keys())
+    obs_values = list(observations.values())
+
+    features = []
+
+    # decode in chunks so progress can be reported while the index matrices stay small
+    for start in range(0, len(obs_keys), DECODE_CHUNK_SIZE):
+        chunk_keys = obs_keys[start:start + DECODE_CHUNK_SIZE]
+        features.extend(decoder.decode_rows(chunk_keys, obs_values[start:start + DECODE_CHUNK_SIZE]))
+
+        if progress:
+            progress.update(len(chunk_keys))
     
     return features
 
-def create_csv_file(sdmx_csv_rows, sdmx_field_names, full_job_path):
+def stream_sdmx_json_to_csv_rows(sdmx_response, decoder, progress=None):
+    try:
+        for batch in sdmx_response['obs_batches']:
+            obs_keys = [obs[0] for obs in batch]
+            obs_values = [obs[1] for obs in batch]
+            for row in decoder.decode_rows(obs_keys, obs_values):
+                yield row
+
+            if progress:
+                progress.update(len(batch))
+    finally:
+        sdmx_response['response'].close()
+
+def create_csv_file(sdmx_csv_rows, sdmx_field_names, full_job_path, progress=None):
     file_name = 'fromSDMXapi.csv'
     full_path_to_file = full_job_path.joinpath(file_name)
 
     with open(full_path_to_file, 'w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=sdmx_field_names)
-        writer.writeheader()
+        writer = csv.writer(f)
+        writer.writerow(sdmx_field_names)
 
         for row in sdmx_csv_rows:
             writer.writerow(row)
+
+            if progress:
+                progress.update()
     
     return full_path_to_file.resolve()
 
-def get_geom(geo_field, geo_value, join_field_type):
-    global geom_cache
-    global geo_fl
+def tee_csv_file(sdmx_rows, sdmx_field_names, full_job_path):
+    # pass rows through unchanged while also writing them to the debug csv
+    file_name = 'fromSDMXapi.csv'
+    full_path_to_file = full_job_path.joinpath(file_name)
 
-    # if join_field_type == 'TEXT':
-    #     geo_value = f"'{geo_value}'"
+    with open(full_path_to_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(sdmx_field_names)
 
-    wc = """{0} = '{1}'""".format(arcpy.AddFieldDelimiters(geo_fl, geo_field), geo_value)
-    # arcpy.AddMessage(wc)
-    if geo_value in geom_cache:
-        # arcpy.AddMessage(f'got from cache for {geo_value}')
-        return geom_cache[geo_value]
-    else:
-        geom = None
-        row = next(arcpy.da.SearchCursor(geo_fl, ['SHAPE@', geo_field],where_clause=wc))
-        if row and len(row) > 0:
-            # arcpy.AddMessage(row)
-            geom = row[0]
-            geo_val_to_add = row[1]
-            geom_cache[geo_val_to_add] = geom
-        else:
-            arcpy.AddMessage(f'Unable to get geometry from Geography layer. The where_clause, {wc} did not return results.')
-
-        return geom
+        for row in sdmx_rows:
+            writer.writerow(row)
+            yield row
+
+def read_table_rows(in_table):
+    with arcpy.da.SearchCursor(in_table, '*') as cursor:
+        for row in cursor:
+            yield row
+
+def report_missing_geom(geo_value, wc):
+    arcpy.AddMessage(f'Unable to get geometry from Geography layer. The where_clause, {wc} did not return results.')
+
+def report_insert_error(row_number, row, e):
+    arcpy.AddWarning(f'Unable to insert row {row_number} into output feature class :: {e}')
 
 ################
 # SCRIPT START #
@@ -180,13 +254,11 @@ in_sdmx_join_field = arcpy.GetParameterAsText(1)
 in_should_replace_codes_with_values = arcpy.GetParameter(2)
 in_should_update_field_aliases_on_output = arcpy.GetParameter(3)
 in_api_has_alias_information = arcpy.GetParameter(4)
-in_codelists_file = arcpy.GetParameter(5)
+in_codelists_file = arcpy.GetParameterAsText(5)
 
 in_geo_table = arcpy.GetParameter(6)
 in_geo_join_field = arcpy.GetParameterAsText(7)
 
-global geom_cache
-geom_cache = {}
 global geo_fl
 geo_fl = 'geo_fl'
 arcpy.MakeFeatureLayer_management(in_geo_table, geo_fl)
@@ -199,65 +271,221 @@ in_use_field_value_for_outputname = arcpy.GetParameter(9)
 in_sdmx_field_for_outputname = arcpy.GetParameterAsText(10)
 in_output_filename = arcpy.ValidateTableName(arcpy.GetParameterAsText(11))
 
-# in_save_temp_files = arcpy.GetParameter(13)
-
-arcpy.SetProgressor('default', 'Creating working directory ...')
+in_save_temp_files = get_optional_parameter(13, False)
+in_headless = get_optional_parameter(14, False)
+in_direct_load = get_optional_parameter(15, False)
+in_max_concurrent_queries = get_optional_parameter(16, DEFAULT_MAX_WORKERS)
+in_use_http_cache = get_optional_parameter(17, False)
+in_upsert = get_optional_parameter(18, False)
+in_upsert_delete_missing = get_optional_parameter(19, False)
+in_key_normalization = get_optional_parameter_as_text(20)
+in_unmatched_rows_to_table = get_optional_parameter(21, False)
+in_output_layout = get_optional_parameter_as_text(22)
+in_create_relationship_class = get_optional_parameter(23, False)
+in_simplify_tolerance = get_optional_parameter_as_text(24)
+in_use_geometry_index_cache = get_optional_parameter(25, True)
+in_stream_response = get_optional_parameter(26, False)
+in_chunk_by_key = get_optional_parameter(27, False)
+in_chunk_period_years = get_optional_parameter(28, 0)
+
+join_key_normalizer, in_simplify_tolerance = parse_geometry_options(in_key_normalization, in_simplify_tolerance)
+
+# FLAT writes every row with its geometry, NORMALIZED writes each geometry once and the rows to a related table,
+# WIDE writes one feature per area with a column per period / measure
+try:
+    in_output_layout = get_output_layout(in_output_layout)
+except ValueError as e:
+    arcpy.AddError(str(e))
+    raise arcpy.ExecuteError
+
+if in_stream_response and SDMXStreamParser is None:
+    arcpy.AddWarning('Streaming the SDMX response requires the ijson package. The full response will be parsed instead.')
+    in_stream_response = False
+
+# split the query by key values and/or period windows, if asked to
+sdmx_chunk_urls = SDMXQueryPlanner(in_sdmx_api_url, in_chunk_by_key, in_chunk_period_years).plan()
+if len(sdmx_chunk_urls) > 1:
+    arcpy.AddMessage(f'SDMX query split into {len(sdmx_chunk_urls)} requests')
+    if in_stream_response:
+        arcpy.AddWarning('Streaming is not used when the SDMX query is split into several requests.')
+        in_stream_response = False
+
+# the http client lives for the whole Pro session, only report this run's requests
+get_client().clear_timings()
+# responses are cached on disk when asked for, reruns against unchanged data only revalidate them
+get_client().cache.enabled = in_use_http_cache
+
+set_progressor('Creating working directory ...', in_headless)
 # create working directory
 wd_res = create_working_directory()
 full_job_path = wd_res[0]
 now_ts = wd_res[1]
 
-arcpy.SetProgressor('default', 'Querying SDMX API ...')
-# get sdmx api response 
-sdmx_response = query_and_parse_sdmx(in_sdmx_api_url)
-
-arcpy.SetProgressor('default', 'Converting SDMX JSON to CSV ...')
-# convert sdmx json to csv
-sdmx_csv_rows = convert_sdmx_json_to_csv(sdmx_response)
+if len(sdmx_chunk_urls) > 1:
+    # fetch the chunks concurrently and merge them into one response
+    sdmx_response = query_and_parse_sdmx_chunks(sdmx_chunk_urls, in_max_concurrent_queries, in_headless)
+else:
+    progress = ProgressReporter('Querying SDMX API', headless=in_headless)
+    # get sdmx api response 
+    if in_stream_response:
+        sdmx_response = query_and_stream_sdmx(in_sdmx_api_url)
+    else:
+        sdmx_response = query_and_parse_sdmx(in_sdmx_api_url)
+    progress.finish()
+
+# every code already comes with a label field. replacing codes with values takes those labels
+# from the codelists file when there is one, instead of the names in the response
+code_labels = None
+if in_should_replace_codes_with_values and in_codelists_file:
+    try:
+        code_labels = SDMXCodelists.from_file(in_codelists_file)
+    except ValueError as e:
+        arcpy.AddError(str(e))
+        raise arcpy.ExecuteError
 
-# write csv to temp file location
-sdmx_field_names = [f['name'] for f in sdmx_response['fields']]
-sdmx_field_names.append('OBS_VALUE')
-path_to_csv_file = create_csv_file(sdmx_csv_rows, sdmx_field_names, full_job_path)
+# code/label lookups and column names are built once for all observations
+sdmx_decoder = SDMXObservationDecoder(sdmx_response['dimension_props'], sdmx_response['attribute_props'], code_labels)
+sdmx_field_names = sdmx_decoder.field_names
+in_mem_stats_tbl = None
+schema = None
+# value of the field chosen for the output name, read from the first observation
+output_name_value = None
+
+if in_output_layout == 'WIDE':
+    # the join dimension becomes the rows, every other dimension that varies becomes columns
+    join_dims = [dim for dim in sdmx_decoder.dimension_fields if in_sdmx_join_field in dim]
+    if not join_dims:
+        arcpy.AddError(f'The WIDE output layout needs the SDMX join field to be a dimension field, {in_sdmx_join_field} is not one')
+        raise arcpy.ExecuteError
 
-arcpy.SetProgressor('default', 'Converting CSV file to Table in memory ...')
-# write csv to temp table in output workspace - will be deleted later
-tmp_stats_tbl = 'tbl_tmp'
-arcpy.TableToTable_conversion(str(path_to_csv_file), 'memory', tmp_stats_tbl)
-in_mem_stats_tbl = f'memory\\{tmp_stats_tbl}'
+    if in_stream_response:
+        sdmx_rows = stream_sdmx_json_to_csv_rows(sdmx_response, sdmx_decoder)
+    else:
+        progress = ProgressReporter('Decoding SDMX observations', sdmx_response['res_count'], 'Decoding observation', headless=in_headless)
+        sdmx_rows = convert_sdmx_json_to_csv(sdmx_response, sdmx_decoder, progress)
+        progress.finish()
+
+    if in_save_temp_files:
+        sdmx_rows = tee_csv_file(sdmx_rows, sdmx_field_names, full_job_path)
+
+    set_progressor('Pivoting SDMX observations ...', in_headless)
+    sdmx_frame = pd.DataFrame.from_records(sdmx_rows, columns=sdmx_field_names)
+    # the field chosen for the output name is usually pivoted away, take its value from the observations
+    if in_use_field_value_for_outputname and len(sdmx_frame) > 0:
+        if in_sdmx_field_for_outputname not in sdmx_frame.columns:
+            arcpy.AddError(f'{in_sdmx_field_for_outputname} is not a field of the SDMX data, it cannot be used for the output name')
+            raise arcpy.ExecuteError
+        output_name_value = sdmx_frame[in_sdmx_field_for_outputname].iloc[0]
+    wide_frame, wide_field_defs, dropped_fields = pivot_wide(
+        sdmx_frame,
+        list(join_dims[0]),
+        [dim for dim in sdmx_decoder.dimension_fields if dim != join_dims[0]],
+        'OBS_VALUE',
+        in_output_workspace,
+        [f for att in sdmx_decoder.attribute_fields for f in att]
+    )
+    if dropped_fields:
+        arcpy.AddWarning(f'Attributes that vary between observations are not part of the WIDE output :: {", ".join(dropped_fields)}')
+    arcpy.AddMessage(f'{len(sdmx_frame)} observations pivoted to {len(wide_frame)} rows of {len(wide_field_defs)} fields')
+    del sdmx_frame
+
+    stats_row_fields = [f[1] for f in wide_field_defs]
+    stats_rows = iter_wide_rows(wide_frame)
+    cnt = len(wide_frame)
+elif in_direct_load:
+    # decoded rows go straight into the output feature class, the csv is only written for debugging
+    if in_stream_response:
+        sdmx_rows = stream_sdmx_json_to_csv_rows(sdmx_response, sdmx_decoder)
+        cnt = None
+    else:
+        progress = ProgressReporter('Decoding SDMX observations', sdmx_response['res_count'], 'Decoding observation', headless=in_headless)
+        sdmx_rows = convert_sdmx_json_to_csv(sdmx_response, sdmx_decoder, progress)
+        progress.finish()
+        cnt = len(sdmx_rows)
+
+    if in_save_temp_files:
+        sdmx_rows = tee_csv_file(sdmx_rows, sdmx_field_names, full_job_path)
+
+    stats_row_fields = list(sdmx_field_names)
+    stats_rows = sdmx_rows
+else:
+    if in_stream_response:
+        progress = ProgressReporter('Streaming SDMX observations to CSV', headless=in_headless)
+        # decode observations as the response arrives and write them straight to the csv file
+        sdmx_csv_rows = stream_sdmx_json_to_csv_rows(sdmx_response, sdmx_decoder, progress)
+        path_to_csv_file = create_csv_file(sdmx_csv_rows, sdmx_field_names, full_job_path)
+        progress.finish()
+    else:
+        progress = ProgressReporter('Converting SDMX JSON to CSV', sdmx_response['res_count'], 'Converting observation', headless=in_headless)
+        # convert sdmx json to csv
+        sdmx_csv_rows = convert_sdmx_json_to_csv(sdmx_response, sdmx_decoder, progress)
+        progress.finish()
+
+        progress = ProgressReporter('Writing CSV file', len(sdmx_csv_rows), 'Writing row', headless=in_headless)
+        # write csv to temp file location
+        path_to_csv_file = create_csv_file(sdmx_csv_rows, sdmx_field_names, full_job_path, progress)
+        progress.finish()
+
+    progress = ProgressReporter('Converting CSV file to Table in memory', headless=in_headless)
+    # write csv to temp table in output workspace - will be deleted later
+    tmp_stats_tbl = 'tbl_tmp'
+    arcpy.TableToTable_conversion(str(path_to_csv_file), 'memory', tmp_stats_tbl)
+    in_mem_stats_tbl = f'memory\\{tmp_stats_tbl}'
+    progress.finish()
+
+    # typed from the values rather than what the csv conversion guessed
+    schema = TableSchema.from_table(in_mem_stats_tbl, text_fields=[in_sdmx_join_field])
+    stats_row_fields = list(schema.names)
+    stats_rows = schema.convert_rows(read_table_rows(in_mem_stats_tbl))
+    cnt = int(arcpy.GetCount_management(in_mem_stats_tbl)[0])
 
 # set the output filename to be a value from the sdmx table, if user selects
-if in_use_field_value_for_outputname:
-    row = next(arcpy.da.SearchCursor(in_mem_stats_tbl, [in_sdmx_field_for_outputname]))
-    in_output_filename = arcpy.ValidateTableName(row[0])
+if in_use_field_value_for_outputname and in_output_layout == 'WIDE':
+    if output_name_value is not None:
+        in_output_filename = arcpy.ValidateTableName(str(output_name_value))
+elif in_use_field_value_for_outputname:
+    stats_rows = iter(stats_rows)
+    row = next(stats_rows)
+    in_output_filename = arcpy.ValidateTableName(row[stats_row_fields.index(in_sdmx_field_for_outputname)])
+    # put the row back in front of the rest
+    stats_rows = itertools.chain([row], stats_rows)
 
 # build path to newly created output feature class 
 final_output_fc_path = os.path.join(in_output_workspace, in_output_filename)
 
+# in upsert mode an existing output is updated in place, keyed on the dimension codes
+upsert_existing = in_upsert and arcpy.Exists(final_output_fc_path)
+if upsert_existing and in_output_layout != 'FLAT':
+    arcpy.AddError('Upserting into an existing output only works with the FLAT output layout')
+    raise arcpy.ExecuteError
+
 # check if the filename for the output fc already exists, if so, add the now_ts (timestamp) to the end
-if arcpy.Exists(final_output_fc_path):
+if not upsert_existing and arcpy.Exists(final_output_fc_path):
     in_output_filename = f'{in_output_filename}_{now_ts}' 
     final_output_fc_path = os.path.join(in_output_workspace, in_output_filename)
 
-arcpy.SetProgressor('default', 'Creating output Feature Class ...')
-# create output feature class
-geo_layer_feature_type = in_geo_fl_desc.shapeType
-geo_layer_sr = in_geo_fl_desc.spatialReference
-arcpy.CreateFeatureclass_management(in_output_workspace, in_output_filename, geo_layer_feature_type, '#', '#', '#', geo_layer_sr)
+if not upsert_existing:
+    set_progressor('Creating output Feature Class ...', in_headless)
+    # create output feature class
+    geo_layer_feature_type = in_geo_fl_desc.shapeType
+    geo_layer_sr = in_geo_fl_desc.spatialReference
+    arcpy.CreateFeatureclass_management(in_output_workspace, in_output_filename, geo_layer_feature_type, '#', '#', '#', geo_layer_sr)
 
 # get field alias info
 if in_should_update_field_aliases_on_output:
-    arcpy.SetProgressor('default', 'Collecting field alias information ...')
+    set_progressor('Collecting field alias information ...', in_headless)
     alias_info = None
     if in_api_has_alias_information:
-        alias_info = sdmx_response['fields']
+        alias_info = {ff['name'].upper(): ff['alias'] for ff in sdmx_response['fields']}
     else:
-        arcpy.AddMessage('TODO :: IMPLEMENT Load from codelists file')
-        arcpy.AddError('load field alias info from codelist file not yet implemented')
-        raise arcpy.ExecuteError
-        # alias_info = parse_fields_from_codelists_file(in_codelists_file)
+        # field names to aliases from the codelists file, parsed once per version of the file
+        try:
+            alias_info = SDMXCodelists.from_file(in_codelists_file).aliases
+        except ValueError as e:
+            arcpy.AddError(str(e))
+            raise arcpy.ExecuteError
 
-arcpy.SetProgressor('default', 'Building fields to add to output feature class ...')
+set_progressor('Building fields to add to output feature class ...', in_headless)
 # build list of fields to add
 add_field_type_map = {
     'Integer': 'LONG',
@@ -266,81 +494,139 @@ add_field_type_map = {
 }
 stats_tbl_fields = []
 join_field_type = 'text'
-stats_table_fields = arcpy.ListFields(in_mem_stats_tbl)
-for f in stats_table_fields:
-    if not f.required:
-        alias = f.aliasName
-        if in_should_update_field_aliases_on_output:
-            found_field = [ff for ff in alias_info if ff['name'] == f.name]
-            if found_field and len(found_field) > 0:
-                found_field = found_field[0]
-                alias = found_field['alias']
-            
-        field_type = f.type
-        if f.type in add_field_type_map.keys():
-            field_type = add_field_type_map[f.type]
-
-        stats_tbl_fields.append([f.name, field_type, alias, f.length])
-
-        if f.name == in_sdmx_join_field:
-            join_field_type = field_type
-
-arcpy.SetProgressor('default', 'Adding fields to output feature class ...')
-# add the fields
-arcpy.AddFields_management(final_output_fc_path, stats_tbl_fields)
-
-stats_table_fields_list = [f.name for f in stats_table_fields]
+if in_output_layout == 'WIDE':
+    source_fields = [f[1:] for f in wide_field_defs]
+elif in_direct_load:
+    # schema comes from the sdmx structure instead of the types guessed from the csv
+    source_fields = sdmx_decoder.field_definitions()
+else:
+    source_fields = schema.field_definitions()
+
+for name, source_type, alias, length in source_fields:
+    if in_should_update_field_aliases_on_output:
+        alias = alias_info.get(name.upper(), alias)
+        
+    field_type = source_type
+    if source_type in add_field_type_map.keys():
+        field_type = add_field_type_map[source_type]
+
+    stats_tbl_fields.append([name, field_type, alias, length])
+
+    if name == in_sdmx_join_field:
+        join_field_type = field_type
+
+if not upsert_existing:
+    set_progressor('Adding fields to output feature class ...', in_headless)
+    # add the fields
+    if in_output_layout == 'NORMALIZED':
+        # the feature class only gets the join key, the rows go to a stats table
+        arcpy.AddFields_management(final_output_fc_path, [f for f in stats_tbl_fields if f[0] == in_sdmx_join_field])
+        stats_table_path = create_stats_table(in_output_workspace, in_output_filename, stats_tbl_fields)
+    else:
+        arcpy.AddFields_management(final_output_fc_path, stats_tbl_fields)
+
+stats_table_fields_list = list(stats_row_fields)
 stats_table_fields_list.insert(0, 'SHAPE@')
 # final_outfc_fields = ','.join(stats_table_fields_list)
 
-cnt = int(arcpy.GetCount_management(in_mem_stats_tbl)[0])
-arcpy.SetProgressor('step', f'Inserting {cnt} rows into output feature class ...', 0, cnt, 1)
-# add features with geometry to the output feature class
-counter = 1
-with arcpy.da.SearchCursor(in_mem_stats_tbl, '*') as cursor:
-    for row in cursor:
-        arcpy.SetProgressorPosition(counter)
-        arcpy.SetProgressorLabel(f'Inserting row {counter} of {cnt} ...')
-
-        stats_cursor_fields = cursor.fields
-        search_val = row[stats_cursor_fields.index(in_sdmx_join_field)]
-        geom = get_geom(in_geo_join_field, search_val, join_field_type)
-
-        row_list = list(row)
-        row_list.insert(0, geom)
-        insert_row = tuple(row_list)
-        # arcpy.AddMessage(insert_row)
-
-        with arcpy.da.InsertCursor(final_output_fc_path, stats_table_fields_list) as ic:
-            try:
-                ic.insertRow(insert_row)
-                counter = counter + 1
-            except:
-                arcpy.AddMessage(ic.fields)
-                arcpy.AddError('Error inserting rows')
-                raise arcpy.ExecuteError
-
-arcpy.ResetProgressor()
-
-# replace SDMX codes with values
-if in_should_replace_codes_with_values:
-    arcpy.SetProgressor('default', 'Replacing SDMX codes with values ...')
-    arcpy.AddMessage('TODO :: IMPLEMENT replace SDMX codes with values')
+# scan the geography layer once so each join value is a dictionary lookup
+global geom_index
+geom_index = build_geometry_index(geo_fl, in_geo_join_field, on_miss=report_missing_geom, key_normalizer=join_key_normalizer, use_cache=in_use_geometry_index_cache, simplify_tolerance=in_simplify_tolerance, headless=in_headless)
+# a cached index memory-maps its file, release it however the join ends
+try:
+    if upsert_existing:
+        sdmx_key_fields = ['{}_CODE'.format(dim['id']) for dim in sdmx_response['dimension_props']]
+        try:
+            writer = FeatureUpserter(final_output_fc_path, stats_table_fields_list, sdmx_key_fields, in_upsert_delete_missing, on_error=report_insert_error, field_types={f[0]: f[1] for f in stats_tbl_fields})
+        except ValueError as e:
+            arcpy.AddError(f'Unable to upsert into the existing output feature class :: {e}')
+            raise arcpy.ExecuteError
+        arcpy.AddMessage(f'Upserting into existing output feature class {final_output_fc_path}')
+    elif in_output_layout == 'NORMALIZED':
+        writer = NormalizedOutputWriter(final_output_fc_path, stats_table_path, stats_table_fields_list, in_sdmx_join_field, on_error=report_insert_error)
+    else:
+        writer = FeatureWriter(final_output_fc_path, stats_table_fields_list, on_error=report_insert_error)
+
+    unmatched_writer = None
+    if in_unmatched_rows_to_table:
+        # rows without geometry go to a non-spatial table instead of the output feature class
+        unmatched_table_path = create_unmatched_rows_table(in_output_workspace, in_output_filename, stats_tbl_fields)
+        unmatched_writer = FeatureWriter(unmatched_table_path, stats_table_fields_list[1:], on_error=report_insert_error)
+
+    progress_label = f'Inserting {cnt} rows into output feature class' if cnt is not None else 'Inserting rows into output feature class'
+    progress = ProgressReporter(progress_label, cnt, 'Inserting row', headless=in_headless)
+    # add features with geometry to the output feature class
+    with writer:
+        # look up the position of the join field once, not on every row
+        join_field_idx = stats_row_fields.index(in_sdmx_join_field)
+        for row in stats_rows:
+            search_val = row[join_field_idx]
+
+            geom = geom_index.get(search_val)
+
+            if geom is None and unmatched_writer is not None:
+                unmatched_writer.write(tuple(row))
+            else:
+                writer.write((geom,) + tuple(row))
+            progress.update()
+
+    progress.finish()
+finally:
+    geom_index.close()
+
+if geom_index.normalized_matches:
+    arcpy.AddMessage(f'{len(geom_index.normalized_matches)} join keys only matched the Geography layer after normalization')
+
+if unmatched_writer is not None:
+    unmatched_writer.close()
+    arcpy.AddMessage(f'{unmatched_writer.rows_written} rows without geometry written to {unmatched_table_path}')
+
+if schema is not None and schema.conversion_errors > 0:
+    arcpy.AddWarning(f'{schema.conversion_errors} values did not fit the field types inferred from a sample of the rows and were written as null')
+
+# one line per join key without geometry, however many rows it has
+miss_counts = geom_index.miss_counts
+for msg in missing_keys_summary(miss_counts):
+    arcpy.AddMessage(msg)
+missing_keys_table_path = write_missing_keys_table(get_missing_keys_table_path(in_output_workspace, in_output_filename), miss_counts, in_output_filename)
+if miss_counts:
+    arcpy.AddWarning(f'{len(miss_counts)} join keys have no geometry in the Geography layer, see {missing_keys_table_path}')
+
+if upsert_existing:
+    arcpy.AddMessage(writer.summary())
+
+if writer.error_count > 0:
+    arcpy.AddWarning(f'{writer.error_count} of {progress.count} rows could not be inserted into the output feature class')
+    if writer.rows_written == 0:
+        arcpy.AddError('Error inserting rows')
+        raise arcpy.ExecuteError
+
+if in_output_layout == 'NORMALIZED':
+    arcpy.AddMessage(f'{writer.features_written} features written to {final_output_fc_path}, {writer.rows_written} rows to {stats_table_path}')
+    if in_create_relationship_class:
+        set_progressor('Creating relationship class ...', in_headless)
+        rel_path = create_relationship_class(final_output_fc_path, stats_table_path, in_sdmx_join_field)
+        if rel_path is None:
+            arcpy.AddWarning('Relationship classes need a geodatabase as the output workspace, none was created')
+
+reset_progressor(in_headless)
 
 # set the output parameter
 arcpy.SetParameter(12, final_output_fc_path)
 
-arcpy.SetProgressor('default', 'Cleaning up temporary files ...')
-# delete the in memory workspace
-arcpy.Delete_management(in_mem_stats_tbl)
+if not in_headless:
+    for msg in get_client().timing_summary():
+        arcpy.AddMessage(msg)
 
-# clean up geometry cache variable
-del geom_cache
+set_progressor('Cleaning up temporary files ...', in_headless)
+# delete the in memory workspace
+if in_mem_stats_tbl is not None:
+    arcpy.Delete_management(in_mem_stats_tbl)
 
 # delete tmp directory
-# if not in_save_temp_files:
-#     pth = Path(full_job_path)
-#     if pth.exists():
-#         shutil.rmtree(pth)
-# else:
-#     arcpy.AddMessage(f'Temp files saved at {full_job_path}')
\ No newline at end of file
+if not in_save_temp_files:
+    pth = Path(full_job_path)
+    if pth.exists():
+        shutil.rmtree(pth)
+else:
+    arcpy.AddMessage(f'Temp files saved at {full_job_path}')
\ No newline at end of file
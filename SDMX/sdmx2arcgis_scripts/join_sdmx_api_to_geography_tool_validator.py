@@ -1,6 +1,18 @@
 import arcpy
 import requests
-import json
+import sys
+from pathlib import Path
+
+# helpers shared by the SDMX and PxWeb tools live in the top-level common folder. validator code
+# embedded in the toolbox has no __file__ to find it from, it then does not list the fields
+try:
+    sys.path.append(str(Path(__file__).resolve().parents[2].joinpath('common')))
+except NameError:
+    pass
+try:
+    from field_discovery import get_sdmx_structure
+except ImportError:
+    get_sdmx_structure = None
 
 def parse_fields_and_lookups(dimension_props, attribute_props):
     fields = []
@@ -41,20 +53,18 @@ def parse_fields_and_lookups(dimension_props, attribute_props):
     return fields
 
 def get_sdmx_field_list(in_url):
-    response = requests.get(
-        in_url, 
-        headers={'accept': 'application/vnd.sdmx.data+json;version=1.0.0-wd'}
-    )
-
-    if not response:
+    # only the structure is needed, it is fetched with a single observation and kept for the rest of the session.
+    # without the common helpers the fields are left unlisted rather than read from the whole dataset
+    if get_sdmx_structure is None:
+        return []
+    try:
+        dimension_props, attribute_props = get_sdmx_structure(in_url)
+    except (requests.exceptions.RequestException, ValueError, KeyError):
         return ['Unable to parse SDMX response. Check URL.']
-    else:
-        res_json = response.json()
-        dimension_props = res_json['data']['structure']['dimensions']['observation']
-        attribute_props = res_json['data']['structure']['attributes']['observation']
-        field_info = parse_fields_and_lookups(dimension_props, attribute_props)
-        fields = [f['name'] for f in field_info]
-        return fields
+
+    field_info = parse_fields_and_lookups(dimension_props, attribute_props)
+    fields = [f['name'] for f in field_info]
+    return fields
 
 class ToolValidator(object):
         
@@ -94,6 +104,8 @@ class ToolValidator(object):
                 
                 self.params[10].filter.list = fields
                 self.params[10].value = fields[0]
+            elif get_sdmx_structure is None:
+                self.params[0].setWarningMessage('Fields of the SDMX API query could not be listed, type the name of the join field')
             else:
                 self.params[0].setErrorMessage('Unable to parse fields from SDMX API. Please make sure your API Query URL is valid')
 
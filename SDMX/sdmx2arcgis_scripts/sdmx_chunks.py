@@ -0,0 +1,212 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+import numpy as np
+
+from http_client import get_client
+
+SDMX_JSON_ACCEPT = 'application/vnd.sdmx.data+json;version=1.0.0-wd'
+DEFAULT_MAX_WORKERS = 4
+
+def period_windows(start_period, end_period, window_years):
+    # [startPeriod, endPeriod] pairs covering the range in blocks of window_years calendar years.
+    # the outer bounds keep their original precision (e.g. 2017-06), inner bounds are whole years
+    start_year = int(start_period[:4])
+    end_year = int(end_period[:4])
+
+    windows = []
+    for year in range(start_year, end_year + 1, window_years):
+        last_year = min(year + window_years - 1, end_year)
+        window_start = start_period if year == start_year else str(year)
+        window_end = end_period if last_year == end_year else str(last_year)
+        windows.append((window_start, window_end))
+
+    return windows
+
+class SDMXQueryPlanner(object):
+
+    """Splits an SDMX REST data query into independent queries, by
+    startPeriod/endPeriod windows and/or by the values of the key dimension
+    with the most '+' separated values. Each chunk returns a complete
+    SDMX-JSON message for its part of the data."""
+
+    def __init__(self, in_url, split_by_key=False, period_window_years=None):
+        self.in_url = in_url
+        self.split_by_key = split_by_key
+        self.period_window_years = period_window_years
+
+        self._url_parts = urlsplit(in_url)
+        self._path_segments = self._url_parts.path.split('/')
+        self._params = parse_qsl(self._url_parts.query, keep_blank_values=True)
+
+        # path is .../data/{flowRef}/{key}/{providerRef}
+        self._key_idx = None
+        if 'data' in self._path_segments:
+            key_idx = self._path_segments.index('data') + 2
+            if key_idx < len(self._path_segments) and self._path_segments[key_idx] not in ('', 'all'):
+                self._key_idx = key_idx
+
+    def get_param(self, name):
+        for k, v in self._params:
+            if k == name:
+                return v
+        return None
+
+    def key_split(self):
+        # (position, values) of the key dimension with the most values, None if no dimension lists more than one
+        if self._key_idx is None:
+            return None
+
+        parts = self._path_segments[self._key_idx].split('.')
+        position = None
+        values = []
+        for i, part in enumerate(parts):
+            part_values = [v for v in part.split('+') if v]
+            if len(part_values) > len(values):
+                position = i
+                values = part_values
+
+        if len(values) < 2:
+            return None
+        return position, values
+
+    def period_split(self):
+        start_period = self.get_param('startPeriod')
+        end_period = self.get_param('endPeriod')
+        if not self.period_window_years or not start_period or not end_period:
+            return None
+
+        windows = period_windows(start_period, end_period, self.period_window_years)
+        if len(windows) < 2:
+            return None
+        return windows
+
+    def build_url(self, key_value=None, key_position=None, window=None):
+        segments = list(self._path_segments)
+        if key_value is not None:
+            parts = segments[self._key_idx].split('.')
+            parts[key_position] = key_value
+            segments[self._key_idx] = '.'.join(parts)
+
+        params = self._params
+        if window is not None:
+            params = [(k, v) for k, v in params if k not in ('startPeriod', 'endPeriod')]
+            params = params + [('startPeriod', window[0]), ('endPeriod', window[1])]
+
+        return urlunsplit((
+            self._url_parts.scheme,
+            self._url_parts.netloc,
+            '/'.join(segments),
+            urlencode(params, safe=',+:'),
+            self._url_parts.fragment
+        ))
+
+    def plan(self):
+        key_split = self.key_split() if self.split_by_key else None
+        windows = self.period_split()
+
+        key_values = [None]
+        key_position = None
+        if key_split:
+            key_position, key_values = key_split
+
+        urls = []
+        for key_value in key_values:
+            for window in (windows or [None]):
+                urls.append(self.build_url(key_value, key_position, window))
+
+        if len(urls) == 1:
+            return [self.in_url]
+        return urls
+
+def fetch_data_message(in_url):
+    response = get_client().get(in_url, headers={'accept': SDMX_JSON_ACCEPT})
+    # a chunk without observations is a 404 (NoResultsFound), not an error for the whole query
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json()
+
+def fetch_chunks(urls, max_workers=DEFAULT_MAX_WORKERS, on_result=None):
+    # run the chunk queries on a bounded pool, messages are returned in the order of urls
+    results = [None] * len(urls)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(fetch_data_message, url): i for i, url in enumerate(urls)}
+        for future in as_completed(futures):
+            i = futures[future]
+            results[i] = future.result()
+            if on_result:
+                on_result(i, results[i])
+
+    return results
+
+def merge_components(component_lists):
+    # union the values of each component (dimension or attribute) by id. returns the merged
+    # components and, per chunk, an array per component mapping chunk value index -> merged index
+    merged = []
+    positions = []
+    for components in component_lists:
+        for component in components:
+            if component['id'] not in [m['id'] for m in merged]:
+                merged.append(dict(component, values=[]))
+                positions.append({})
+
+    merged_idx = {m['id']: j for j, m in enumerate(merged)}
+    remaps = []
+    for components in component_lists:
+        chunk_remap = {}
+        for component in components:
+            j = merged_idx[component['id']]
+            value_positions = positions[j]
+            idx = []
+            for value in component['values']:
+                if value['id'] not in value_positions:
+                    value_positions[value['id']] = len(merged[j]['values'])
+                    merged[j]['values'].append(value)
+                idx.append(value_positions[value['id']])
+            chunk_remap[component['id']] = np.array(idx, dtype=np.intp)
+        remaps.append(chunk_remap)
+
+    return merged, remaps
+
+def merge_data_messages(res_jsons):
+    # each chunk keys its observations by positions in its own value lists, so the value
+    # lists are merged by id and every observation key and attribute index is re-mapped
+    res_jsons = [r for r in res_jsons if r]
+    if not res_jsons:
+        return None
+
+    structures = [r['data']['structure'] for r in res_jsons]
+    dimension_props, dim_remaps = merge_components([s['dimensions']['observation'] for s in structures])
+    attribute_props, att_remaps = merge_components([s['attributes']['observation'] for s in structures])
+
+    obs = {}
+    for res_json, structure, dim_remap, att_remap in zip(res_jsons, structures, dim_remaps, att_remaps):
+        chunk_obs = res_json['data']['dataSets'][0]['observations']
+        if not chunk_obs:
+            continue
+
+        chunk_dims = structure['dimensions']['observation']
+        chunk_atts = structure['attributes']['observation']
+
+        # re-map every key column with one gather
+        keys = list(chunk_obs.keys())
+        key_matrix = np.array(':'.join(keys).split(':'), dtype=np.intp).reshape(len(keys), len(chunk_dims))
+        merged_keys = np.empty((len(keys), len(dimension_props)), dtype=np.intp)
+        for i, dim in enumerate(chunk_dims):
+            merged_keys[:, [d['id'] for d in dimension_props].index(dim['id'])] = dim_remap[dim['id']][key_matrix[:, i]]
+
+        att_positions = [[a['id'] for a in attribute_props].index(a['id']) for a in chunk_atts]
+        for key, values in zip(merged_keys, chunk_obs.values()):
+            merged_values = [values[0] if len(values) > 0 else None] + [None] * len(attribute_props)
+            for i, att_value in enumerate(values[1:1 + len(chunk_atts)]):
+                if att_value is not None:
+                    merged_values[1 + att_positions[i]] = int(att_remap[chunk_atts[i]['id']][att_value])
+
+            obs[':'.join(map(str, key))] = merged_values
+
+    return {
+        'dimension_props': dimension_props,
+        'attribute_props': attribute_props,
+        'obs': obs
+    }
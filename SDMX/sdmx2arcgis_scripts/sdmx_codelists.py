@@ -0,0 +1,262 @@
+import json
+import os
+import re
+import tempfile
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+# common is on the path of every tool script that imports this module
+from batch_manifest import file_hash
+
+LANGUAGE = 'en'
+
+# bump when the parsed result changes, cache entries of an older parser are then not used
+CACHE_FORMAT_VERSION = 1
+
+# parsed files of this process, a batch loads its codelists file once
+_loaded = {}
+
+def default_cache_dir():
+    return Path(tempfile.gettempdir()).joinpath('sdmx_pxweb2arcgis', 'codelists')
+
+def local_name(element):
+    return element.tag.rsplit('}', 1)[-1]
+
+def children(element, name):
+    return [c for c in element if local_name(c) == name]
+
+def child(element, name):
+    found = children(element, name)
+    return found[0] if found else None
+
+def pick_language(names):
+    # the english name when there is one, otherwise the first
+    if not names:
+        return None
+    return names.get(LANGUAGE, next(iter(names.values())))
+
+def urn_id(urn):
+    # 'urn:...Codelist=ILO:CL_AREA(1.0)' -> CL_AREA, 'urn:...ConceptScheme=ILO:CS(1.0).REF_AREA' -> REF_AREA
+    match = re.search(r'=[^:]*:([^(]+)\([^)]*\)(?:\.(.+))?$', urn.strip())
+    if match is None:
+        return None
+    return match.group(2) or match.group(1)
+
+def ml_name(element):
+    names = {}
+    for name in children(element, 'Name'):
+        lang = name.get('{http://www.w3.org/XML/1998/namespace}lang', LANGUAGE)
+        names[lang] = (name.text or '').strip()
+    return pick_language(names)
+
+def ml_reference(element):
+    # the id a Ref child (SDMX 2.1) or a urn (SDMX 3.0) points to
+    if element is None:
+        return None
+    ref = child(element, 'Ref')
+    if ref is not None:
+        return ref.get('id')
+    if element.text and element.text.strip():
+        return urn_id(element.text)
+    urn = child(element, 'URN')
+    return urn_id(urn.text) if urn is not None and urn.text else None
+
+def json_name(item):
+    name = item.get('name')
+    if isinstance(name, dict):
+        return pick_language(name)
+    if name is None:
+        return pick_language(item.get('names'))
+    return name
+
+def json_reference(value):
+    if isinstance(value, dict):
+        return value.get('id') or urn_id(value.get('urn', ''))
+    return urn_id(value) if value else None
+
+class SDMXCodelists(object):
+
+    """Codelists, concepts and data structure components of an SDMX-ML or
+    SDMX-JSON structure file, indexed once by codelist id and code so field
+    aliases and code labels are dictionary lookups. Parsed files are kept per
+    file hash, in memory and as JSON on disk, and reused until the file
+    changes or the parser's CACHE_FORMAT_VERSION does."""
+
+    def __init__(self):
+        # codelist id -> {code: label}
+        self.codelists = {}
+        # concept id -> name
+        self.concepts = {}
+        # component id -> (concept id, codelist id)
+        self.components = {}
+        # upper case field name -> alias
+        self.aliases = {}
+        # hash of the file the codelists were read from
+        self.version = None
+
+    @classmethod
+    def from_file(cls, path, cache_dir=None):
+        # ValueError when the file is not an SDMX structure file
+        if not path or not os.path.isfile(path):
+            raise ValueError(f'Codelists file \'{path}\' does not exist')
+
+        key = file_hash(path)
+        if key in _loaded:
+            return _loaded[key]
+
+        cache_path = Path(cache_dir) if cache_dir else default_cache_dir()
+        cache_path = cache_path.joinpath(f'{key}.v{CACHE_FORMAT_VERSION}.json')
+        codelists = cls.load_cache(cache_path)
+
+        if codelists is None:
+            codelists = cls.parse(path)
+            try:
+                cache_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(codelists.to_json(), f)
+                os.replace(str(tmp_path), str(cache_path))
+            except OSError:
+                # without a writable temp folder the file is parsed on every run
+                pass
+
+        codelists.version = key
+        _loaded[key] = codelists
+        return codelists
+
+    @classmethod
+    def load_cache(cls, cache_path):
+        # None when there is no usable entry, a damaged or older one is parsed again
+        if not cache_path.exists():
+            return None
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                content = json.load(f)
+            if content.get('format') != CACHE_FORMAT_VERSION:
+                return None
+            codelists = cls()
+            codelists.codelists = content['codelists']
+            codelists.concepts = content['concepts']
+            codelists.components = {k: tuple(v) for k, v in content['components'].items()}
+            codelists.aliases = content['aliases']
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+        return codelists
+
+    def to_json(self):
+        return {
+            'format': CACHE_FORMAT_VERSION,
+            'codelists': self.codelists,
+            'concepts': self.concepts,
+            'components': {k: list(v) for k, v in self.components.items()},
+            'aliases': self.aliases
+        }
+
+    @classmethod
+    def parse(cls, path):
+        codelists = cls()
+        with open(path, 'rb') as f:
+            start = f.read(1024).lstrip(b'\xef\xbb\xbf \t\r\n')
+        try:
+            if start.startswith(b'{'):
+                with open(path, 'r', encoding='utf-8-sig') as f:
+                    codelists.read_json(json.load(f))
+            else:
+                codelists.read_xml(ET.parse(path).getroot())
+        except (ET.ParseError, ValueError, KeyError, TypeError, AttributeError) as e:
+            raise ValueError(f'Unable to read SDMX structure file \'{path}\' :: {e}')
+
+        if not codelists.codelists and not codelists.concepts:
+            raise ValueError(f'No codelists or concepts found in \'{path}\'')
+        codelists.build_aliases()
+        return codelists
+
+    def read_xml(self, root):
+        for element in root.iter():
+            name = local_name(element)
+            if name == 'Codelist':
+                self.codelists[element.get('id')] = {c.get('id'): ml_name(c) for c in children(element, 'Code')}
+            elif name == 'Concept':
+                self.concepts[element.get('id')] = ml_name(element)
+            elif name in ('Dimension', 'TimeDimension', 'Attribute', 'PrimaryMeasure', 'Measure'):
+                representation = child(element, 'LocalRepresentation')
+                enumeration = child(representation, 'Enumeration') if representation is not None else None
+                concept_id = ml_reference(child(element, 'ConceptIdentity')) or element.get('id')
+                self.components[element.get('id')] = (concept_id, ml_reference(enumeration))
+
+    def read_json(self, message):
+        data = message.get('data', message)
+
+        for codelist in data.get('codelists', []):
+            self.codelists[codelist['id']] = {c['id']: json_name(c) for c in codelist.get('codes', [])}
+        for scheme in data.get('conceptSchemes', []):
+            for concept in scheme.get('concepts', []):
+                self.concepts[concept['id']] = json_name(concept)
+
+        for dsd in data.get('dataStructures', []):
+            dsd_components = dsd.get('dataStructureComponents', {})
+            component_lists = (
+                dsd_components.get('dimensionList', {}).get('dimensions', []),
+                dsd_components.get('dimensionList', {}).get('timeDimensions', []),
+                dsd_components.get('attributeList', {}).get('attributes', []),
+                dsd_components.get('measureList', {}).get('measures', []),
+                [dsd_components.get('measureList', {}).get('primaryMeasure')]
+            )
+            for components in component_lists:
+                for component in components:
+                    if not component:
+                        continue
+                    enumeration = component.get('localRepresentation', {}).get('enumeration')
+                    concept_id = json_reference(component.get('conceptIdentity')) or component['id']
+                    self.components[component['id']] = (concept_id, json_reference(enumeration))
+
+        # a data message carries its own codes and labels for each dimension and attribute
+        structure = data.get('structure', message.get('structure', {}))
+        for group in ('dimensions', 'attributes'):
+            for level in structure.get(group, {}).values():
+                for component in level:
+                    self.concepts[component['id']] = json_name(component)
+                    self.codelists[component['id']] = {v['id']: json_name(v) for v in component.get('values', []) if 'id' in v}
+                    self.components[component['id']] = (component['id'], component['id'])
+
+    def build_aliases(self):
+        # the component id of a csv column and the label field the API tool names after the concept
+        for component_id, (concept_id, _) in self.components.items():
+            name = self.concepts.get(concept_id)
+            if name:
+                self.aliases[component_id.upper()] = name
+                self.aliases.setdefault(name.replace(' ', '_').upper(), name)
+        for concept_id, name in self.concepts.items():
+            if name:
+                self.aliases.setdefault(concept_id.upper(), name)
+
+    def alias(self, field_name, default=None):
+        return self.aliases.get(field_name.upper(), default)
+
+    def codes(self, component_id):
+        # {code: label} of a component's codelist, or of a codelist given by its own id
+        _, codelist_id = self.components.get(component_id, (None, component_id))
+        return self.codelists.get(codelist_id, {})
+
+    def label(self, component_id, code, default=None):
+        return self.codes(component_id).get(code, default)
+
+    def label_length(self, component_id):
+        # longest label of a component's codelist
+        return max([len(label) for label in self.codes(component_id).values() if label] + [1])
+
+    def code_fields(self, field_names, skip=()):
+        # the fields of a csv that hold the codes of a codelist. skipped fields keep their codes,
+        # the join field has to keep matching the Geography layer
+        skip = set(n.upper() for n in skip)
+        return [n for n in field_names if n.upper() not in skip and self.codes(n)]
+
+    def replace_codes(self, rows, field_names, code_fields):
+        # rows with every code in code_fields that has a label replaced by the label
+        columns = [(field_names.index(n), self.codes(n)) for n in code_fields]
+        for row in rows:
+            row = list(row)
+            for i, codes in columns:
+                if row[i] is not None:
+                    row[i] = codes.get(str(row[i]), row[i])
+            yield tuple(row)
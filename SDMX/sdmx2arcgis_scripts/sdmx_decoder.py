@@ -0,0 +1,123 @@
+from datetime import datetime
+
+import numpy as np
+from dateutil import parser
+
+def format_time_period(value):
+    tv = parser.parse(value)
+    return datetime.strftime(tv, '%Y-%m')
+
+def get_label(value):
+    name = value.get('name')
+    if isinstance(name, dict):
+        return name.get('en')
+    return name
+
+def max_text_length(values):
+    return max([len(str(v)) for v in values if v is not None] + [1])
+
+class SDMXObservationDecoder(object):
+
+    """Decodes SDMX-JSON (AllDimensions) observation keys in bulk. Code and
+    label arrays and the output column names are built once from the
+    structure; a batch of keys becomes an integer index matrix and each output
+    column is a single gather from those arrays. With codelists, the label of
+    a code comes from them rather than from the response."""
+
+    def __init__(self, dimension_props, attribute_props, codelists=None):
+        self.field_names = []
+        # (code field, label field) pairs, in column order
+        self.dimension_fields = []
+        self.attribute_fields = []
+        self._dimensions = []
+        self._attributes = []
+
+        for i, dim in enumerate(dimension_props):
+            values = dim['values']
+            if dim['id'] == 'TIME_PERIOD':
+                codes = np.array([format_time_period(get_label(v)) for v in values], dtype=object)
+                labels = codes
+            else:
+                codes = np.array([v['id'] for v in values], dtype=object)
+                labels = np.array([self.label(codelists, dim['id'], v) for v in values], dtype=object)
+
+            self._dimensions.append((dim.get('keyPosition', i), codes, labels))
+            self.dimension_fields.append(('{}_CODE'.format(dim['id']), get_label(dim).replace(' ', '_').upper()))
+            self.field_names.extend(self.dimension_fields[-1])
+
+        for dim in attribute_props:
+            values = dim['values']
+            # the extra last slot holds None for observations without a value for the attribute
+            codes = np.array([v['id'] for v in values] + [None], dtype=object)
+            labels = np.array([self.label(codelists, dim['id'], v) for v in values] + [None], dtype=object)
+
+            self._attributes.append((codes, labels))
+            self.attribute_fields.append(('{}_CODE'.format(dim['id']), dim['id']))
+            self.field_names.extend(self.attribute_fields[-1])
+
+        self.field_names.append('OBS_VALUE')
+        self.key_length = len(self._dimensions)
+
+    @staticmethod
+    def label(codelists, component_id, value):
+        if codelists is None:
+            return get_label(value)
+        return codelists.label(component_id, value['id'], get_label(value))
+
+    def field_definitions(self):
+        # [name, type, alias, length] for AddFields, text lengths sized from the codes and labels in the structure
+        lengths = []
+        for _, codes, labels in self._dimensions:
+            lengths.append(max_text_length(codes))
+            lengths.append(max_text_length(labels))
+        for codes, labels in self._attributes:
+            lengths.append(max_text_length(codes))
+            lengths.append(max_text_length(labels))
+
+        field_defs = [[name, 'TEXT', name, length] for name, length in zip(self.field_names, lengths)]
+        field_defs.append(['OBS_VALUE', 'DOUBLE', 'OBS_VALUE', 8])
+        return field_defs
+
+    def key_matrix(self, keys):
+        # one split over all keys instead of one per key
+        flat = ':'.join(keys).split(':')
+        return np.array(flat, dtype=np.intp).reshape(len(keys), self.key_length)
+
+    def attribute_matrix(self, values):
+        att_cnt = len(self._attributes)
+        rows = [v[1:1 + att_cnt] for v in values]
+        # observations may leave off trailing attributes
+        rows = [r if len(r) == att_cnt else list(r) + [None] * (att_cnt - len(r)) for r in rows]
+
+        matrix = np.array(rows, dtype=object).reshape(len(values), att_cnt)
+        for j, (codes, _) in enumerate(self._attributes):
+            column = matrix[:, j]
+            column[np.equal(column, None)] = len(codes) - 1
+
+        return matrix.astype(np.intp)
+
+    def decode_columns(self, keys, values):
+        columns = []
+
+        key_idx = self.key_matrix(keys)
+        for key_position, codes, labels in self._dimensions:
+            idx = key_idx[:, key_position]
+            columns.append(codes[idx])
+            columns.append(labels[idx])
+
+        if self._attributes:
+            att_idx = self.attribute_matrix(values)
+            for j, (codes, labels) in enumerate(self._attributes):
+                idx = att_idx[:, j]
+                columns.append(codes[idx])
+                columns.append(labels[idx])
+
+        columns.append([v[0] if len(v) > 0 else None for v in values])
+
+        return columns
+
+    def decode_rows(self, keys, values):
+        # row tuples in the same order as field_names
+        if len(keys) == 0:
+            return []
+        return zip(*self.decode_columns(keys, values))
@@ -0,0 +1,123 @@
+import json
+import tempfile
+
+import ijson
+
+DEFAULT_STREAM_BATCH_SIZE = 5000
+
+STRUCTURE_PREFIX = 'data.structure'
+DATASET_PREFIX = 'data.dataSets.item'
+OBSERVATIONS_PREFIX = 'data.dataSets.item.observations'
+
+def build_value(events, event, value):
+    # assemble the json value that starts with (event, value) from the remaining parse events
+    builder = ijson.ObjectBuilder()
+    builder.event(event, value)
+    if event not in ('start_map', 'start_array'):
+        return builder.value
+
+    depth = 1
+    for _, event, value in events:
+        builder.event(event, value)
+        if event in ('start_map', 'start_array'):
+            depth = depth + 1
+        elif event in ('end_map', 'end_array'):
+            depth = depth - 1
+            if depth == 0:
+                break
+
+    return builder.value
+
+class SDMXStreamParser(object):
+
+    """Incremental parser for SDMX-JSON data messages (AllDimensions). The
+    structure is read first, then observations from dataSets[0] are handed out
+    in batches as the body is read, so only one batch is held in memory.
+    Observations that arrive before the structure are spooled to a temp file."""
+
+    def __init__(self, fp, batch_size=DEFAULT_STREAM_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.structure = None
+        self.res_count = 0
+
+        self._events = ijson.parse(fp, use_float=True)
+        self._dataset_idx = -1
+        self._spool = None
+        self._spool_count = 0
+
+    def _next_observation(self):
+        # returns (key, values) for the next observation of dataSets[0], None at the end of the body
+        for prefix, event, value in self._events:
+            if prefix == STRUCTURE_PREFIX and event == 'start_map':
+                self.structure = build_value(self._events, event, value)
+                return self._next_observation()
+
+            if prefix == DATASET_PREFIX and event == 'start_map':
+                self._dataset_idx = self._dataset_idx + 1
+
+            elif prefix == OBSERVATIONS_PREFIX and event == 'map_key' and self._dataset_idx == 0:
+                key = value
+                _, event, value = next(self._events)
+                return key, build_value(self._events, event, value)
+
+        return None
+
+    def read_structure(self):
+        while self.structure is None:
+            obs = self._next_observation()
+            if obs is None:
+                break
+
+            # keep observations read before (or right after) the structure for later
+            self._spool_observation(obs)
+
+        if self.structure is None:
+            raise ValueError('SDMX response does not contain a data structure')
+
+        return self.structure
+
+    def _spool_observation(self, obs):
+        if self._spool is None:
+            self._spool = tempfile.TemporaryFile('w+', encoding='utf-8')
+        self._spool.write(json.dumps(obs))
+        self._spool.write('\n')
+        self._spool_count = self._spool_count + 1
+
+    def _spooled_observations(self):
+        if self._spool is None:
+            return
+
+        self._spool.seek(0)
+        for line in self._spool:
+            key, values = json.loads(line)
+            yield key, values
+
+        self._spool.close()
+        self._spool = None
+
+    def observation_batches(self):
+        if self.structure is None:
+            self.read_structure()
+
+        batch = []
+        for obs in self._spooled_observations():
+            batch.append(obs)
+            if len(batch) >= self.batch_size:
+                self.res_count = self.res_count + len(batch)
+                yield batch
+                batch = []
+
+        while True:
+            obs = self._next_observation()
+            if obs is None:
+                break
+
+            batch.append(obs)
+            if len(batch) >= self.batch_size:
+                self.res_count = self.res_count + len(batch)
+                yield batch
+                batch = []
+
+        if batch:
+            self.res_count = self.res_count + len(batch)
+            yield batch
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+
+import arcpy
+
+# short names so the table also works as a dbf in a folder workspace
+MANIFEST_FIELDS = [
+    ['CSV_FILE', 'TEXT', 'CSV File', 1024],
+    ['CSV_HASH', 'TEXT', 'CSV Hash', 64],
+    ['GEO_VER', 'TEXT', 'Geography Version', 64],
+    ['PARAMS', 'TEXT', 'Parameters Hash', 64],
+    ['OUTPUT', 'TEXT', 'Output Feature Class', 255],
+    ['ROWS', 'LONG', 'Rows Written'],
+    ['UPDATED', 'DATE', 'Updated']
+]
+MANIFEST_FIELD_NAMES = [f[0] for f in MANIFEST_FIELDS]
+
+def file_hash(path, chunk_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def params_hash(params):
+    # only the parameters that change what ends up in an output feature class belong in here
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+class BatchManifest(object):
+
+    """Table in the output workspace recording, per CSV file, the file hash,
+    Geography layer version and parameter hash of the run that produced its
+    output feature class. A file whose record still matches is not rebuilt."""
+
+    def __init__(self, out_workspace, table_name):
+        self.out_workspace = out_workspace
+        self.table_path = os.path.join(out_workspace, table_name)
+        self.entries = {}
+
+        if arcpy.Exists(self.table_path):
+            with arcpy.da.SearchCursor(self.table_path, MANIFEST_FIELD_NAMES) as cursor:
+                for row in cursor:
+                    self.entries[row[0]] = dict(zip(MANIFEST_FIELD_NAMES, row))
+        else:
+            arcpy.CreateTable_management(out_workspace, table_name)
+            arcpy.AddFields_management(self.table_path, MANIFEST_FIELDS)
+
+    @staticmethod
+    def entry_key(csv_path):
+        return os.path.normcase(os.path.abspath(csv_path))
+
+    def get(self, csv_path):
+        return self.entries.get(self.entry_key(csv_path))
+
+    def output_path(self, entry):
+        return os.path.join(self.out_workspace, entry['OUTPUT'])
+
+    def is_current(self, entry, csv_hash, geo_version, params_version):
+        # a missing layer version means the layer could not be fingerprinted, so nothing is current
+        return entry is not None and geo_version is not None \
+            and entry['CSV_HASH'] == csv_hash \
+            and entry['GEO_VER'] == geo_version \
+            and entry['PARAMS'] == params_version \
+            and arcpy.Exists(self.output_path(entry))
+
+    def replace_output(self, entry, new_path):
+        # a rebuilt output is written next to the one it replaces and only takes over its name once it
+        # was built, so a rebuild that fails part way through leaves the last good output in place
+        if entry is None:
+            return new_path
+        old_path = self.output_path(entry)
+        if os.path.normcase(old_path) == os.path.normcase(new_path):
+            return new_path
+
+        for suffix in ('', '_unmatched'):
+            if arcpy.Exists(f'{old_path}{suffix}'):
+                arcpy.Delete_management(f'{old_path}{suffix}')
+        for suffix in ('', '_unmatched'):
+            if arcpy.Exists(f'{new_path}{suffix}'):
+                arcpy.Rename_management(f'{new_path}{suffix}', f'{old_path}{suffix}')
+        return old_path
+
+    def record(self, csv_path, csv_hash, geo_version, params_version, output_name, rows):
+        key = self.entry_key(csv_path)
+        row = [key, csv_hash, geo_version or '', params_version, output_name, rows, datetime.now()]
+
+        # written as each file finishes, so an interrupted run keeps what it already built
+        if key in self.entries:
+            with arcpy.da.UpdateCursor(self.table_path, MANIFEST_FIELD_NAMES) as cursor:
+                for existing in cursor:
+                    if existing[0] == key:
+                        cursor.updateRow(row)
+        else:
+            with arcpy.da.InsertCursor(self.table_path, MANIFEST_FIELD_NAMES) as cursor:
+                cursor.insertRow(row)
+
+        self.entries[key] = dict(zip(MANIFEST_FIELD_NAMES, row))
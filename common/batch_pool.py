@@ -0,0 +1,104 @@
+import os
+import pickle
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'batch_worker.py')
+
+def get_python_executable():
+    # inside Pro sys.executable is ArcGISPro.exe, worker processes need the environment's python
+    for name in ('python.exe', 'python'):
+        path = os.path.join(sys.exec_prefix, name)
+        if os.path.exists(path):
+            return path
+    return sys.executable
+
+class WorkerProcess(object):
+
+    """A python process running batch_worker.py. Tasks are sent one at a time
+    and the worker's answers are read on a thread into a shared queue. The
+    worker only imports the module the task function lives in, never the tool
+    script that started it."""
+
+    def __init__(self, job, results):
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            [get_python_executable(), WORKER_SCRIPT],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.stderr,
+            # no console window for each worker when the tool runs inside Pro
+            creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0)
+        )
+        self.send(job)
+        self.reader = threading.Thread(target=self.read, args=(results,), daemon=True)
+        self.reader.start()
+
+    def send(self, message):
+        pickle.dump(message, self.process.stdin)
+        self.process.stdin.flush()
+
+    def read(self, results):
+        try:
+            while True:
+                results.put((self,) + pickle.load(self.process.stdout))
+        except (EOFError, OSError, pickle.UnpicklingError):
+            # the worker is done, or died and the caller is told with what it wrote to stderr
+            results.put((self, None, None, None))
+
+    def error_output(self):
+        self.stderr.seek(0)
+        return self.stderr.read().decode('utf-8', 'replace').strip()
+
+    def stop(self):
+        try:
+            self.send(None)
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.stderr.close()
+
+def imap_in_pool(func, tasks, worker_count, initializer=None, initargs=()):
+    # run func over tasks in worker_count processes, results come back in task order.
+    # func and initializer have to live in an importable module, not in the tool script
+    tasks = list(tasks)
+    job = {
+        'path': list(sys.path),
+        'module': func.__module__,
+        'func': func.__name__,
+        'initializer': initializer.__name__ if initializer else None,
+        'initargs': tuple(initargs)
+    }
+
+    results = queue.Queue()
+    workers = [WorkerProcess(job, results) for _ in range(min(worker_count, len(tasks)))]
+    next_task = 0
+    finished = {}
+    try:
+        for worker in workers:
+            if next_task < len(tasks):
+                worker.send((next_task, tasks[next_task]))
+                next_task = next_task + 1
+
+        for index in range(len(tasks)):
+            while index not in finished:
+                worker, task_index, ok, value = results.get()
+                if task_index is None:
+                    raise RuntimeError(f'Batch worker process stopped unexpectedly :: {worker.error_output()}')
+                if not ok:
+                    raise value
+                finished[task_index] = value
+
+                if next_task < len(tasks):
+                    worker.send((next_task, tasks[next_task]))
+                    next_task = next_task + 1
+            yield finished.pop(index)
+    finally:
+        for worker in workers:
+            worker.stop()
@@ -0,0 +1,47 @@
+import importlib
+import os
+import pickle
+import sys
+import traceback
+
+# entry point of a batch worker process, started by batch_pool as 'python batch_worker.py'.
+# the job comes in pickled on stdin: sys.path, the module holding the functions, the initializer
+# and its arguments. then one (index, task) per message until None, each answered on stdout
+# with (index, True, result) or (index, False, error)
+
+def picklable_error(e):
+    # the error itself when it survives pickling, otherwise its traceback as text
+    try:
+        pickle.dumps(e)
+        return e
+    except Exception:
+        return RuntimeError(''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+
+def main():
+    stdin = sys.stdin.buffer
+    # results own the real stdout, anything the task prints goes to stderr instead of into the pickles
+    results = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+
+    job = pickle.load(stdin)
+    sys.path[:0] = [p for p in job['path'] if p not in sys.path]
+    module = importlib.import_module(job['module'])
+    if job['initializer']:
+        getattr(module, job['initializer'])(*job['initargs'])
+    func = getattr(module, job['func'])
+
+    while True:
+        message = pickle.load(stdin)
+        if message is None:
+            break
+        index, task = message
+        try:
+            response = (index, True, func(task))
+        except Exception as e:
+            response = (index, False, picklable_error(e))
+        pickle.dump(response, results)
+        results.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+import arcpy
+
+from feature_writer import FeatureWriter
+
+NUMERIC_FIELD_TYPES = ('Double', 'Single')
+INTEGER_FIELD_TYPES = ('Integer', 'SmallInteger', 'BigInteger')
+INTEGER_RANGES = {
+    'SmallInteger': (-2 ** 15, 2 ** 15 - 1),
+    'Integer': (-2 ** 31, 2 ** 31 - 1),
+    'BigInteger': (-2 ** 63, 2 ** 63 - 1)
+}
+
+# how wide a numeric field type is, in the names of both ListFields and AddFields
+NUMERIC_TYPE_WIDTHS = {
+    'SMALLINTEGER': 1, 'SHORT': 1,
+    'INTEGER': 2, 'LONG': 2,
+    'BIGINTEGER': 3,
+    'SINGLE': 4, 'FLOAT': 4,
+    'DOUBLE': 5
+}
+
+def comparable_value(value, field_type):
+    # a csv or api value and the value stored in the feature class compare equal when they mean the same thing
+    if value is None or value == '':
+        return None
+    try:
+        if field_type in NUMERIC_FIELD_TYPES:
+            return float(value)
+        if field_type in INTEGER_FIELD_TYPES:
+            # a fraction is kept, 2.5 does not compare equal to a stored 2
+            number = float(value)
+            return int(number) if number.is_integer() else number
+    except (TypeError, ValueError):
+        return value
+    if field_type == 'String':
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return str(value)
+    return value
+
+def key_value(value, field_type):
+    # 2020, 2020.0 and '2020' are the same key
+    value = comparable_value(value, field_type)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def fits_field(value, field_type):
+    # False for a value an integer field would truncate or cannot hold
+    if field_type not in INTEGER_FIELD_TYPES or value is None or value == '':
+        return True
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return True
+    low, high = INTEGER_RANGES[field_type]
+    return number.is_integer() and low <= number <= high
+
+def narrower_fields(target_fields, field_types):
+    # names of target fields whose type is narrower than the type of the incoming values
+    narrower = []
+    for name, field_type in field_types.items():
+        target = target_fields.get(name.upper())
+        if target is None:
+            continue
+        incoming_width = NUMERIC_TYPE_WIDTHS.get(str(field_type).upper())
+        target_width = NUMERIC_TYPE_WIDTHS.get(target.type.upper())
+        if incoming_width is not None and target_width is not None and incoming_width > target_width:
+            narrower.append(f'{target.name} ({target.type}, the data needs {field_type})')
+    return narrower
+
+class FeatureUpserter(object):
+
+    """Loads rows into an existing output feature class keyed on a set of fields.
+    Rows whose key is already there only have changed attributes updated, the
+    stored geometry is left as it is. New keys are inserted through a
+    FeatureWriter, and keys no longer in the data can be deleted. Values an
+    integer field would truncate are reported as row errors, not written.
+    A key of the data stored more than once keeps its first row, the later
+    ones are deleted."""
+
+    def __init__(self, out_fc, fields, key_fields, delete_missing=False, on_error=None, field_types=None):
+        self.out_fc = out_fc
+        self.delete_missing = delete_missing
+        self.on_error = on_error
+
+        # published feature classes do not always keep the case of the field names
+        target_fields = {f.name.upper(): f for f in arcpy.ListFields(out_fc)}
+        missing = [f for f in fields if f != 'SHAPE@' and f.upper() not in target_fields]
+        if missing:
+            raise ValueError(f'{out_fc} is missing the field(s) {", ".join(missing)}')
+
+        # field name -> type of this run's values. a field created for whole numbers by an earlier
+        # run cannot take decimals, the output has to be rebuilt rather than the values truncated
+        narrower = narrower_fields(target_fields, field_types or {})
+        if narrower:
+            raise ValueError(f'{out_fc} has field(s) too narrow for the data, {", ".join(narrower)}. Rebuild the output instead of upserting')
+
+        self.fields = [f if f == 'SHAPE@' else target_fields[f.upper()].name for f in fields]
+        self.shape_idx = self.fields.index('SHAPE@') if 'SHAPE@' in self.fields else None
+        self.attribute_idxs = [i for i, f in enumerate(self.fields) if f != 'SHAPE@']
+        self.attribute_fields = [self.fields[i] for i in self.attribute_idxs]
+        self.attribute_types = [target_fields[f.upper()].type for f in self.attribute_fields]
+        self.key_idxs = [self.attribute_fields.index(target_fields[f.upper()].name) for f in key_fields]
+
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.deleted = 0
+        # later rows of a key the output already held more than once
+        self.duplicates_deleted = 0
+        self.errors = []
+
+        self._rows = {}
+        self._failed_keys = set()
+        self._row_number = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # nothing is written when the caller fails part way through, a partial upsert would delete rows
+        if exc_type is None:
+            self.close()
+        return False
+
+    def row_key(self, attributes):
+        return tuple(key_value(attributes[i], self.attribute_types[i]) for i in self.key_idxs)
+
+    def comparable(self, attributes):
+        return [comparable_value(v, t) for v, t in zip(attributes, self.attribute_types)]
+
+    def write(self, row):
+        self._row_number = self._row_number + 1
+        attributes = [row[i] for i in self.attribute_idxs]
+        for value, field, field_type in zip(attributes, self.attribute_fields, self.attribute_types):
+            if not fits_field(value, field_type):
+                e = ValueError(f'{value} does not fit the {field_type} field {field}')
+                self.errors.append((self._row_number, e))
+                if self.on_error:
+                    self.on_error(self._row_number, row, e)
+                # the stored row is left alone rather than deleted as missing
+                self._failed_keys.add(self.row_key(attributes))
+                return
+        # the last row for a key wins, same as inserting both and reading the newest
+        self._rows[self.row_key(attributes)] = (self._row_number, row, attributes)
+
+    def close(self):
+        seen = set()
+        with arcpy.da.UpdateCursor(self.out_fc, self.attribute_fields) as cursor:
+            for existing in cursor:
+                key = self.row_key(existing)
+                if key in seen:
+                    # left in place the row would keep its old values next to the updated one
+                    cursor.deleteRow()
+                    self.duplicates_deleted = self.duplicates_deleted + 1
+                    continue
+
+                incoming = self._rows.pop(key, None)
+                if incoming is None:
+                    if self.delete_missing and key not in self._failed_keys:
+                        cursor.deleteRow()
+                        self.deleted = self.deleted + 1
+                    continue
+
+                seen.add(key)
+                row_number, row, attributes = incoming
+                if self.comparable(existing) == self.comparable(attributes):
+                    self.unchanged = self.unchanged + 1
+                    continue
+
+                try:
+                    cursor.updateRow(attributes)
+                    self.updated = self.updated + 1
+                except Exception as e:
+                    self.errors.append((row_number, e))
+                    if self.on_error:
+                        self.on_error(row_number, row, e)
+
+        # whatever is left is new
+        new_rows = sorted(self._rows.values(), key=lambda r: r[0])
+        self._rows = {}
+        with FeatureWriter(self.out_fc, self.fields, on_error=self.on_error) as writer:
+            for row_number, row, attributes in new_rows:
+                writer.write(row)
+        self.inserted = writer.rows_written
+        self.errors.extend(writer.errors)
+
+    @property
+    def rows_written(self):
+        # rows of this run that are now in the output, written or already there
+        return self.inserted + self.updated + self.unchanged
+
+    @property
+    def error_count(self):
+        return len(self.errors)
+
+    def summary(self):
+        deleted = f', {self.deleted} deleted' if self.delete_missing else ''
+        duplicates = f', {self.duplicates_deleted} duplicate key rows deleted' if self.duplicates_deleted else ''
+        return f'{self.inserted} rows inserted, {self.updated} updated, {self.unchanged} unchanged{deleted}{duplicates}'
@@ -0,0 +1,50 @@
+import arcpy
+
+class FeatureWriter(object):
+
+    """Loads rows into an output feature class through a single InsertCursor
+    kept open for the whole load. A row that fails to insert is reported and
+    skipped so the rows after it still get written."""
+
+    def __init__(self, out_fc, fields, on_error=None):
+        self.out_fc = out_fc
+        self.fields = list(fields)
+        self.on_error = on_error
+
+        self.rows_written = 0
+        self.errors = []
+
+        self._cursor = None
+        self._row_number = 0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def open(self):
+        if self._cursor is None:
+            self._cursor = arcpy.da.InsertCursor(self.out_fc, self.fields)
+
+    def write(self, row):
+        self._row_number = self._row_number + 1
+        self.open()
+        try:
+            self._cursor.insertRow(row)
+            self.rows_written = self.rows_written + 1
+        except Exception as e:
+            self.errors.append((self._row_number, e))
+            if self.on_error:
+                self.on_error(self._row_number, row, e)
+
+    def close(self):
+        if self._cursor is not None:
+            del self._cursor
+            self._cursor = None
+
+    @property
+    def error_count(self):
+        return len(self.errors)
@@ -0,0 +1,54 @@
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from http_client import get_client
+
+SDMX_JSON_ACCEPT = 'application/vnd.sdmx.data+json;version=1.0.0-wd'
+
+# the dialog waits on validation, so give up on a slow server sooner than the tools do
+DISCOVERY_TIMEOUT = (10, 60)
+
+# module state lives as long as the python process, i.e. the whole Pro session,
+# so reopening a tool dialog with the same url does not go back to the server
+_sdmx_structures = {}
+_pxweb_variables = {}
+
+def with_query_params(in_url, **params):
+    parts = urlsplit(in_url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in params]
+    query = query + list(params.items())
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query, safe=',+:'), parts.fragment))
+
+def get_sdmx_structure(in_url):
+    # (dimension_props, attribute_props) of an SDMX data query, read from a one-observation response
+    if in_url not in _sdmx_structures:
+        response = None
+        # servers that do not support lastNObservations get the query as it is
+        for url in (with_query_params(in_url, lastNObservations='1'), in_url):
+            response = get_client().get(url, headers={'accept': SDMX_JSON_ACCEPT}, timeout=DISCOVERY_TIMEOUT)
+            if response:
+                break
+
+        if not response:
+            raise ValueError(f'SDMX API returned {response.status_code} :: {response.text}')
+
+        structure = response.json()['data']['structure']
+        _sdmx_structures[in_url] = (structure['dimensions']['observation'], structure['attributes']['observation'])
+
+    return _sdmx_structures[in_url]
+
+def get_pxweb_variables(in_url):
+    # variables of a PxWeb table from the table metadata GET, no data is queried
+    if in_url not in _pxweb_variables:
+        response = get_client().get(in_url, timeout=DISCOVERY_TIMEOUT)
+        if not response:
+            raise ValueError(f'PxWeb API returned {response.status_code} :: {response.text}')
+
+        _pxweb_variables[in_url] = response.json().get('variables', [])
+
+    return _pxweb_variables[in_url]
+
+def get_pxweb_query_dimensions(in_url, post_body):
+    # (code, text) of the dimensions a query returns, in table order: the queried
+    # variables plus any the table does not allow to be eliminated
+    queried = set(q['code'] for q in post_body.get('query', []))
+    return [(v['code'], v['text']) for v in get_pxweb_variables(in_url) if v['code'] in queried or not v.get('elimination', False)]
@@ -0,0 +1,342 @@
+import hashlib
+import json
+import mmap
+import struct
+
+import arcpy
+
+from join_keys import JoinKeyTransform, KeyNormalizer
+
+NUMERIC_FIELD_TYPES = ('OID', 'Integer', 'SmallInteger', 'BigInteger', 'Double', 'Single')
+
+# saved index: magic, header length, JSON header with the key -> (offset, length) directory, then the WKB.
+# the header is plain data, a file planted in the shared cache folder cannot run code when it is read
+INDEX_FILE_MAGIC = b'GEOMIDX3'
+INDEX_FILE_HEADER = struct.Struct('<Q')
+
+class GeometryIndex(object):
+
+    """Key to geometry lookup for the Geography layer. The layer is scanned
+    once up front; the per-key query is only used when that scan fails. An
+    index can be saved as WKB and loaded in another process without the layer;
+    a loaded index memory-maps the file and only decodes the keys it is asked for.
+    With a key_transform, data values are transformed before they are looked
+    up, or the layer's keys are reverse transformed when the index is built
+    and there is no key_normalizer. A key_normalizer is applied to both the layer's keys and the looked up
+    values, so a normalized match is still a single dictionary lookup."""
+
+    def __init__(self, geo_fl, geo_field, on_miss=None, preload=True, key_transform=None, key_normalizer=None):
+        self.geo_fl = geo_fl
+        self.geo_field = geo_field
+        self.on_miss = on_miss
+        self.preloaded = False
+
+        self.key_transform = key_transform if key_transform else None
+        # True once the stored keys are data values rather than layer values
+        self.keys_transformed = False
+
+        self.key_normalizer = key_normalizer if key_normalizer else None
+        # layer keys that normalized onto a key another layer row already had
+        self.collisions = 0
+        self._exact_keys = set()
+        self._normalized_matches = set()
+
+        # numeric key fields are queried unquoted
+        self._numeric_field = False
+        if geo_fl:
+            fields = arcpy.ListFields(geo_fl, geo_field)
+            self._numeric_field = len(fields) > 0 and fields[0].type in NUMERIC_FIELD_TYPES
+
+        self._geoms = {}
+        # key -> (offset, length) of its WKB in the memory-mapped file of a loaded index
+        self._wkb = {}
+        self._blob = None
+        self._blob_start = 0
+        self._fingerprint = None
+        self._spatial_reference = None
+        self._misses = set()
+        self._miss_counts = {}
+
+        if preload:
+            self.preload()
+
+    def preload(self):
+        geoms = {}
+        exact_keys = set()
+        collisions = 0
+        # key the index on what the data holds, so rows need no transform at all. a raw layer key
+        # such as ' ku010 ' only reverses once normalized, so with a normalizer the data values
+        # are transformed forward instead and both sides meet in normalized form
+        reverse_keys = self.key_transform is not None and self.key_transform.reversible and self.key_normalizer is None
+        try:
+            with arcpy.da.SearchCursor(self.geo_fl, ['SHAPE@', self.geo_field]) as cursor:
+                for row in cursor:
+                    key = self.to_key(row[1])
+                    if reverse_keys:
+                        key = self.key_transform.reverse(key)
+                    if key is None:
+                        continue
+
+                    if self.key_normalizer is not None:
+                        if key not in exact_keys and self.key_normalizer(key) in geoms:
+                            collisions = collisions + 1
+                        exact_keys.add(key)
+                        key = self.key_normalizer(key)
+
+                    # keep the first geometry for a key, same as the old where clause lookup
+                    if key not in geoms:
+                        geoms[key] = row[0]
+        except (RuntimeError, MemoryError) as e:
+            arcpy.AddWarning(f'Unable to index the Geography layer, geometries will be queried per key :: {e}')
+            return False
+
+        self._geoms = geoms
+        self._exact_keys = exact_keys
+        self.collisions = collisions
+        self._misses = set()
+        self._fingerprint = None
+        self.preloaded = True
+        self.keys_transformed = reverse_keys
+        return True
+
+    @staticmethod
+    def to_key(value):
+        # join values have always been compared as text (the where clause quoted them)
+        if value is None:
+            return None
+        return str(value)
+
+    def lookup_key(self, value):
+        key = self.to_key(value)
+        if self.key_transform is not None and not self.keys_transformed:
+            key = self.key_transform(key)
+        return key
+
+    def normalize(self, key):
+        if self.key_normalizer is not None:
+            return self.key_normalizer(key)
+        return key
+
+    def layer_key(self, key):
+        # the layer value a lookup key stands for
+        if self.keys_transformed:
+            return self.key_transform(key)
+        return key
+
+    def where_clause(self, key):
+        field = arcpy.AddFieldDelimiters(self.geo_fl, self.geo_field) if self.geo_fl else self.geo_field
+        if self._numeric_field:
+            try:
+                return """{0} = {1}""".format(field, float(key) if '.' in key else int(key))
+            except ValueError:
+                pass
+        return """{0} = '{1}'""".format(field, key.replace("'", "''"))
+
+    def query(self, key):
+        wc = self.where_clause(key)
+        with arcpy.da.SearchCursor(self.geo_fl, ['SHAPE@', self.geo_field], where_clause=wc) as cursor:
+            for row in cursor:
+                return row[0]
+        return None
+
+    def matched(self, exact_key):
+        # count the keys that would not have matched without normalization
+        if self.key_normalizer is not None and exact_key not in self._exact_keys:
+            self._normalized_matches.add(exact_key)
+
+    def count_miss(self, key):
+        self._miss_counts[key] = self._miss_counts.get(key, 0) + 1
+
+    def get(self, value):
+        exact_key = self.lookup_key(value)
+        key = self.normalize(exact_key)
+
+        if key in self._geoms:
+            self.matched(exact_key)
+            return self._geoms[key]
+        if key in self._wkb:
+            self.matched(exact_key)
+            return self.decode(key)
+        if key is None or key in self._misses:
+            self.count_miss(key)
+            return None
+
+        geom = None
+        if not self.preloaded:
+            # without the scan there is nothing normalized to match against, query the key as it is
+            try:
+                geom = self.query(exact_key)
+            except RuntimeError:
+                geom = None
+
+        if geom is None:
+            # remember the miss so the key is only reported and looked up once
+            self._misses.add(key)
+            self.count_miss(key)
+            if self.on_miss:
+                self.on_miss(key, self.where_clause(self.layer_key(exact_key)))
+        else:
+            self._geoms[key] = geom
+
+        return geom
+
+    def wkb_bytes(self, key):
+        offset, length = self._wkb[key]
+        start = self._blob_start + offset
+        return self._blob[start:start + length]
+
+    def decode(self, key):
+        # loaded indexes turn WKB into geometries on first use
+        geom = arcpy.FromWKB(bytearray(self.wkb_bytes(key)), self._spatial_reference)
+        del self._wkb[key]
+        self._geoms[key] = geom
+        return geom
+
+    def fill_missing(self, other):
+        # keys only the other index has a geometry for, e.g. areas lost when this one was simplified.
+        # returns the number of keys added
+        added = 0
+        for key in set(other._geoms) | set(other._wkb):
+            if key in self._geoms or key in self._wkb:
+                continue
+            if key in other._wkb:
+                self._geoms[key] = other.decode(key)
+            elif other._geoms[key] is not None:
+                self._geoms[key] = other._geoms[key]
+            else:
+                continue
+            self._misses.discard(key)
+            added = added + 1
+        self._exact_keys = self._exact_keys | other._exact_keys
+        self._fingerprint = None
+        return added
+
+    def iter_wkb(self):
+        # (key, WKB bytes) of every indexed geometry, in key order
+        for key in sorted(set(self._geoms) | set(self._wkb)):
+            if key in self._wkb:
+                yield key, bytes(self.wkb_bytes(key))
+            elif self._geoms[key] is not None:
+                yield key, bytes(self._geoms[key].WKB)
+
+    def save(self, path):
+        # WKB keyed by join value, enough for another process to rebuild the index
+        spatial_reference = self._spatial_reference
+        for geom in self._geoms.values():
+            if geom is not None:
+                spatial_reference = geom.spatialReference
+                break
+
+        entries = list(self.iter_wkb())
+        if self.preloaded and self._fingerprint is None:
+            # hashed from the same pass, not a second one over the layer's geometries
+            self._fingerprint = self.hash_wkb(entries)
+
+        directory = {}
+        offset = 0
+        for key, wkb in entries:
+            directory[key] = [offset, len(wkb)]
+            offset = offset + len(wkb)
+
+        data = {
+            'geo_field': self.geo_field,
+            'key_transform_rules': self.key_transform.rules if self.key_transform is not None else None,
+            'keys_transformed': self.keys_transformed,
+            'key_normalizer': self.key_normalizer.settings() if self.key_normalizer is not None else None,
+            'exact_keys': sorted(self._exact_keys),
+            'collisions': self.collisions,
+            'fingerprint': self._fingerprint,
+            'spatial_reference': spatial_reference.exportToString() if spatial_reference else None,
+            'directory': directory
+        }
+        header = json.dumps(data).encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(INDEX_FILE_MAGIC)
+            f.write(INDEX_FILE_HEADER.pack(len(header)))
+            f.write(header)
+            for _, wkb in entries:
+                f.write(wkb)
+
+    @classmethod
+    def load(cls, path, on_miss=None):
+        # only the header is read, the WKB stays in the mapped file until a key is looked up
+        with open(path, 'rb') as f:
+            blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header_start = len(INDEX_FILE_MAGIC) + INDEX_FILE_HEADER.size
+        if blob[:len(INDEX_FILE_MAGIC)] != INDEX_FILE_MAGIC:
+            blob.close()
+            raise ValueError(f'{path} is not a saved geometry index')
+        header_length = INDEX_FILE_HEADER.unpack(blob[len(INDEX_FILE_MAGIC):header_start])[0]
+        try:
+            data = json.loads(blob[header_start:header_start + header_length].decode('utf-8'))
+            if not isinstance(data, dict) or not isinstance(data.get('directory'), dict):
+                raise ValueError(f'{path} has no key directory')
+        except ValueError:
+            blob.close()
+            raise
+
+        key_transform = JoinKeyTransform(data['key_transform_rules']) if data['key_transform_rules'] else None
+        key_normalizer = KeyNormalizer(**data['key_normalizer']) if data['key_normalizer'] else None
+        index = cls(None, data['geo_field'], on_miss=on_miss, preload=False, key_transform=key_transform, key_normalizer=key_normalizer)
+        index.keys_transformed = data['keys_transformed']
+        index._exact_keys = set(data['exact_keys'])
+        index.collisions = data['collisions']
+        index._fingerprint = data['fingerprint']
+        if data['spatial_reference']:
+            index._spatial_reference = arcpy.SpatialReference()
+            index._spatial_reference.loadFromString(data['spatial_reference'])
+        index._wkb = {key: (entry[0], entry[1]) for key, entry in data['directory'].items()}
+        index._blob = blob
+        index._blob_start = header_start + header_length
+        # there is no layer to query, a key that is not in the index is a miss
+        index.preloaded = True
+        return index
+
+    def close(self):
+        # decoded geometries stay usable, keys not decoded yet are dropped
+        if self._blob is not None:
+            self._wkb = {}
+            self._blob.close()
+            self._blob = None
+
+    def fingerprint(self):
+        # hash of every key and geometry, changes whenever the indexed layer does.
+        # None when the layer could not be indexed up front
+        if not self.preloaded:
+            return None
+        if self._fingerprint is None:
+            self._fingerprint = self.hash_wkb(self.iter_wkb())
+        return self._fingerprint
+
+    def hash_wkb(self, entries):
+        h = hashlib.sha256(self.geo_field.encode('utf-8'))
+        for key, wkb in entries:
+            h.update(key.encode('utf-8'))
+            h.update(b'\0')
+            h.update(wkb)
+            h.update(b'\0')
+        return h.hexdigest()
+
+    @property
+    def misses(self):
+        return sorted(self._misses)
+
+    @property
+    def miss_counts(self):
+        # rows without geometry per join key, since the last clear_miss_counts
+        return dict(self._miss_counts)
+
+    def clear_miss_counts(self):
+        self._miss_counts = {}
+
+    @property
+    def normalized_matches(self):
+        return sorted(self._normalized_matches)
+
+    def __len__(self):
+        return len(self._geoms) + len(self._wkb)
+
+    def __contains__(self, value):
+        key = self.normalize(self.lookup_key(value))
+        return key in self._geoms or key in self._wkb
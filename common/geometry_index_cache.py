@@ -0,0 +1,139 @@
+import hashlib
+import os
+import struct
+import tempfile
+from pathlib import Path
+
+import arcpy
+
+from geometry_index import GeometryIndex
+
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+def default_cache_dir():
+    return Path(tempfile.gettempdir()).joinpath('sdmx_pxweb2arcgis', 'geometry_index')
+
+def source_files(catalog_path):
+    # the files holding a layer's data: the whole file geodatabase, or the shapefile's parts.
+    # lock files come and go whenever the layer is opened, they say nothing about its content
+    path = Path(catalog_path)
+    for parent in [path] + list(path.parents):
+        if parent.suffix.lower() == '.gdb' and parent.is_dir():
+            return [p for p in parent.iterdir() if p.is_file() and '.lock' not in p.name]
+    if path.is_file():
+        return [p for p in path.parent.glob(f'{path.stem}.*') if p.is_file() and '.lock' not in p.name]
+    return []
+
+def layer_state(geo_fl):
+    # what the layer reads and when its files last changed. None for sources without
+    # files to look at (enterprise geodatabases, services), their changes cannot be seen
+    desc = arcpy.Describe(geo_fl)
+    files = source_files(desc.catalogPath)
+    if not files:
+        return None
+
+    file_states = []
+    for f in sorted(files):
+        stat = f.stat()
+        file_states.append(f'{f.name}:{stat.st_size}:{stat.st_mtime_ns}')
+    return {
+        'path': os.path.normcase(os.path.abspath(desc.catalogPath)),
+        'where_clause': getattr(desc, 'whereClause', '') or '',
+        'selection': getattr(desc, 'FIDSet', '') or '',
+        'spatial_reference': desc.spatialReference.exportToString() if desc.spatialReference else '',
+        'files': file_states
+    }
+
+class GeometryIndexCache(object):
+
+    """Saved GeometryIndex files on disk. Entries are keyed by the layer's path,
+    definition query and selection, spatial reference and the size and
+    modification time of its files, plus the join field and key rules, so an
+    edit to the layer makes a new entry instead of reusing a stale one. The
+    least recently used entries are removed once the cache is over max_bytes."""
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = Path(cache_dir) if cache_dir else default_cache_dir()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def hash_parts(parts):
+        h = hashlib.sha256()
+        for part in parts:
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    @staticmethod
+    def key_rules(key_transform, key_normalizer):
+        return (
+            repr(key_transform.rules if key_transform else None),
+            repr(sorted(key_normalizer.settings().items()) if key_normalizer else None)
+        )
+
+    def cache_key(self, geo_fl, geo_field, key_transform=None, key_normalizer=None):
+        # None when the layer's changes cannot be seen
+        state = layer_state(geo_fl)
+        if state is None:
+            return None
+        return self.hash_parts((repr(sorted(state.items())), geo_field) + self.key_rules(key_transform, key_normalizer))
+
+    def entry_path(self, key):
+        return self.cache_dir.joinpath(f'{key}.gidx')
+
+    def load(self, key, on_miss=None):
+        path = self.entry_path(key)
+        if not path.exists():
+            return None
+        try:
+            index = GeometryIndex.load(str(path), on_miss=on_miss)
+        except (OSError, EOFError, KeyError, TypeError, IndexError, ValueError, struct.error):
+            # a damaged entry is rebuilt
+            return None
+        # last access time drives eviction
+        os.utime(str(path), None)
+        return index
+
+    def store(self, key, index):
+        tmp_path = self.cache_dir.joinpath(f'{key}.{os.getpid()}.tmp')
+        index.save(str(tmp_path))
+        try:
+            os.replace(str(tmp_path), str(self.entry_path(key)))
+        except OSError:
+            # another run has the entry open, it holds the same index
+            tmp_path.unlink()
+        self.prune()
+
+    def prune(self):
+        entries = []
+        for path in self.cache_dir.glob('*.gidx'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+                total = total - size
+            except OSError:
+                # still mapped by a running tool
+                pass
+
+    def open(self, geo_fl, geo_field, on_miss=None, key_transform=None, key_normalizer=None):
+        # (index, True when it came from the cache). a layer that cannot be cached is indexed as before
+        key = self.cache_key(geo_fl, geo_field, key_transform, key_normalizer)
+        if key is not None:
+            index = self.load(key, on_miss)
+            if index is not None:
+                return index, True
+
+        index = GeometryIndex(geo_fl, geo_field, on_miss=on_miss, key_transform=key_transform, key_normalizer=key_normalizer)
+        if key is not None and index.preloaded:
+            self.store(key, index)
+        return index, False
@@ -0,0 +1,46 @@
+import arcpy
+
+from geometry_index import GeometryIndex
+from geometry_index_cache import GeometryIndexCache
+from join_keys import KeyNormalizer
+from simplified_geometry import SimplifiedGeometryCache, parse_tolerance
+
+def parse_geometry_options(key_normalization, simplify_tolerance):
+    # (KeyNormalizer or None, tolerance or None) from the tools' text parameters, e.g.
+    # 'trim, casefold, numeric, pad=5' and '250 Meters'. a bad value stops the tool
+    try:
+        return KeyNormalizer.from_text(key_normalization), parse_tolerance(simplify_tolerance)
+    except ValueError as e:
+        arcpy.AddError(str(e))
+        raise arcpy.ExecuteError
+
+def build_geometry_index(geo_fl, geo_field, on_miss=None, key_transform=None, key_normalizer=None, use_cache=True, simplify_tolerance=None, headless=False):
+    # the GeometryIndex every tool joins against: scanned once or mapped from the on-disk cache,
+    # and swapped for simplified geometries when a tolerance is given
+    if not headless:
+        arcpy.SetProgressor('default', 'Indexing geometries from Geography layer ...')
+    if use_cache:
+        # the index is kept on disk until the Geography layer changes, a rerun maps it instead of scanning the layer
+        geom_index, from_cache = GeometryIndexCache().open(geo_fl, geo_field, on_miss=on_miss, key_transform=key_transform, key_normalizer=key_normalizer)
+        if from_cache and not headless:
+            arcpy.AddMessage(f'Geometry index for {len(geom_index)} Geography layer keys loaded from cache')
+    else:
+        geom_index = GeometryIndex(geo_fl, geo_field, on_miss=on_miss, key_transform=key_transform, key_normalizer=key_normalizer)
+    if geom_index.collisions > 0:
+        arcpy.AddWarning(f'{geom_index.collisions} Geography layer keys are the same as another key once normalized, the first of them is used')
+
+    if simplify_tolerance:
+        if not headless:
+            arcpy.SetProgressor('default', f'Simplifying geometries from Geography layer to {simplify_tolerance} ...')
+        # simplified geometries are cached on disk per layer version and tolerance, reruns skip the simplification
+        try:
+            simplified_index, from_cache = SimplifiedGeometryCache().simplified_index(geom_index, geo_fl, simplify_tolerance, on_miss=on_miss)
+            # the full resolution index is not used again, release its mapped file now
+            geom_index.close()
+            geom_index = simplified_index
+            if not headless:
+                arcpy.AddMessage(f'Geometries simplified to {simplify_tolerance}' + (' (from cache)' if from_cache else ''))
+        except (ValueError, RuntimeError, arcpy.ExecuteError) as e:
+            arcpy.AddWarning(f'Unable to simplify the Geography layer, full resolution geometries are used :: {e}')
+
+    return geom_index
@@ -0,0 +1,251 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+# responses are revalidated on every use unless a ttl is given, a cached dataset is never served stale
+DEFAULT_TTL_SECONDS = 0
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+def default_cache_dir():
+    return Path(tempfile.gettempdir()).joinpath('sdmx_pxweb2arcgis', 'http_cache')
+
+def canonical_body(body):
+    # json bodies hash the same whatever their key order or whitespace
+    if body is None:
+        return b''
+    if isinstance(body, bytes):
+        return body
+    if isinstance(body, str):
+        return body.encode('utf-8')
+    return json.dumps(body, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+class CachedBody(object):
+
+    """File-like body of a cached response, closed once it is read to the end."""
+
+    def __init__(self, body_path):
+        self._fp = gzip.open(str(body_path), 'rb')
+        self.decode_content = True
+
+    def read(self, amt=None):
+        if self._fp.closed:
+            return b''
+        data = self._fp.read(-1 if amt is None else amt)
+        if not data:
+            self._fp.close()
+        return data
+
+    def close(self):
+        self._fp.close()
+
+class CachingBody(object):
+
+    """Wraps the raw body of a streamed response and copies what is read into
+    the cache. The entry is only committed when the body is read to the end."""
+
+    def __init__(self, raw, cache, key, meta):
+        self._raw = raw
+        self._raw.decode_content = True
+        self._cache = cache
+        self._key = key
+        self._meta = meta
+        self._tmp_path = cache.temp_path(key)
+        self._fp = gzip.open(str(self._tmp_path), 'wb')
+        self.decode_content = True
+
+    def read(self, amt=None):
+        data = self._raw.read(amt)
+        if self._fp is not None:
+            if data:
+                self._fp.write(data)
+            else:
+                self._fp.close()
+                self._fp = None
+                self._cache.commit(self._key, self._meta, self._tmp_path)
+        return data
+
+    def close(self):
+        if self._fp is not None:
+            # body was not read to the end, nothing to keep
+            self._fp.close()
+            self._fp = None
+            self._tmp_path.unlink()
+        self._raw.close()
+
+    def release_conn(self):
+        release_conn = getattr(self._raw, 'release_conn', None)
+        if release_conn:
+            release_conn()
+
+class ResponseCache(object):
+
+    """On-disk cache of successful API responses, keyed by method, URL,
+    canonical request body and Accept header. Bodies are stored gzipped.
+    Entries younger than ttl_seconds are served without a request, older ones
+    are revalidated with ETag / Last-Modified when the server sent them; with
+    the default ttl of 0 every use is revalidated. The
+    least recently used entries are evicted once the cache is over max_bytes."""
+
+    def __init__(self, cache_dir=None, ttl_seconds=DEFAULT_TTL_SECONDS, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = Path(cache_dir) if cache_dir else default_cache_dir()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.enabled = True
+
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(method, url, body=None, accept=None):
+        h = hashlib.sha256()
+        for part in (method.upper().encode('utf-8'), url.encode('utf-8'), canonical_body(body), (accept or '').lower().encode('utf-8')):
+            h.update(part)
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def meta_path(self, key):
+        return self.cache_dir.joinpath(f'{key}.json')
+
+    def body_path(self, key):
+        return self.cache_dir.joinpath(f'{key}.gz')
+
+    def temp_path(self, key):
+        return self.cache_dir.joinpath(f'{key}.{os.getpid()}.{threading.get_ident()}.tmp')
+
+    def lookup(self, key):
+        try:
+            with open(self.meta_path(key), encoding='utf-8') as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+
+        if not self.body_path(key).exists():
+            return None
+        return meta
+
+    def is_fresh(self, meta):
+        return time.time() - meta['stored_at'] < self.ttl_seconds
+
+    def validators(self, meta):
+        headers = {}
+        if meta['headers'].get('ETag'):
+            headers['If-None-Match'] = meta['headers']['ETag']
+        if meta['headers'].get('Last-Modified'):
+            headers['If-Modified-Since'] = meta['headers']['Last-Modified']
+        return headers
+
+    def response(self, key, meta):
+        # a requests Response served from disk
+        response = requests.Response()
+        response.status_code = meta['status']
+        response.url = meta['url']
+        response.headers = CaseInsensitiveDict(meta['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = CachedBody(self.body_path(key))
+        response.from_cache = True
+
+        # last access time drives eviction
+        os.utime(str(self.meta_path(key)), None)
+        return response
+
+    def new_meta(self, method, response):
+        headers = {h: response.headers[h] for h in CACHED_HEADERS if h in response.headers}
+        return {
+            'method': method,
+            'url': response.url,
+            'status': response.status_code,
+            'headers': headers,
+            'stored_at': time.time()
+        }
+
+    def store(self, key, meta, content):
+        tmp_path = self.temp_path(key)
+        with gzip.open(str(tmp_path), 'wb') as fp:
+            fp.write(content)
+        self.commit(key, meta, tmp_path)
+
+    def commit(self, key, meta, tmp_path):
+        os.replace(str(tmp_path), str(self.body_path(key)))
+        self.write_meta(key, meta)
+        self.prune()
+
+    def write_meta(self, key, meta):
+        tmp_path = self.temp_path(key)
+        with open(tmp_path, 'w', encoding='utf-8') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(str(tmp_path), str(self.meta_path(key)))
+
+    def refresh(self, key, meta):
+        # the server said the cached body is still current (304)
+        meta['stored_at'] = time.time()
+        self.write_meta(key, meta)
+
+    def cache_response(self, key, method, response, stream=False):
+        meta = self.new_meta(method, response)
+        if stream:
+            response.raw = CachingBody(response.raw, self, key, meta)
+        else:
+            self.store(key, meta, response.content)
+        return response
+
+    def prune(self):
+        entries = []
+        total = 0
+        now = time.time()
+        with self._lock:
+            for meta_path in self.cache_dir.glob('*.json'):
+                key = meta_path.stem
+                try:
+                    size = self.body_path(key).stat().st_size
+                    accessed = meta_path.stat().st_mtime
+                    with open(meta_path, encoding='utf-8') as meta_file:
+                        meta = json.load(meta_file)
+                except (OSError, ValueError):
+                    continue
+
+                # expired entries that cannot be revalidated are never used again
+                if now - meta['stored_at'] >= self.ttl_seconds and not self.validators(meta):
+                    self.remove(key)
+                    continue
+
+                entries.append((accessed, key, size))
+                total = total + size
+
+            for accessed, key, size in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                self.remove(key)
+                total = total - size
+
+    def remove(self, key):
+        for path in (self.meta_path(key), self.body_path(key)):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def reset_counts(self):
+        with self._lock:
+            self.hits = 0
+            self.revalidated = 0
+            self.misses = 0
+
+    def summary(self):
+        return f'HTTP cache :: {self.hits + self.revalidated} hits ({self.revalidated} revalidated), {self.misses} misses'
@@ -0,0 +1,136 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from http_cache import ResponseCache
+
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 300
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 1
+DEFAULT_POOL_SIZE = 10
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+def build_retry(retries, backoff_factor):
+    # the PxWeb POST is a read-only query, so it is retried like a GET
+    retry_args = {
+        'total': retries,
+        'connect': retries,
+        'read': retries,
+        'status': retries,
+        'backoff_factor': backoff_factor,
+        'status_forcelist': RETRY_STATUS_CODES,
+        'raise_on_status': False
+    }
+    try:
+        return Retry(allowed_methods=frozenset(['GET', 'POST']), **retry_args)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=frozenset(['GET', 'POST']), **retry_args)
+
+class HttpClient(object):
+
+    """requests Session shared by the SDMX and PxWeb tools and validators.
+    Connections are pooled and kept alive, responses are gzip/deflate encoded,
+    every request has connect/read timeouts and is retried with exponential
+    backoff on 5xx responses and dropped connections. The time of each request
+    is recorded so slow endpoints show up in the tool messages. With a cache,
+    GET and POST responses are served from / saved to disk."""
+
+    def __init__(self, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT, retries=DEFAULT_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR, pool_size=DEFAULT_POOL_SIZE, cache=None):
+        self.timeout = (connect_timeout, read_timeout)
+        self.cache = cache
+        self.timings = []
+        self._lock = threading.Lock()
+
+        adapter = HTTPAdapter(max_retries=build_retry(retries, backoff_factor), pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+
+        started = time.perf_counter()
+        status = None
+        try:
+            if self.cache is not None and self.cache.enabled and method in ('GET', 'POST'):
+                response = self._cached_request(method, url, kwargs)
+            else:
+                response = self.session.request(method, url, **kwargs)
+            status = response.status_code
+            if getattr(response, 'from_cache', False):
+                status = f'{status} cached'
+            return response
+        finally:
+            # for streamed responses this is the time to the headers, the body is read later
+            with self._lock:
+                self.timings.append((method, url, status, time.perf_counter() - started))
+
+    def _cached_request(self, method, url, kwargs):
+        headers = kwargs.get('headers') or {}
+        accept = next((v for k, v in headers.items() if k.lower() == 'accept'), None)
+        body = kwargs.get('json', kwargs.get('data'))
+        key = self.cache.cache_key(method, url, body, accept)
+
+        meta = self.cache.lookup(key)
+        if meta is not None and self.cache.is_fresh(meta):
+            self.cache.count('hits')
+            return self.cache.response(key, meta)
+
+        if meta is not None:
+            # stale entry, ask the server whether it changed
+            kwargs = dict(kwargs)
+            kwargs['headers'] = dict(headers, **self.cache.validators(meta))
+
+        response = self.session.request(method, url, **kwargs)
+        if meta is not None and response.status_code == 304:
+            response.close()
+            self.cache.refresh(key, meta)
+            self.cache.count('revalidated')
+            return self.cache.response(key, meta)
+
+        self.cache.count('misses')
+        if response.status_code == 200:
+            return self.cache.cache_response(key, method, response, kwargs.get('stream', False))
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def timing_summary(self, slowest=5):
+        # one line for the totals and one per slowest request
+        with self._lock:
+            timings = list(self.timings)
+        if not timings:
+            return []
+
+        total = sum(t[3] for t in timings)
+        lines = [f'HTTP :: {len(timings)} requests in {total:.2f}s']
+        if self.cache is not None and self.cache.enabled:
+            lines.append(self.cache.summary())
+        for method, url, status, elapsed in sorted(timings, key=lambda t: t[3], reverse=True)[:slowest]:
+            lines.append(f'HTTP :: {elapsed:.2f}s {method} {url} ({status})')
+        return lines
+
+    def clear_timings(self):
+        with self._lock:
+            self.timings = []
+        if self.cache is not None:
+            self.cache.reset_counts()
+
+_client = None
+
+def get_client():
+    # one client per process, so the pool (and its open connections) outlives a single tool run
+    global _client
+    if _client is None:
+        _client = HttpClient(cache=ResponseCache())
+    return _client
@@ -0,0 +1,137 @@
+class JoinKeyTransform(object):
+
+    """The find / replace rules of the tools' transform value table, compiled
+    once. Each rule either removes its find value from the key, or wraps the key
+    in a prefix and/or suffix. Results are memoized per key, and when every rule
+    is a wrap the transform can be undone to key the geography index instead."""
+
+    def __init__(self, rules):
+        self.rules = [(find_val, rep_val) for find_val, rep_val in rules]
+
+        # ('remove', find) or ('wrap', prefix, suffix), in rule order, same reading as the old per-row loop
+        steps = []
+        for find_val, rep_val in self.rules:
+            if find_val and rep_val == 'None':
+                steps.append(('remove', find_val))
+            elif find_val and rep_val == '':
+                steps.append(('wrap', find_val, ''))
+            elif find_val == '' and rep_val:
+                steps.append(('wrap', '', rep_val))
+            elif find_val and rep_val:
+                steps.append(('wrap', find_val, rep_val))
+
+        # neighbouring wraps fold into one
+        self.steps = []
+        for step in steps:
+            if step[0] == 'wrap' and self.steps and self.steps[-1][0] == 'wrap':
+                last = self.steps.pop()
+                step = ('wrap', step[1] + last[1], last[2] + step[2])
+            self.steps.append(step)
+
+        self._memo = {}
+
+    @classmethod
+    def from_value_table(cls, value_table):
+        return cls([(value_table.getValue(i, 0), value_table.getValue(i, 1)) for i in range(0, value_table.rowCount)])
+
+    def __bool__(self):
+        return len(self.steps) > 0
+
+    @property
+    def reversible(self):
+        # removing a value cannot be undone, a wrap can
+        return all(step[0] == 'wrap' for step in self.steps)
+
+    def apply(self, key):
+        for step in self.steps:
+            if step[0] == 'remove':
+                key = key.replace(step[1], '')
+            else:
+                key = f'{step[1]}{key}{step[2]}'
+        return key
+
+    def __call__(self, key):
+        if key is None:
+            return None
+        key = str(key)
+        if key not in self._memo:
+            self._memo[key] = self.apply(key)
+        return self._memo[key]
+
+    def reverse(self, key):
+        # the key that transforms into this one, None when no key can
+        if key is None:
+            return None
+        key = str(key)
+        for step in reversed(self.steps):
+            prefix, suffix = step[1], step[2]
+            if len(key) < len(prefix) + len(suffix) or not key.startswith(prefix) or not key.endswith(suffix):
+                return None
+            key = key[len(prefix):len(key) - len(suffix)]
+        return key
+
+class KeyNormalizer(object):
+
+    """Normalization applied to join keys on both sides of the join: trim,
+    case-fold, numeric coercion ('005', '5.0' and 5 all become '5') and
+    zero-padding of all-digit keys. Results are memoized per key."""
+
+    OPTIONS = ('trim', 'casefold', 'numeric', 'pad')
+
+    def __init__(self, trim=False, casefold=False, numeric=False, pad=0):
+        self.trim = trim
+        self.casefold = casefold
+        self.numeric = numeric
+        self.pad = int(pad or 0)
+        self._memo = {}
+
+    @classmethod
+    def from_text(cls, text):
+        # 'trim, casefold, numeric, pad=5' as typed into the tool parameter
+        kwargs = {}
+        for option in (text or '').split(','):
+            name, _, value = option.strip().partition('=')
+            name = name.strip().lower()
+            if not name:
+                continue
+            if name not in cls.OPTIONS:
+                raise ValueError(f'Unknown join key normalization \'{name}\', use {", ".join(cls.OPTIONS)}')
+            if name == 'pad':
+                try:
+                    kwargs['pad'] = int(value)
+                except ValueError:
+                    raise ValueError(f'Join key normalization pad needs a width, e.g. pad=5, got \'{option.strip()}\'')
+            else:
+                kwargs[name] = True
+        return cls(**kwargs)
+
+    def settings(self):
+        return {'trim': self.trim, 'casefold': self.casefold, 'numeric': self.numeric, 'pad': self.pad}
+
+    def __bool__(self):
+        return self.trim or self.casefold or self.numeric or self.pad > 0
+
+    def apply(self, key):
+        if self.trim:
+            key = key.strip()
+        if self.casefold:
+            key = key.casefold()
+        if self.numeric:
+            try:
+                number = float(key)
+                if number.is_integer():
+                    key = str(int(number))
+                else:
+                    key = repr(number)
+            except (ValueError, OverflowError):
+                pass
+        if self.pad > 0 and key.isdigit():
+            key = key.zfill(self.pad)
+        return key
+
+    def __call__(self, key):
+        if key is None:
+            return None
+        if key not in self._memo:
+            self._memo[key] = self.apply(key)
+        return self._memo[key]
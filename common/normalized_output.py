@@ -0,0 +1,99 @@
+import os
+
+import arcpy
+
+from feature_writer import FeatureWriter
+
+OUTPUT_LAYOUTS = ('FLAT', 'NORMALIZED', 'WIDE')
+
+def get_output_layout(text, layouts=OUTPUT_LAYOUTS):
+    # not every tool supports every layout, WIDE needs the observations in memory to pivot them
+    layout = (text or 'FLAT').strip().upper()
+    if layout not in layouts:
+        raise ValueError(f'Unknown output layout \'{text}\', use {", ".join(layouts)}')
+    return layout
+
+def create_stats_table(out_workspace, output_name, fields):
+    # non-spatial table holding every observation of a normalized output
+    table_name = arcpy.ValidateTableName(f'{output_name}_stats', out_workspace)
+    table_path = os.path.join(out_workspace, table_name)
+    if arcpy.Exists(table_path):
+        arcpy.Delete_management(table_path)
+
+    arcpy.CreateTable_management(out_workspace, table_name)
+    arcpy.AddFields_management(table_path, fields)
+    return table_path
+
+def create_relationship_class(out_fc, stats_table, key_field):
+    # one feature to many observations on the join key. only geodatabases have relationship classes
+    out_workspace = os.path.dirname(out_fc)
+    if arcpy.Describe(out_workspace).workspaceType == 'FileSystem':
+        return None
+
+    rel_name = arcpy.ValidateTableName(f'{os.path.basename(out_fc)}_rel', out_workspace)
+    rel_path = os.path.join(out_workspace, rel_name)
+    if arcpy.Exists(rel_path):
+        arcpy.Delete_management(rel_path)
+
+    arcpy.CreateRelationshipClass_management(
+        out_fc, stats_table, rel_path, 'SIMPLE',
+        os.path.basename(stats_table), os.path.basename(out_fc),
+        'NONE', 'ONE_TO_MANY', 'NONE', key_field, key_field
+    )
+    return rel_path
+
+class NormalizedOutputWriter(object):
+
+    """Takes the same (geometry, attributes...) rows as a FeatureWriter but
+    writes each geometry once per join key to the output feature class, with
+    only the key field, and every row without its geometry to a stats table."""
+
+    def __init__(self, out_fc, stats_table, fields, key_field, on_error=None):
+        self.fields = list(fields)
+        self.shape_idx = self.fields.index('SHAPE@')
+        self.key_idx = self.fields.index(key_field)
+        self.stats_idxs = [i for i in range(len(self.fields)) if i != self.shape_idx]
+
+        self.geometry_writer = FeatureWriter(out_fc, ['SHAPE@', key_field], on_error=on_error)
+        self.stats_writer = FeatureWriter(stats_table, [self.fields[i] for i in self.stats_idxs], on_error=on_error)
+
+        self._keys = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def write(self, row):
+        key = row[self.key_idx]
+        geom = row[self.shape_idx]
+        # a key with no geometry only lives in the stats table
+        if geom is not None and key not in self._keys:
+            self._keys.add(key)
+            self.geometry_writer.write((geom, key))
+
+        self.stats_writer.write(tuple(row[i] for i in self.stats_idxs))
+
+    def close(self):
+        try:
+            self.geometry_writer.close()
+        finally:
+            self.stats_writer.close()
+
+    @property
+    def features_written(self):
+        return self.geometry_writer.rows_written
+
+    @property
+    def rows_written(self):
+        return self.stats_writer.rows_written
+
+    @property
+    def errors(self):
+        return self.geometry_writer.errors + self.stats_writer.errors
+
+    @property
+    def error_count(self):
+        return len(self.errors)
@@ -0,0 +1,75 @@
+import arcpy
+import pandas as pd
+
+WIDE_VALUE_PREFIX = 'V'
+MAX_FIELD_NAME_LENGTH = 64
+MAX_ALIAS_LENGTH = 255
+
+def is_constant(series):
+    return series.nunique(dropna=False) <= 1
+
+def unique_field_name(name, out_workspace, used):
+    name = arcpy.ValidateFieldName(name[:MAX_FIELD_NAME_LENGTH], out_workspace)
+    unique_name = name
+    n = 2
+    while unique_name.upper() in used:
+        suffix = f'_{n}'
+        unique_name = f'{name[:MAX_FIELD_NAME_LENGTH - len(suffix)]}{suffix}'
+        n = n + 1
+    used.add(unique_name.upper())
+    return unique_name
+
+def text_field_length(series):
+    lengths = series.dropna().astype(str).str.len()
+    return max(int(lengths.max()) if len(lengths) > 0 else 1, 1)
+
+def pivot_wide(frame, index_columns, pivot_columns, value_column, out_workspace, other_columns=()):
+    # one row per index value (the area) and one value column per combination of the pivot
+    # columns that vary, named from their codes and aliased with their labels. pivot and other
+    # columns holding a single value are carried over as they are, varying other columns are dropped.
+    # returns (wide frame, [source column, name, type, alias, length] field definitions, dropped columns)
+    varying = [(code, label) for code, label in pivot_columns if not is_constant(frame[code])]
+    constant = []
+    for code, label in pivot_columns:
+        if (code, label) not in varying:
+            constant = constant + [c for c in (code, label) if c not in constant]
+    constant = constant + [c for c in other_columns if is_constant(frame[c])]
+    dropped = [c for c in other_columns if c not in constant]
+
+    code_columns = [code for code, _ in varying]
+    label_columns = [label for _, label in varying]
+    values = pd.to_numeric(frame[value_column], errors='coerce')
+
+    used = set()
+    field_defs = []
+    for col in list(index_columns) + constant:
+        field_defs.append([col, unique_field_name(col, out_workspace, used), 'TEXT', col, text_field_length(frame[col])])
+
+    if varying:
+        # a single group and unstack instead of a filter per column
+        wide = values.groupby([frame[c] for c in list(index_columns) + code_columns], observed=True).first().unstack(code_columns)
+        labels = frame.drop_duplicates(code_columns).set_index(code_columns)[label_columns]
+
+        value_names = []
+        for col in wide.columns:
+            codes = col if isinstance(col, tuple) else (col,)
+            alias = ', '.join(str(v) for v in labels.loc[col].values)
+            name = unique_field_name(f'{WIDE_VALUE_PREFIX}_{"_".join(str(c) for c in codes)}', out_workspace, used)
+            value_names.append(name)
+            field_defs.append([name, name, 'DOUBLE', alias[:MAX_ALIAS_LENGTH], 8])
+        wide.columns = value_names
+    else:
+        wide = values.groupby([frame[c] for c in index_columns], observed=True).first().to_frame(value_column)
+        field_defs.append([value_column, unique_field_name(value_column, out_workspace, used), 'DOUBLE', value_column, 8])
+
+    wide = wide.reset_index()
+    for col in constant:
+        wide[col] = frame[col].iloc[0] if len(frame) > 0 else None
+
+    wide = wide[[f[0] for f in field_defs]]
+    return wide, field_defs, dropped
+
+def iter_wide_rows(wide):
+    # missing cells are written as null
+    wide = wide.astype(object).where(wide.notna(), None)
+    return wide.itertuples(index=False, name=None)
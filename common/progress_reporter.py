@@ -0,0 +1,101 @@
+import time
+import arcpy
+
+DEFAULT_INTERVAL_SECONDS = 0.5
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    hours, rem = divmod(seconds, 3600)
+    minutes, seconds = divmod(rem, 60)
+    if hours:
+        return f'{hours}:{minutes:02d}:{seconds:02d}'
+    return f'{minutes}:{seconds:02d}'
+
+def set_progressor(label, headless=False):
+    # a stage without rows to count only gets its label, in headless mode nothing is emitted
+    if not headless:
+        arcpy.SetProgressor('default', label)
+
+def reset_progressor(headless=False):
+    if not headless:
+        arcpy.ResetProgressor()
+
+class ProgressReporter(object):
+
+    """Progressor updates for one stage of a tool (fetch, parse, CSV, table
+    conversion, insert). The progressor is only touched every interval_seconds
+    and/or every interval_rows rows, and the label carries rows/sec and an ETA.
+    In headless mode nothing is emitted."""
+
+    def __init__(self, stage, total=None, row_label=None, interval_seconds=DEFAULT_INTERVAL_SECONDS, interval_rows=None, headless=False):
+        self.stage = stage
+        self.total = total
+        self.row_label = row_label or 'Row'
+        self.interval_seconds = interval_seconds
+        self.interval_rows = interval_rows
+        self.headless = headless
+
+        self.count = 0
+        self._last_count = 0
+        self._started = time.perf_counter()
+        self._last_emit = self._started
+
+        if not self.headless:
+            if self.total:
+                arcpy.SetProgressor('step', f'{self.stage} ...', 0, self.total, 1)
+            else:
+                arcpy.SetProgressor('default', f'{self.stage} ...')
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self._started
+
+    @property
+    def rate(self):
+        elapsed = self.elapsed
+        if elapsed <= 0:
+            return 0.0
+        return self.count / elapsed
+
+    def label(self):
+        rate = self.rate
+        if self.total:
+            label = f'{self.row_label} {self.count} of {self.total} ... {rate:,.0f} rows/sec'
+            if rate > 0 and self.count < self.total:
+                label = f'{label}, ETA {format_duration((self.total - self.count) / rate)}'
+            return label
+        return f'{self.stage} ... {self.count} rows, {rate:,.0f} rows/sec'
+
+    def update(self, step=1):
+        self.count = self.count + step
+        if self.headless:
+            return
+
+        due = False
+        if self.interval_rows and self.count - self._last_count >= self.interval_rows:
+            due = True
+        elif self.interval_seconds is not None:
+            now = time.perf_counter()
+            if now - self._last_emit >= self.interval_seconds:
+                due = True
+
+        if due:
+            self._emit()
+
+    def _emit(self):
+        self._last_count = self.count
+        self._last_emit = time.perf_counter()
+        if self.total:
+            arcpy.SetProgressorPosition(min(self.count, self.total))
+        arcpy.SetProgressorLabel(self.label())
+
+    def finish(self):
+        # leave the progressor where the per-row updates used to leave it
+        if self.headless:
+            return
+
+        if self.count:
+            self._emit()
+            arcpy.AddMessage(f'{self.stage} :: {self.count} rows in {format_duration(self.elapsed)} ({self.rate:,.0f} rows/sec)')
+        else:
+            arcpy.AddMessage(f'{self.stage} :: completed in {format_duration(self.elapsed)}')
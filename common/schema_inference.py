@@ -0,0 +1,205 @@
+import re
+from datetime import datetime
+
+import arcpy
+import pandas as pd
+
+# tables up to this many rows are scanned in full, larger ones are sampled and their types widened
+DEFAULT_SAMPLE_SIZE = 1000000
+
+SHORT_RANGE = (-2 ** 15, 2 ** 15 - 1)
+LONG_RANGE = (-2 ** 31, 2 ** 31 - 1)
+
+# names of fields holding periods even when they are plain years
+DEFAULT_PERIOD_FIELDS = ('TIME_PERIOD', 'TIME_PERIOD_CODE', 'TIME', 'PERIOD', 'YEAR')
+
+# periods with a month, quarter or day are recognised in any field, plain years only in period fields
+PERIOD_PATTERNS = (
+    (re.compile(r'^(\d{4})-(\d{2})-(\d{2})$'), lambda m: (int(m.group(1)), int(m.group(2)), int(m.group(3)))),
+    (re.compile(r'^(\d{4})-?M?(\d{2})$'), lambda m: (int(m.group(1)), int(m.group(2)), 1)),
+    (re.compile(r'^(\d{4})-?[QK]([1-4])$'), lambda m: (int(m.group(1)), int(m.group(2)) * 3 - 2, 1)),
+)
+YEAR_PATTERN = re.compile(r'^(\d{4})$')
+
+# names of fields holding measured values, they stay DOUBLE even when every value is a whole number
+DEFAULT_MEASURE_FIELDS = ('OBS_VALUE', 'VALUE')
+
+NUMERIC_SOURCE_TYPES = ('SmallInteger', 'Integer', 'BigInteger', 'Single', 'Double', 'OID')
+INTEGER_SOURCE_TYPES = ('SmallInteger', 'Integer', 'BigInteger', 'OID')
+DECIMAL_SOURCE_TYPES = ('Single', 'Double')
+
+def parse_period(value, years=False):
+    # datetime at the start of the period, None when the value is not a period
+    text = str(value).strip()
+    patterns = PERIOD_PATTERNS + ((YEAR_PATTERN, lambda m: (int(m.group(1)), 1, 1)),) if years else PERIOD_PATTERNS
+    for pattern, parts in patterns:
+        match = pattern.match(text)
+        if match:
+            try:
+                return datetime(*parts(match))
+            except ValueError:
+                return None
+    return None
+
+def integer_type(numbers):
+    low, high = numbers.min(), numbers.max()
+    if SHORT_RANGE[0] <= low and high <= SHORT_RANGE[1]:
+        return 'SHORT'
+    if LONG_RANGE[0] <= low and high <= LONG_RANGE[1]:
+        return 'LONG'
+    return None
+
+def to_int(value):
+    # a value with a fraction does not fit an integer field, it is a conversion error rather than truncated
+    number = float(value)
+    if number % 1 != 0:
+        raise ValueError(f'{value} is not a whole number')
+    return int(number)
+
+class PeriodConverter(object):
+
+    """Turns period codes into dates, once per distinct code."""
+
+    def __init__(self, years):
+        self.years = years
+        self._memo = {}
+
+    def __call__(self, value):
+        if value not in self._memo:
+            self._memo[value] = parse_period(value, self.years)
+        return self._memo[value]
+
+def infer_column(values, source_type, period_field=False, keep_text=False, measure_field=False):
+    # (field type, length, converter or None) for the non-empty values of one column
+    values = values[values.notna()]
+    if source_type not in NUMERIC_SOURCE_TYPES:
+        values = values[values.astype(str) != '']
+
+    if source_type == 'Date':
+        return 'DATE', None, None
+    # decimals stay decimals, a sample of whole numbers says nothing about the rows after it
+    if source_type in DECIMAL_SOURCE_TYPES:
+        return 'DOUBLE', None, None
+    if len(values) == 0:
+        return ('DOUBLE', None, None) if source_type in NUMERIC_SOURCE_TYPES else ('TEXT', 1, None)
+
+    text = values.astype(str).str.strip()
+    if source_type in NUMERIC_SOURCE_TYPES:
+        numbers = values.astype(float)
+    elif keep_text or text.str.match(r'^[-+]?0[0-9]').any():
+        # leading zeros make a code, not a number
+        numbers = None
+    else:
+        numbers = pd.to_numeric(text, errors='coerce')
+        if numbers.isna().any():
+            numbers = None
+
+    # a period field that only holds years is still a period
+    if period_field or numbers is None:
+        if all(parse_period(v, period_field) is not None for v in text.drop_duplicates()):
+            return 'DATE', None, PeriodConverter(period_field)
+
+    if numbers is not None:
+        if measure_field:
+            return 'DOUBLE', None, None if source_type in NUMERIC_SOURCE_TYPES else float
+        # '2.0' is written as a decimal even though it is whole
+        decimal_text = source_type not in NUMERIC_SOURCE_TYPES and text.str.contains(r'[.eE]').any()
+        if not decimal_text and (numbers % 1 == 0).all():
+            field_type = integer_type(numbers)
+            if field_type is not None:
+                return field_type, None, None if source_type in ('SmallInteger', 'Integer') else to_int
+        return 'DOUBLE', None, None if source_type in NUMERIC_SOURCE_TYPES else float
+
+    return 'TEXT', max(int(values.astype(str).str.len().max()), 1), None
+
+def widen(field_type, length, whole_numbers=False):
+    # a sample does not see every value, leave room for the ones it missed. unless the source
+    # field only holds whole numbers, a later row may have a fraction an integer field cannot hold
+    if field_type in ('SHORT', 'LONG') and not whole_numbers:
+        return 'DOUBLE', None
+    if field_type == 'SHORT':
+        return 'LONG', None
+    if field_type == 'TEXT':
+        return 'TEXT', max(length * 2, 255)
+    return field_type, length
+
+class TableSchema(object):
+
+    """Narrowest field types for the values of a table: SHORT / LONG / DOUBLE
+    instead of text or doubles holding whole numbers, DATE for period codes and
+    text fields sized to their longest value. Rows read from the table go
+    through convert_row so their values match the inferred types. Fields in
+    text_lengths are always text, at least as long as given, for values that
+    are replaced after conversion, e.g. codes by their labels."""
+
+    def __init__(self, fields, rows, sample_size=DEFAULT_SAMPLE_SIZE, period_fields=DEFAULT_PERIOD_FIELDS, text_fields=(), measure_fields=DEFAULT_MEASURE_FIELDS, text_lengths=None):
+        # fields are arcpy Field objects in row order, only the first sample_size rows are looked at
+        self.fields = list(fields)
+        self.names = [f.name for f in self.fields]
+        self.sampled = False
+        # values a sampled type could not hold, written as null
+        self.conversion_errors = 0
+
+        sample = []
+        for row in rows:
+            if len(sample) == sample_size:
+                self.sampled = True
+                break
+            sample.append(row)
+        frame = pd.DataFrame.from_records(sample, columns=self.names)
+
+        period_names = set(n.upper() for n in period_fields)
+        text_names = set(n.upper() for n in text_fields)
+        measure_names = set(n.upper() for n in measure_fields)
+        text_lengths = {n.upper(): length for n, length in (text_lengths or {}).items()}
+        self.field_defs = []
+        self.converters = []
+        for f in self.fields:
+            if f.required:
+                self.converters.append(None)
+                continue
+
+            if f.name.upper() in text_lengths:
+                values = frame[f.name][frame[f.name].notna()].astype(str)
+                field_type, length, converter = 'TEXT', max([text_lengths[f.name.upper()]] + list(values.str.len())), str
+            else:
+                field_type, length, converter = infer_column(frame[f.name], f.type, f.name.upper() in period_names, f.name.upper() in text_names, f.name.upper() in measure_names)
+            if self.sampled:
+                field_type, length = widen(field_type, length, f.type in INTEGER_SOURCE_TYPES)
+                if field_type == 'DOUBLE' and converter is to_int:
+                    converter = float
+            self.field_defs.append([f.name, field_type, f.aliasName, length])
+            self.converters.append(converter)
+
+        self._converting = [(i, c) for i, c in enumerate(self.converters) if c is not None]
+
+    @classmethod
+    def from_table(cls, in_table, sample_size=DEFAULT_SAMPLE_SIZE, period_fields=DEFAULT_PERIOD_FIELDS, text_fields=(), measure_fields=DEFAULT_MEASURE_FIELDS, text_lengths=None):
+        fields = arcpy.ListFields(in_table)
+        with arcpy.da.SearchCursor(in_table, [f.name for f in fields]) as cursor:
+            return cls(fields, cursor, sample_size, period_fields, text_fields, measure_fields, text_lengths)
+
+    def field_definitions(self):
+        # [name, type, alias, length] for AddFields
+        return [list(f) for f in self.field_defs]
+
+    def convert_row(self, row):
+        if not self._converting:
+            return row
+        row = list(row)
+        for i, converter in self._converting:
+            value = row[i]
+            if value is None or value == '':
+                row[i] = None
+                continue
+            try:
+                row[i] = converter(value)
+            except (TypeError, ValueError, OverflowError):
+                row[i] = None
+            if row[i] is None:
+                self.conversion_errors = self.conversion_errors + 1
+        return tuple(row)
+
+    def convert_rows(self, rows):
+        for row in rows:
+            yield self.convert_row(row)
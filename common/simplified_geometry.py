@@ -0,0 +1,81 @@
+import re
+import tempfile
+from pathlib import Path
+
+import arcpy
+
+from geometry_index import GeometryIndex
+from geometry_index_cache import GeometryIndexCache, DEFAULT_MAX_BYTES
+
+SIMPLIFY_ALGORITHM = 'POINT_REMOVE'
+
+def default_cache_dir():
+    return Path(tempfile.gettempdir()).joinpath('sdmx_pxweb2arcgis', 'geometry_cache')
+
+def parse_tolerance(text):
+    # '250 Meters', '0.01 DecimalDegrees' or a bare number in the units of the Geography layer. None when empty
+    text = (text or '').strip()
+    if not text:
+        return None
+    match = re.match(r'^([0-9]*\.?[0-9]+)\s*([A-Za-z]*)$', text)
+    if match is None or float(match.group(1)) <= 0:
+        raise ValueError(f'Simplify tolerance needs a positive distance, e.g. 250 Meters, got \'{text}\'')
+    number = float(match.group(1))
+    return f'{number:g} {match.group(2)}'.strip()
+
+def simplify_layer(geo_fl, tolerance, out_fc):
+    # the whole layer is simplified in one run so an edge shared by two areas is simplified once,
+    # and both neighbours keep the same border
+    shape_type = arcpy.Describe(geo_fl).shapeType
+    if shape_type == 'Polygon':
+        arcpy.cartography.SimplifyPolygon(geo_fl, out_fc, SIMPLIFY_ALGORITHM, tolerance, '0 Unknown', 'RESOLVE_ERRORS', 'NO_KEEP')
+    elif shape_type == 'Polyline':
+        arcpy.cartography.SimplifyLine(geo_fl, out_fc, SIMPLIFY_ALGORITHM, tolerance, 'RESOLVE_ERRORS', 'NO_KEEP')
+    else:
+        raise ValueError(f'{shape_type} geometries cannot be simplified')
+    return out_fc
+
+class SimplifiedGeometryCache(GeometryIndexCache):
+
+    """Simplified copies of the Geography layer kept on disk as saved
+    GeometryIndex files, one per layer version, join field, key rules,
+    tolerance and spatial reference. Each tolerance is its own entry, so runs
+    at several scales and every file of a batch reuse what was built before."""
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+        super(SimplifiedGeometryCache, self).__init__(cache_dir if cache_dir else default_cache_dir(), max_bytes)
+
+    def simplified_key(self, geom_index, tolerance, spatial_reference):
+        # None when the layer has no fingerprint, there is nothing to tell its versions apart
+        fingerprint = geom_index.fingerprint()
+        if fingerprint is None:
+            return None
+
+        parts = (fingerprint, geom_index.geo_field) + self.key_rules(geom_index.key_transform, geom_index.key_normalizer)
+        return self.hash_parts(parts + (tolerance, spatial_reference.exportToString() if spatial_reference else ''))
+
+    def simplified_index(self, geom_index, geo_fl, tolerance, on_miss=None):
+        # (index of simplified geometries, True when it came from the cache). keys whose area
+        # collapsed at this tolerance keep their full geometry rather than going missing
+        spatial_reference = arcpy.Describe(geo_fl).spatialReference
+        key = self.simplified_key(geom_index, tolerance, spatial_reference)
+        if key is not None:
+            index = self.load(key, on_miss)
+            if index is not None:
+                return index, True
+
+        out_fc = arcpy.CreateUniqueName('simplified_geo', arcpy.env.scratchGDB)
+        try:
+            simplify_layer(geo_fl, tolerance, out_fc)
+            index = GeometryIndex(out_fc, geom_index.geo_field, on_miss=on_miss, key_transform=geom_index.key_transform, key_normalizer=geom_index.key_normalizer)
+            if not index.preloaded:
+                raise RuntimeError('Unable to index the simplified geometries')
+            index.fill_missing(geom_index)
+
+            if key is not None:
+                self.store(key, index)
+        finally:
+            if arcpy.Exists(out_fc):
+                arcpy.Delete_management(out_fc)
+
+        return index, False
@@ -0,0 +1,24 @@
+import arcpy
+
+# optional parameters are appended to the end of a tool's parameter list. a toolbox that
+# has not been updated yet does not pass them, so fall back to the default instead of failing
+# (the index of every optional parameter is listed in the README)
+def get_optional_parameter(index, default=None):
+    if index >= arcpy.GetArgumentCount():
+        return default
+
+    value = arcpy.GetParameter(index)
+    if value is None or value == '':
+        return default
+
+    return value
+
+def get_optional_parameter_as_text(index, default=''):
+    if index >= arcpy.GetArgumentCount():
+        return default
+
+    value = arcpy.GetParameterAsText(index)
+    if not value:
+        return default
+
+    return value
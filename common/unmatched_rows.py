@@ -0,0 +1,61 @@
+import os
+
+import arcpy
+
+MISSING_KEY_FIELDS = [
+    ['SOURCE', 'TEXT', 'Source', 255],
+    ['JOIN_KEY', 'TEXT', 'Join Key', 255],
+    ['ROW_COUNT', 'LONG', 'Rows']
+]
+SUMMARY_TOP_KEYS = 10
+
+def create_unmatched_rows_table(out_workspace, output_name, fields):
+    # non-spatial table with the output's fields for rows that have no geometry, replaced on every run
+    table_name = arcpy.ValidateTableName(f'{output_name}_unmatched', out_workspace)
+    table_path = os.path.join(out_workspace, table_name)
+    if arcpy.Exists(table_path):
+        arcpy.Delete_management(table_path)
+
+    arcpy.CreateTable_management(out_workspace, table_name)
+    arcpy.AddFields_management(table_path, fields)
+    return table_path
+
+def get_missing_keys_table_path(out_workspace, output_name):
+    return os.path.join(out_workspace, arcpy.ValidateTableName(f'{output_name}_missing_keys', out_workspace))
+
+def sorted_miss_counts(miss_counts):
+    # most rows first
+    return sorted(miss_counts.items(), key=lambda kv: (-kv[1], str(kv[0])))
+
+def write_missing_keys_table(table_path, miss_counts, source):
+    # one row per join key without geometry. rows an earlier run wrote for the same source are replaced
+    if not miss_counts and not arcpy.Exists(table_path):
+        return None
+
+    if not arcpy.Exists(table_path):
+        out_workspace, table_name = os.path.split(table_path)
+        arcpy.CreateTable_management(out_workspace, table_name)
+        arcpy.AddFields_management(table_path, MISSING_KEY_FIELDS)
+
+    field_names = [f[0] for f in MISSING_KEY_FIELDS]
+    with arcpy.da.UpdateCursor(table_path, field_names) as cursor:
+        for row in cursor:
+            if row[0] == source:
+                cursor.deleteRow()
+
+    with arcpy.da.InsertCursor(table_path, field_names) as cursor:
+        for key, count in sorted_miss_counts(miss_counts):
+            cursor.insertRow([source, key, count])
+
+    return table_path
+
+def missing_keys_summary(miss_counts, top=SUMMARY_TOP_KEYS):
+    if not miss_counts:
+        return []
+
+    lines = [f'{sum(miss_counts.values())} rows with {len(miss_counts)} distinct join keys have no geometry in the Geography layer']
+    for key, count in sorted_miss_counts(miss_counts)[:top]:
+        lines.append(f'  {key} :: {count} rows')
+    if len(miss_counts) > top:
+        lines.append(f'  ... and {len(miss_counts) - top} more keys')
+    return lines
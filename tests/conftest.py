@@ -0,0 +1,15 @@
+import sys
+import types
+from pathlib import Path
+
+# the modules under test are imported the way the tool scripts import them, by folder
+ROOT = Path(__file__).resolve().parents[1]
+for folder in ('common', 'SDMX/sdmx2arcgis_scripts', 'PxWeb/pxweb2arcgis_scripts'):
+    sys.path.insert(0, str(ROOT.joinpath(folder)))
+
+# outside ArcGIS Pro there is no arcpy. the tested code paths do not call it, the
+# modules only need the import to succeed
+try:
+    import arcpy  # noqa: F401
+except ImportError:
+    sys.modules['arcpy'] = types.ModuleType('arcpy')
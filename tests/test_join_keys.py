@@ -0,0 +1,67 @@
+import pytest
+
+from join_keys import JoinKeyTransform, KeyNormalizer
+
+def test_wrap_rules_reverse():
+    transform = JoinKeyTransform([('PRE_', ''), ('', '_SUF')])
+    assert transform.reversible
+    assert transform('123') == 'PRE_123_SUF'
+    assert transform.reverse('PRE_123_SUF') == '123'
+    assert transform.reverse(transform('')) == ''
+
+def test_neighbouring_wraps_fold():
+    # a later prefix goes in front of the earlier one, a later suffix after it
+    transform = JoinKeyTransform([('A', 'B'), ('C', 'D')])
+    assert transform.steps == [('wrap', 'CA', 'BD')]
+    assert transform('x') == 'CAxBD'
+    assert transform.reverse('CAxBD') == 'x'
+
+def test_reverse_of_key_no_transform_makes():
+    transform = JoinKeyTransform([('PRE_', 'SUF')])
+    assert transform.reverse('123SUF') is None
+    assert transform.reverse('PRE_123') is None
+    assert transform.reverse('PRE_SU') is None
+    assert transform.reverse(None) is None
+
+def test_remove_rule_is_not_reversible():
+    transform = JoinKeyTransform([('-', 'None'), ('K', '')])
+    assert not transform.reversible
+    assert transform('1-2-3') == 'K123'
+
+def test_empty_transform():
+    transform = JoinKeyTransform([])
+    assert not transform
+    assert transform(5) == '5'
+
+@pytest.mark.parametrize('key, expected', [
+    ('005', '5'),
+    ('5.0', '5'),
+    ('5', '5'),
+    ('5.5', '5.5'),
+    ('1e3', '1000'),
+    ('AB1', 'AB1'),
+])
+def test_numeric(key, expected):
+    assert KeyNormalizer(numeric=True)(key) == expected
+
+def test_trim_casefold_pad():
+    normalizer = KeyNormalizer(trim=True, casefold=True, pad=5)
+    assert normalizer(' 42 ') == '00042'
+    assert normalizer('Ab ') == 'ab'
+    assert normalizer('123456') == '123456'
+    assert normalizer(None) is None
+
+def test_numeric_then_pad():
+    # numeric drops leading zeros, pad puts back the width the layer uses
+    normalizer = KeyNormalizer(numeric=True, pad=3)
+    assert normalizer('7.0') == normalizer('07') == normalizer('007') == '007'
+
+def test_from_text():
+    normalizer = KeyNormalizer.from_text(' trim, NUMERIC , pad=4')
+    assert normalizer.settings() == {'trim': True, 'casefold': False, 'numeric': True, 'pad': 4}
+    assert not KeyNormalizer.from_text('')
+
+@pytest.mark.parametrize('text', ['upper', 'pad', 'pad=x'])
+def test_from_text_errors(text):
+    with pytest.raises(ValueError):
+        KeyNormalizer.from_text(text)
@@ -0,0 +1,72 @@
+import itertools
+
+import numpy as np
+
+from pxweb_jsonstat import JsonStatCube, merge_datasets
+
+def dataset(regions=('R1', 'R2'), years=('2020', '2021', '2022'), contents=('POP', 'AREA')):
+    # json-stat 2.0 cube, region x year x contents with the last dimension varying fastest
+    cells = list(itertools.product(regions, years, contents))
+    return {
+        'class': 'dataset',
+        'label': 'Test table',
+        'id': ['Region', 'Year', 'ContentsCode'],
+        'size': [len(regions), len(years), len(contents)],
+        'role': {'time': ['Year'], 'metric': ['ContentsCode']},
+        'dimension': {
+            'Region': {'label': 'region', 'category': {'index': {r: i for i, r in enumerate(regions)}, 'label': {r: f'Region {r}' for r in regions}}},
+            'Year': {'label': 'year', 'category': {'index': list(years)}},
+            'ContentsCode': {'label': 'contents', 'category': {
+                'index': {c: i for i, c in enumerate(contents)},
+                'label': {'POP': 'Population', 'AREA': 'Area'},
+                'unit': {'POP': {'base': 'persons', 'decimals': 0}, 'AREA': {'base': 'km2', 'decimals': 1}}
+            }}
+        },
+        'value': [float(i) for i in range(len(cells))]
+    }
+
+def expected_rows(ds):
+    # nested loops in dimension order, the order the value array is stored in
+    regions = list(ds['dimension']['Region']['category']['index'].keys())
+    years = ds['dimension']['Year']['category']['index']
+    contents = list(ds['dimension']['ContentsCode']['category']['index'].keys())
+    return [(f'Region {r}', y, c) for r, y, c in itertools.product(regions, years, contents)]
+
+def test_category_positions_follow_value_order():
+    cube = JsonStatCube(dataset())
+    assert list(cube.category_positions(cube.dimensions[0])) == [0] * 6 + [1] * 6
+    assert list(cube.category_positions(cube.dimensions[1])) == [0, 0, 1, 1, 2, 2] * 2
+    assert list(cube.category_positions(cube.dimensions[2])) == [0, 1] * 6
+
+def test_data_frame_rows_match_cells():
+    ds = dataset()
+    frame = JsonStatCube(ds).to_data_frame('contents')
+    labels = {'POP': 'Population', 'AREA': 'Area'}
+    expected = [(r, y, labels[c]) for r, y, c in expected_rows(ds)]
+    assert list(zip(frame['region'].astype(str), frame['year'].astype(str), frame['contents'].astype(str))) == expected
+    assert list(frame['Value']) == ds['value']
+    assert list(frame['contents_Code'].astype(str)) == [c for _, _, c in expected_rows(ds)]
+    assert list(frame['UNITS'].astype(str)) == ['PERSONS', 'KM2'] * 6
+    assert list(frame['DECIMALS']) == [0, 1] * 6
+
+def test_sparse_values():
+    ds = dataset()
+    ds['value'] = {'1': 5, '10': 7.5}
+    values = JsonStatCube(ds).to_data_frame()['Value'].to_numpy()
+    assert values[1] == 5 and values[10] == 7.5
+    assert np.isnan(np.delete(values, [1, 10])).all()
+
+def test_merge_split_query():
+    # a query split on years comes back as one cube in the order of the full query
+    whole = dataset()
+    first = dataset(years=('2022',))
+    second = dataset(years=('2020', '2021'))
+    cells = {cell: v for cell, v in zip(itertools.product(('R1', 'R2'), ('2020', '2021', '2022'), ('POP', 'AREA')), whole['value'])}
+    for ds in (first, second):
+        years = ds['dimension']['Year']['category']['index']
+        ds['value'] = [cells[cell] for cell in itertools.product(('R1', 'R2'), years, ('POP', 'AREA'))]
+
+    merged = merge_datasets([first, second], {'Year': {'2020': 0, '2021': 1, '2022': 2}})
+    assert merged['size'] == whole['size']
+    assert merged['value'] == whole['value']
+    assert list(JsonStatCube(merged).to_data_frame()['Value']) == whole['value']
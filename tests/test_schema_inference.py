@@ -0,0 +1,76 @@
+from datetime import datetime
+
+import pytest
+
+from schema_inference import LONG_RANGE, SHORT_RANGE, TableSchema
+
+class Field(object):
+
+    """The parts of an arcpy Field the schema reads."""
+
+    def __init__(self, name, field_type='String', required=False):
+        self.name = name
+        self.type = field_type
+        self.aliasName = name
+        self.required = required
+
+def field_type(values, source_type='String', name='VALUE_FIELD', sample_size=1000):
+    schema = TableSchema([Field(name, source_type)], [(v,) for v in values], sample_size=sample_size)
+    return schema.field_definitions()[0][1:4:2]
+
+@pytest.mark.parametrize('values, expected', [
+    ([SHORT_RANGE[0], SHORT_RANGE[1]], 'SHORT'),
+    ([SHORT_RANGE[0] - 1, 0], 'LONG'),
+    ([0, SHORT_RANGE[1] + 1], 'LONG'),
+    ([LONG_RANGE[0], LONG_RANGE[1]], 'LONG'),
+    ([LONG_RANGE[0] - 1, 0], 'DOUBLE'),
+    ([0, LONG_RANGE[1] + 1], 'DOUBLE'),
+])
+def test_integer_edges(values, expected):
+    assert field_type([str(v) for v in values])[0] == expected
+    assert field_type(values, 'Double')[0] == 'DOUBLE'
+    assert field_type(values, 'BigInteger')[0] == expected
+
+def test_text_numbers():
+    assert field_type(['1', '2.0'])[0] == 'DOUBLE'
+    assert field_type(['1', '2.5'])[0] == 'DOUBLE'
+    assert field_type(['007', '8']) == ['TEXT', 3]
+    assert field_type(['1', 'x']) == ['TEXT', 1]
+
+def test_measure_fields_stay_double():
+    assert field_type(['1', '2'], name='OBS_VALUE')[0] == 'DOUBLE'
+
+def test_periods():
+    schema = TableSchema([Field('TIME_PERIOD'), Field('CODE')], [('2020', '2020-Q2'), ('2021', '2021-Q3')])
+    assert [d[1] for d in schema.field_definitions()] == ['DATE', 'DATE']
+    assert list(schema.convert_rows([('2020', '2020-Q2')])) == [(datetime(2020, 1, 1), datetime(2020, 4, 1))]
+
+@pytest.mark.parametrize('values, expected', [
+    (['1', '2'], 'DOUBLE'),
+    (['1', str(SHORT_RANGE[1] + 1)], 'DOUBLE'),
+])
+def test_sampled_text_widens_to_double(values, expected):
+    # a sample of whole numbers does not rule out a fraction in the rows after it
+    assert field_type(values + ['3'], sample_size=2)[0] == expected
+
+@pytest.mark.parametrize('values, expected', [
+    ([1, 2], 'LONG'),
+    ([1, SHORT_RANGE[1] + 1], 'LONG'),
+    ([1, LONG_RANGE[1] + 1], 'DOUBLE'),
+])
+def test_sampled_integers_widen_one_step(values, expected):
+    assert field_type(values + [3], 'BigInteger', sample_size=2)[0] == expected
+
+def test_sampled_text_length_widens():
+    assert field_type(['a', 'bc', 'x' * 300], sample_size=2) == ['TEXT', 255]
+
+def test_fractions_in_integer_field_are_counted():
+    schema = TableSchema([Field('VALUE_FIELD', 'BigInteger')], [(1,), (2,), (3,)], sample_size=2)
+    assert schema.field_definitions()[0][1] == 'LONG'
+    assert list(schema.convert_rows([(1,), (2.5,)])) == [(1,), (None,)]
+    assert schema.conversion_errors == 1
+
+def test_text_lengths():
+    schema = TableSchema([Field('REF_AREA'), Field('REQUIRED', 'OID', required=True)], [('12', 1), ('3', 2)], text_lengths={'ref_area': 20})
+    assert schema.field_definitions() == [['REF_AREA', 'TEXT', 'REF_AREA', 20]]
+    assert list(schema.convert_rows([('12', 1)])) == [('12', 1)]
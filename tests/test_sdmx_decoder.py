@@ -0,0 +1,90 @@
+from datetime import datetime
+
+from dateutil import parser
+
+from sdmx_codelists import SDMXCodelists
+from sdmx_decoder import SDMXObservationDecoder
+
+DIMENSIONS = [
+    {'id': 'REF_AREA', 'keyPosition': 0, 'name': {'en': 'Reference area'}, 'values': [{'id': 'A1', 'name': {'en': 'Area 1'}}, {'id': 'A2', 'name': {'en': 'Area 2'}}, {'id': 'A3', 'name': {'en': 'Area 3'}}]},
+    {'id': 'TIME_PERIOD', 'keyPosition': 1, 'name': {'en': 'Time period'}, 'values': [{'id': '2020', 'name': {'en': '2020'}}, {'id': '2021-03', 'name': {'en': '2021-03'}}]},
+    {'id': 'SEX', 'keyPosition': 2, 'name': {'en': 'Sex'}, 'values': [{'id': 'F', 'name': {'en': 'Female'}}, {'id': 'M', 'name': {'en': 'Male'}}]}
+]
+
+ATTRIBUTES = [
+    {'id': 'OBS_STATUS', 'name': {'en': 'Observation status'}, 'values': [{'id': 'A', 'name': {'en': 'Normal'}}, {'id': 'P', 'name': {'en': 'Provisional'}}]},
+    {'id': 'UNIT_MULT', 'name': {'en': 'Unit multiplier'}, 'values': [{'id': '0', 'name': {'en': 'Units'}}]}
+]
+
+OBSERVATIONS = {
+    '0:0:0': [1.5, 0, 0],
+    '1:1:1': [2.0, 1],
+    '2:0:1': [None, None, 0],
+    '2:1:0': [3.25],
+    '0:1:1': [7.0, 1, None]
+}
+
+def loop_decode(observations, dimension_props, attribute_props):
+    # the per-observation loop the decoder replaced, one dict per observation
+    features = []
+    for obs, values in observations.items():
+        feature = {}
+        for i, key in enumerate(obs.split(':')):
+            found_dim = [dim for dim in dimension_props if dim['keyPosition'] == i][0]
+            value = found_dim['values'][int(key)]
+            label_field = found_dim['name']['en'].upper().replace(' ', '_')
+            if found_dim['id'] == 'TIME_PERIOD':
+                period = datetime.strftime(parser.parse(value['name']['en']), '%Y-%m')
+                feature['{}_CODE'.format(found_dim['id'])] = period
+                feature[label_field] = period
+            else:
+                feature['{}_CODE'.format(found_dim['id'])] = value['id']
+                feature[label_field] = value['name']['en']
+
+        feature['OBS_VALUE'] = values[0]
+        for j, found_att in enumerate(attribute_props):
+            att_value = values[j + 1] if j + 1 < len(values) else None
+            if att_value is None:
+                feature['{}_CODE'.format(found_att['id'])] = None
+                feature[found_att['id']] = None
+            else:
+                feature['{}_CODE'.format(found_att['id'])] = found_att['values'][att_value]['id']
+                feature[found_att['id']] = found_att['values'][att_value]['name']['en']
+        features.append(feature)
+    return features
+
+def test_decoder_matches_loop():
+    decoder = SDMXObservationDecoder(DIMENSIONS, ATTRIBUTES)
+    rows = decoder.decode_rows(list(OBSERVATIONS.keys()), list(OBSERVATIONS.values()))
+    decoded = [dict(zip(decoder.field_names, row)) for row in rows]
+    assert decoded == loop_decode(OBSERVATIONS, DIMENSIONS, ATTRIBUTES)
+
+def test_key_position_orders_dimensions():
+    # dimensions listed out of key order still read the right part of the key
+    dimensions = [DIMENSIONS[2], DIMENSIONS[0], DIMENSIONS[1]]
+    decoder = SDMXObservationDecoder(dimensions, ATTRIBUTES)
+    rows = decoder.decode_rows(list(OBSERVATIONS.keys()), list(OBSERVATIONS.values()))
+    decoded = [dict(zip(decoder.field_names, row)) for row in rows]
+    assert decoded == loop_decode(OBSERVATIONS, DIMENSIONS, ATTRIBUTES)
+
+def test_field_definitions_fit_values():
+    decoder = SDMXObservationDecoder(DIMENSIONS, ATTRIBUTES)
+    lengths = {name: length for name, _, _, length in decoder.field_definitions()}
+    assert lengths['REF_AREA_CODE'] == 2
+    assert lengths['REFERENCE_AREA'] == 6
+    assert lengths['TIME_PERIOD_CODE'] == 7
+    assert lengths['OBS_STATUS'] == 11
+    assert decoder.field_definitions()[-1][:2] == ['OBS_VALUE', 'DOUBLE']
+
+def test_no_observations():
+    decoder = SDMXObservationDecoder(DIMENSIONS, ATTRIBUTES)
+    assert list(decoder.decode_rows([], [])) == []
+
+def test_codelist_labels():
+    codelists = SDMXCodelists()
+    codelists.codelists = {'CL_AREA': {'A1': 'First area', 'A2': 'Second area'}}
+    codelists.components = {'REF_AREA': ('REF_AREA', 'CL_AREA')}
+    decoder = SDMXObservationDecoder(DIMENSIONS, ATTRIBUTES, codelists)
+    rows = decoder.decode_rows(['0:0:0', '1:0:0', '2:0:0'], [[1.0], [2.0], [3.0]])
+    # codes missing from the codelist keep the label of the response
+    assert [row[1] for row in rows] == ['First area', 'Second area', 'Area 3']
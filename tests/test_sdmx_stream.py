@@ -0,0 +1,69 @@
+import io
+import json
+
+from sdmx_stream import SDMXStreamParser
+
+STRUCTURE = {
+    'dimensions': {'observation': [
+        {'id': 'REF_AREA', 'keyPosition': 0, 'name': {'en': 'Reference area'}, 'values': [{'id': 'A1', 'name': {'en': 'Area 1'}}, {'id': 'A2', 'name': {'en': 'Area 2'}}]},
+        {'id': 'SEX', 'keyPosition': 1, 'name': {'en': 'Sex'}, 'values': [{'id': 'F', 'name': {'en': 'Female'}}, {'id': 'M', 'name': {'en': 'Male'}}]}
+    ]},
+    'attributes': {'observation': [
+        {'id': 'OBS_STATUS', 'name': {'en': 'Status'}, 'values': [{'id': 'P', 'name': {'en': 'Provisional'}}]}
+    ]}
+}
+
+OBSERVATIONS = {
+    '0:0': [1.5, 0],
+    '0:1': [2, None],
+    '1:0': [None],
+    '1:1': [4.25, 0]
+}
+
+def message(structure_first=True, datasets=None):
+    data = {}
+    datasets = datasets if datasets is not None else [{'action': 'Information', 'observations': OBSERVATIONS}]
+    if structure_first:
+        data['structure'] = STRUCTURE
+        data['dataSets'] = datasets
+    else:
+        data['dataSets'] = datasets
+        data['structure'] = STRUCTURE
+    return json.dumps({'meta': {'id': 'test'}, 'data': data}).encode('utf-8')
+
+def parsed_observations(body):
+    # what the non-streamed path reads from the whole message
+    res_json = json.loads(body)
+    return res_json['data']['structure'], list(res_json['data']['dataSets'][0]['observations'].items())
+
+def streamed_observations(body, batch_size):
+    parser = SDMXStreamParser(io.BytesIO(body), batch_size=batch_size)
+    structure = parser.read_structure()
+    observations = [obs for batch in parser.observation_batches() for obs in batch]
+    return structure, observations, parser.res_count
+
+def test_stream_matches_parsed_message():
+    body = message()
+    structure, observations = parsed_observations(body)
+    for batch_size in (1, 3, 100):
+        streamed_structure, streamed, res_count = streamed_observations(body, batch_size)
+        assert streamed_structure == structure
+        assert streamed == observations
+        assert res_count == len(observations)
+
+def test_observations_before_structure_are_kept():
+    body = message(structure_first=False)
+    structure, observations = parsed_observations(body)
+    streamed_structure, streamed, _ = streamed_observations(body, 2)
+    assert streamed_structure == structure
+    assert streamed == observations
+
+def test_only_first_dataset_is_read():
+    body = message(datasets=[{'observations': OBSERVATIONS}, {'observations': {'0:0': [99]}}])
+    _, observations = parsed_observations(body)
+    _, streamed, _ = streamed_observations(body, 2)
+    assert streamed == observations
+
+def test_batches_hold_at_most_batch_size():
+    parser = SDMXStreamParser(io.BytesIO(message()), batch_size=3)
+    assert [len(batch) for batch in parser.observation_batches()] == [3, 1]